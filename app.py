@@ -94,11 +94,14 @@ sys.stderr.reconfigure(line_buffering=True)
 print("[STARTUP] app.py loading...", flush=True)
 
 # Database and ORM imports
-from sqlalchemy.pool import NullPool
+from sqlalchemy.pool import NullPool, QueuePool
+from sqlalchemy import event as sa_event, exc as sa_exc
+from sqlalchemy.schema import CreateIndex
 from flask import Flask, render_template, request, session, redirect, url_for, Response, flash, jsonify
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user, UserMixin
 from flask_socketio import SocketIO, join_room, emit
+import click
 
 # Security and authentication
 from werkzeug.security import generate_password_hash, check_password_hash
@@ -108,10 +111,20 @@ from authlib.integrations.flask_client import OAuth
 
 # Utilities
 import base64
-import io
 import json
 import os
 import requests
+import threading
+import concurrent.futures
+import uuid
+import bisect
+import heapq
+import random
+import math
+from dataclasses import dataclass, field, fields
+from collections import OrderedDict, deque, Counter
+import hashlib
+import atexit
 from pytz import timezone, utc
 
 import os
@@ -360,6 +373,13 @@ try:
 except ImportError:
     GEMINI_AVAILABLE = False  # Graceful degradation if library not installed
 
+# Optional shared cache backend (AI responses shared across gunicorn workers)
+try:
+    import redis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False  # Per-process cache only
+
 # ============================================================================
 # FLASK APPLICATION INITIALIZATION
 # ============================================================================
@@ -410,17 +430,55 @@ app.config['SQLALCHEMY_DATABASE_URI'] = database_url
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False  # Disable modification tracking to save memory
 
 # Connection Pool Settings for Cloud PostgreSQL (Neon/Supabase/Render)
-# NullPool: Opens a fresh connection per request — safest for cloud DBs with connection limits
-# No pool_pre_ping with NullPool (it's redundant; each connection is brand-new)
+# DB_POOL_MODE selects the strategy:
+#   null      - NullPool: a fresh connection per checkout (default, safest for tight connection limits)
+#   queue     - QueuePool: keeps warm connections so requests skip the TCP + TLS handshake
+#   pgbouncer - small QueuePool in front of a PgBouncer/Supavisor transaction-mode pooler
 _is_postgres_url = database_url.startswith("postgresql://") or database_url.startswith("postgres://")
 _connect_args = {'connect_timeout': 10}
 if _is_postgres_url:
     _connect_args['sslmode'] = 'require'   # Required for Neon / Supabase
 
-app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
-    'poolclass': NullPool,          # No connection pooling — one connection per request
-    'connect_args': _connect_args,  # Timeout + SSL (Neon/Supabase require SSL)
-}
+DB_POOL_MODE = os.getenv('DB_POOL_MODE', 'null').strip().lower()
+if DB_POOL_MODE not in ('null', 'queue', 'pgbouncer'):
+    print(f"[DB] Unknown DB_POOL_MODE '{DB_POOL_MODE}', falling back to 'null'")
+    DB_POOL_MODE = 'null'
+if database_url.startswith('sqlite'):
+    DB_POOL_MODE = 'null'  # SQLite file DBs gain nothing from a QueuePool
+
+if DB_POOL_MODE == 'queue':
+    # Neon free tier allows ~100 connections, Supabase direct ~60: keep size + overflow well below that
+    _engine_options = {
+        'poolclass': QueuePool,
+        'pool_size': int(os.getenv('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', 5)),
+        'pool_timeout': int(os.getenv('DB_POOL_TIMEOUT', 10)),    # Seconds to wait for a free connection
+        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', 280)),   # Recycle before Neon/Supabase idle cut-off (~5 min)
+        'pool_pre_ping': True,                                    # Detect connections dropped by the server
+        'connect_args': _connect_args,
+    }
+elif DB_POOL_MODE == 'pgbouncer':
+    # Transaction-mode poolers multiplex server connections, so keep the client pool small
+    # and never rely on session state (SET, advisory locks). psycopg2 does not use
+    # server-side prepared statements, so no extra driver flags are needed.
+    _engine_options = {
+        'poolclass': QueuePool,
+        'pool_size': int(os.getenv('DB_POOL_SIZE', 3)),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', 2)),
+        'pool_timeout': int(os.getenv('DB_POOL_TIMEOUT', 10)),
+        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', 280)),
+        'pool_pre_ping': True,
+        'connect_args': _connect_args,
+    }
+else:
+    # No pool_pre_ping with NullPool (it's redundant; each connection is brand-new)
+    _engine_options = {
+        'poolclass': NullPool,          # No connection pooling — one connection per request
+        'connect_args': _connect_args,  # Timeout + SSL (Neon/Supabase require SSL)
+    }
+
+print(f"[DB] Pool mode: {DB_POOL_MODE}")
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = _engine_options
 
 # File upload configuration for profile images and syllabus PDFs
 app.config['UPLOAD_FOLDER'] = os.path.join('static', 'uploads')
@@ -513,36 +571,79 @@ AI_API_KEY = _raw_keys[0] if _raw_keys else ""
 AI_API_TYPE = os.getenv("AI_API_TYPE", "google")  # Currently only Google Gemini supported
 
 
-class GeminiKeyRotator:
+@dataclass
+class GeminiKeyState:
+    """Health + rate state for one API key (owned by GeminiKeyScheduler, guarded by its lock)."""
+    index: int
+    key: str
+    tokens: float
+    refilled_at: float
+    cooldown_until: float = 0.0      # 429 backoff (per-minute limits)
+    exhausted_until: float = 0.0     # daily quota hit: skip until the next reset
+    consecutive_429: int = 0
+    requests: int = 0
+    successes: int = 0
+    errors: int = 0
+    quota_errors: int = 0
+    total_latency: float = 0.0
+    last_used: float = 0.0
+    last_error: str = ''
+
+    @property
+    def label(self):
+        return f"#{self.index + 1} (…{self.key[-4:]})" if self.key else f"#{self.index + 1}"
+
+
+class GeminiKeyScheduler:
     """
-    API Key Pool with automatic rotation on quota exhaustion.
+    Thread-safe, health-aware scheduling over the Gemini API key pool.
 
     How it works:
-    - Holds a list of Gemini API keys.
-    - On every `generate_content` call, it uses the current active key.
-    - If a ResourceExhausted (429) or quota error is detected, it rotates
-      to the next key, re-configures genai, and retries automatically.
-    - If ALL keys are exhausted, raises an exception.
+    - Each key has a token bucket (GEMINI_KEY_RPM requests / minute); every
+      call takes the available key with the most tokens, so load is spread
+      across keys instead of burning key #1 first.
+    - A per-minute 429 puts the key in exponential-backoff cooldown; a daily
+      quota error parks it until the next daily reset (midnight Pacific,
+      when Gemini quotas reset) — after that it is used again.
+    - Keys are passed per call through a per-key client; the process-global
+      genai.configure() is never touched after startup, so concurrent
+      requests can't race on it.
+    - Latency / error stats per key feed the admin key-health page.
 
     Usage in Render:
     - Set AI_API_KEY_1, AI_API_KEY_2, AI_API_KEY_3, ... in Render environment.
     """
 
-    def __init__(self, keys: list):
-        self.keys = keys
-        self._index = 0  # Current active key index
-        if GEMINI_AVAILABLE and self.keys:
+    BACKOFF_BASE = 2          # seconds; doubles per consecutive 429
+    BACKOFF_MAX = 300
+    MAX_WAIT = 10             # seconds a call may wait for a token before giving up
+    QUOTA_TZ = timezone('America/Los_Angeles')
+
+    def __init__(self, keys: list, rpm=None):
+        self.rpm = rpm or int(os.getenv('GEMINI_KEY_RPM', 10))
+        now = time.time()
+        self._lock = threading.Lock()
+        self._keys = [GeminiKeyState(index=i, key=k, tokens=float(self.rpm), refilled_at=now) for i, k in enumerate(keys)]
+        self._clients = {}  # key index -> GenerativeServiceClient
+        if GEMINI_AVAILABLE and keys:
             try:
-                genai.configure(api_key=self.keys[0])
-                print(f"[Gemini] Loaded {len(self.keys)} API key(s). Active: key #{1}")
+                # Default for any code path that still uses the global client
+                genai.configure(api_key=keys[0])
             except Exception as e:
-                print(f"[Gemini] Failed to configure with key #1: {e}")
+                print(f"[Gemini] Failed to configure default key: {e}")
+            print(f"[Gemini] Loaded {len(keys)} API key(s), {self.rpm} req/min each")
+
+    @property
+    def available(self) -> bool:
+        """True if at least one API key is configured."""
+        return bool(self._keys)
 
     @property
-    def current_key(self):
-        return self.keys[self._index] if self.keys else ""
+    def keys(self):
+        return [state.key for state in self._keys]
 
-    def _is_quota_error(self, exc: Exception) -> bool:
+    @staticmethod
+    def _is_quota_error(exc: Exception) -> bool:
         """Detect quota/rate-limit errors from Gemini API."""
         err_str = str(exc).lower()
         quota_signals = [
@@ -553,60 +654,498 @@ class GeminiKeyRotator:
         ]
         return any(signal in err_str for signal in quota_signals)
 
-    def _rotate(self) -> bool:
-        """Rotate to the next available key. Returns True if rotation succeeded."""
-        next_index = self._index + 1
-        if next_index >= len(self.keys):
-            print("[Gemini] All API keys exhausted. No more keys to try.")
-            return False
-        self._index = next_index
-        new_key = self.keys[self._index]
-        try:
-            genai.configure(api_key=new_key)
-            print(f"[Gemini] Rotated to API key #{self._index + 1}")
-            return True
-        except Exception as e:
-            print(f"[Gemini] Failed to configure key #{self._index + 1}: {e}")
-            return False
+    @staticmethod
+    def _is_daily_quota(exc: Exception) -> bool:
+        err_str = str(exc).lower()
+        return 'per day' in err_str or 'perday' in err_str or 'daily' in err_str
+
+    def _next_daily_reset(self):
+        now = datetime.now(self.QUOTA_TZ)
+        tomorrow = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+        return tomorrow.timestamp()
+
+    def _refill_locked(self, state, now):
+        elapsed = now - state.refilled_at
+        state.tokens = min(float(self.rpm), state.tokens + elapsed * self.rpm / 60.0)
+        state.refilled_at = now
+
+    def _acquire(self, exclude):
+        """Pick a key (most tokens, then least recently used) and take a token; waits up to MAX_WAIT."""
+        deadline = time.time() + self.MAX_WAIT
+        while True:
+            now = time.time()
+            with self._lock:
+                best, soonest = None, None
+                for state in self._keys:
+                    if state.index in exclude:
+                        continue
+                    blocked_until = max(state.cooldown_until, state.exhausted_until)
+                    if blocked_until > now:
+                        soonest = blocked_until if soonest is None else min(soonest, blocked_until)
+                        continue
+                    self._refill_locked(state, now)
+                    if state.tokens < 1:
+                        ready_at = now + (1 - state.tokens) * 60.0 / self.rpm
+                        soonest = ready_at if soonest is None else min(soonest, ready_at)
+                        continue
+                    if best is None or (state.tokens, -state.last_used) > (best.tokens, -best.last_used):
+                        best = state
+                if best is not None:
+                    best.tokens -= 1
+                    best.last_used = now
+                    best.requests += 1
+                    return best
+            if soonest is None or soonest > deadline:
+                raise RuntimeError(
+                    "All Gemini API keys are rate-limited or exhausted right now. "
+                    "Please try again later or add more API keys."
+                )
+            time.sleep(max(0.05, soonest - time.time()))
+
+    def _client_for(self, state):
+        client = self._clients.get(state.index)
+        if client is None:
+            from google.ai import generativelanguage as glm
+            client = glm.GenerativeServiceClient(client_options={'api_key': state.key})
+            with self._lock:
+                client = self._clients.setdefault(state.index, client)
+        return client
+
+    def _record_success(self, state, latency):
+        with self._lock:
+            state.successes += 1
+            state.total_latency += latency
+            state.consecutive_429 = 0
+            state.cooldown_until = 0.0
+
+    def _record_failure(self, state, exc, latency, quota):
+        with self._lock:
+            state.total_latency += latency
+            state.last_error = str(exc)[:200]
+            if not quota:
+                state.errors += 1
+                return
+            state.quota_errors += 1
+            if self._is_daily_quota(exc):
+                state.exhausted_until = self._next_daily_reset()
+                print(f"[Gemini] Key {state.label} daily quota exhausted until reset")
+            else:
+                state.consecutive_429 += 1
+                backoff = min(self.BACKOFF_MAX, self.BACKOFF_BASE * 2 ** (state.consecutive_429 - 1))
+                state.cooldown_until = time.time() + backoff
+                print(f"[Gemini] Key {state.label} rate-limited, cooling down {backoff}s")
 
     def generate_content(self, model_name: str, *args, **kwargs):
         """
-        Call generate_content with automatic key rotation on quota errors.
-        Wraps genai.GenerativeModel(model_name).generate_content(...).
+        Call generate_content on a scheduled key; on a quota error the next
+        healthy key is tried. Wraps genai.GenerativeModel(model_name).generate_content(...).
         """
         if not GEMINI_AVAILABLE:
             raise RuntimeError("google-generativeai library not installed.")
-        if not self.keys:
+        if not self._keys:
             raise ValueError("No Gemini API keys configured.")
 
         tried = set()
         while True:
-            if self._index in tried:
-                raise RuntimeError("All Gemini API keys have been exhausted for today.")
-            tried.add(self._index)
+            state = self._acquire(exclude=tried)
+            tried.add(state.index)
+            model = genai.GenerativeModel(model_name)
+            model._client = self._client_for(state)  # Per-call key, no global configure
+            started = time.time()
             try:
-                model = genai.GenerativeModel(model_name)
-                return model.generate_content(*args, **kwargs)
+                response = model.generate_content(*args, **kwargs)
             except Exception as exc:
-                if self._is_quota_error(exc):
-                    print(f"[Gemini] Key #{self._index + 1} quota exhausted: {exc}")
-                    if not self._rotate():
-                        raise RuntimeError(
-                            "All Gemini API keys have been exhausted for today. "
-                            "Please try again tomorrow or add more API keys."
-                        ) from exc
-                    # Retry with the new key (loop continues)
-                else:
+                quota = self._is_quota_error(exc)
+                self._record_failure(state, exc, time.time() - started, quota)
+                if not quota:
                     raise  # Non-quota error — propagate immediately
+                if len(tried) >= len(self._keys):
+                    raise RuntimeError(
+                        "All Gemini API keys have been exhausted for now. "
+                        "Please try again later or add more API keys."
+                    ) from exc
+                continue  # Retry on another key
+            self._record_success(state, time.time() - started)
+            return response
 
-    @property
-    def available(self) -> bool:
-        """True if at least one API key is configured."""
-        return bool(self.keys)
+    def health(self):
+        """Per-key health snapshot (keys masked) for the admin page."""
+        now = time.time()
+        rows = []
+        with self._lock:
+            for state in self._keys:
+                self._refill_locked(state, now)
+                if state.exhausted_until > now:
+                    status = 'exhausted'
+                elif state.cooldown_until > now:
+                    status = 'cooldown'
+                else:
+                    status = 'healthy'
+                completed = state.successes + state.errors + state.quota_errors
+                rows.append({
+                    'key': state.label,
+                    'status': status,
+                    'tokens': round(state.tokens, 1),
+                    'capacity': self.rpm,
+                    'requests': state.requests,
+                    'successes': state.successes,
+                    'errors': state.errors,
+                    'quota_errors': state.quota_errors,
+                    'avg_latency_ms': round(state.total_latency / completed * 1000) if completed else None,
+                    'retry_in_s': round(max(state.cooldown_until, state.exhausted_until) - now) if status != 'healthy' else 0,
+                    'last_error': state.last_error,
+                })
+        return rows
+
+
+# Global key scheduler instance
+gemini_keys = GeminiKeyScheduler(_raw_keys)
+
+# ============================================================================
+# AI GATEWAY (bounded worker pool in front of Gemini)
+# ============================================================================
+
+class AIGatewayBusy(RuntimeError):
+    """An endpoint is at its concurrency limit and the queue wait ran out."""
+
+
+class AIGatewayTimeout(TimeoutError):
+    """The AI call didn't finish within the gateway timeout."""
+
+
+class GeminiBackend:
+    """Real backend: Gemini through the key scheduler."""
+    name = 'gemini'
+
+    def generate(self, model_name, *args, **kwargs):
+        return gemini_keys.generate_content(model_name, *args, **kwargs)
+
+    def stream(self, model_name, prompt):
+        """Yield text deltas as Gemini produces them (generate_content(stream=True))."""
+        response = gemini_keys.generate_content(model_name, prompt, stream=True)
+        for chunk in response:
+            try:
+                text = chunk.text
+            except ValueError:
+                continue  # Chunk without text parts (safety / finish metadata)
+            if text:
+                yield text
+
+
+class FakeGeminiBackend:
+    """
+    Local stand-in for Gemini (AI_BACKEND=fake) so the gateway can be
+    benchmarked offline: sleeps for a configurable latency and echoes the
+    prompt in a response object that has .text like the real one.
+    """
+    name = 'fake'
+    TOKEN_DELAY = 0.02
+
+    class FakeResponse:
+        def __init__(self, text):
+            self.text = text
+
+    def __init__(self, latency_ms=800, jitter_ms=200):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+
+    def _delay(self):
+        return max(0, self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)) / 1000
 
+    def generate(self, model_name, *args, **kwargs):
+        time.sleep(self._delay())
+        prompt = args[0] if args else kwargs.get('contents')
+        return FakeGeminiBackend.FakeResponse(f"[fake {model_name}] {str(prompt)[:200]}")
 
-# Global key rotator instance
-gemini_rotator = GeminiKeyRotator(_raw_keys)
+    def stream(self, model_name, prompt):
+        """First word after the usual latency, then one word every TOKEN_DELAY seconds."""
+        time.sleep(self._delay())
+        for i, word in enumerate(f"[fake {model_name}] {str(prompt)[:200]}".split(' ')):
+            if i:
+                time.sleep(self.TOKEN_DELAY)
+            yield word if i == 0 else ' ' + word
+
+
+class AIGateway:
+    """
+    Bounded worker pool for all AI calls, so slow Gemini responses queue
+    here instead of piling up on request / Socket.IO threads.
+
+    DS concept:
+    - ThreadPoolExecutor with a fixed number of workers
+    - Per-endpoint BoundedSemaphore: 'chat', 'battle', 'quiz', 'topic',
+      'photo', 'voice', 'summary' each get their own slice of the pool; acquiring
+      waits at most `queue_timeout` before AIGatewayBusy
+    - Coalescing: hash map request-hash -> in-flight Future. Identical
+      prompts submitted while one is running share its result
+    - Jobs: job_id -> Future, so routes can return immediately and the
+      client polls /api/ai/jobs/<job_id>
+    - Streams: token-by-token calls share the same pool and endpoint slots;
+      time-to-first-token of the last TTFT_WINDOW streams is kept in a
+      bounded deque for p50 / p95
+    """
+
+    DEFAULT_LIMITS = {'chat': 4, 'battle': 2, 'quiz': 2, 'topic': 2, 'photo': 2, 'voice': 3, 'summary': 1}
+    JOB_TTL_SECONDS = 600
+    TTFT_WINDOW = 500
+
+    def __init__(self, backend, max_workers=8, timeout=60, queue_timeout=5, limits=None):
+        self.backend = backend
+        self.timeout = timeout
+        self.queue_timeout = queue_timeout
+        self.limits = dict(self.DEFAULT_LIMITS, **(limits or {}))
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='ai-gateway')
+        self._max_workers = max_workers
+        self._semaphores = {name: threading.BoundedSemaphore(n) for name, n in self.limits.items()}
+        self._lock = threading.Lock()
+        self._inflight = {}   # request hash -> Future
+        self._jobs = {}       # job_id -> (owner_id, created_at, Future)
+        self._active = {name: 0 for name in self.limits}
+        self._ttft = deque(maxlen=self.TTFT_WINDOW)  # seconds to first streamed token
+        self.stats_counters = {'submitted': 0, 'coalesced': 0, 'rejected': 0, 'timeouts': 0, 'completed': 0, 'failed': 0,
+                               'streams': 0, 'cancelled': 0}
+
+    @staticmethod
+    def from_env():
+        limits = {}
+        for pair in os.getenv('AI_GATEWAY_LIMITS', '').split(','):
+            name, _, value = pair.partition('=')
+            if name.strip() and value.strip().isdigit():
+                limits[name.strip()] = int(value)
+        if os.getenv('AI_BACKEND', 'gemini').lower() == 'fake':
+            backend = FakeGeminiBackend(latency_ms=int(os.getenv('FAKE_AI_LATENCY_MS', 800)))
+            print("[AIGateway] Using fake Gemini backend")
+        else:
+            backend = GeminiBackend()
+        return AIGateway(
+            backend,
+            max_workers=int(os.getenv('AI_GATEWAY_WORKERS', 8)),
+            timeout=int(os.getenv('AI_GATEWAY_TIMEOUT', 60)),
+            queue_timeout=int(os.getenv('AI_GATEWAY_QUEUE_TIMEOUT', 5)),
+            limits=limits
+        )
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self.stats_counters[name] += n
+
+    @staticmethod
+    def _request_hash(endpoint, model_name, args, kwargs):
+        raw = repr((endpoint, model_name, args, sorted(kwargs.items())))
+        return hashlib.sha256(raw.encode('utf-8', 'replace')).hexdigest()
+
+    def submit(self, endpoint, model_name, *args, **kwargs):
+        """Queue an AI call; returns a Future of the backend response (coalesced if identical)."""
+        if endpoint not in self._semaphores:
+            raise ValueError(f"Unknown AI endpoint: {endpoint}")
+        key = self._request_hash(endpoint, model_name, args, kwargs)
+        with self._lock:
+            existing = self._inflight.get(key)
+            if existing is not None:
+                self.stats_counters['coalesced'] += 1
+                return existing
+
+        semaphore = self._semaphores[endpoint]
+        if not semaphore.acquire(timeout=self.queue_timeout):
+            self._count('rejected')
+            raise AIGatewayBusy(f"AI is busy right now ({endpoint}). Please try again in a moment.")
+
+        with self._lock:
+            existing = self._inflight.get(key)
+            if existing is not None:
+                # Someone submitted the same prompt while we waited for a slot
+                semaphore.release()
+                self.stats_counters['coalesced'] += 1
+                return existing
+            self._active[endpoint] += 1
+            self.stats_counters['submitted'] += 1
+            future = self._executor.submit(self.backend.generate, model_name, *args, **kwargs)
+            self._inflight[key] = future
+
+        def _done(f):
+            semaphore.release()
+            with self._lock:
+                self._active[endpoint] -= 1
+                if self._inflight.get(key) is f:
+                    del self._inflight[key]
+                self.stats_counters['failed' if f.exception() else 'completed'] += 1
+
+        future.add_done_callback(_done)
+        return future
+
+    def generate(self, endpoint, model_name, *args, timeout=None, **kwargs):
+        """Submit and wait (bounded by the gateway timeout). Returns the backend response."""
+        future = self.submit(endpoint, model_name, *args, **kwargs)
+        try:
+            return future.result(timeout=timeout or self.timeout)
+        except concurrent.futures.TimeoutError:
+            self._count('timeouts')
+            raise AIGatewayTimeout(f"AI request timed out after {timeout or self.timeout}s ({endpoint}).")
+
+    # --- Streaming ---
+
+    def stream(self, endpoint, model_name, prompt, on_delta, cancel_event=None):
+        """
+        Queue a streaming AI call. on_delta(text) is called from the worker
+        thread for every chunk; setting cancel_event stops the stream at the
+        next chunk. Streams are never coalesced (each has its own listener).
+        Returns a Future of (full_text, cancelled).
+        """
+        if endpoint not in self._semaphores:
+            raise ValueError(f"Unknown AI endpoint: {endpoint}")
+        semaphore = self._semaphores[endpoint]
+        if not semaphore.acquire(timeout=self.queue_timeout):
+            self._count('rejected')
+            raise AIGatewayBusy(f"AI is busy right now ({endpoint}). Please try again in a moment.")
+
+        started = time.perf_counter()
+
+        def run():
+            parts, cancelled = [], False
+            chunks = self.backend.stream(model_name, prompt)
+            try:
+                for delta in chunks:
+                    if cancel_event is not None and cancel_event.is_set():
+                        cancelled = True
+                        break
+                    if not parts:
+                        with self._lock:
+                            self._ttft.append(time.perf_counter() - started)
+                    parts.append(delta)
+                    on_delta(delta)
+                    if time.perf_counter() - started > self.timeout:
+                        self._count('timeouts')
+                        raise AIGatewayTimeout(f"AI stream timed out after {self.timeout}s ({endpoint}).")
+            finally:
+                chunks.close()
+            return ''.join(parts), cancelled
+
+        with self._lock:
+            self._active[endpoint] += 1
+            self.stats_counters['submitted'] += 1
+            self.stats_counters['streams'] += 1
+            future = self._executor.submit(run)
+
+        def _done(f):
+            semaphore.release()
+            with self._lock:
+                self._active[endpoint] -= 1
+                if f.exception():
+                    self.stats_counters['failed'] += 1
+                else:
+                    self.stats_counters['cancelled' if f.result()[1] else 'completed'] += 1
+
+        future.add_done_callback(_done)
+        return future
+
+    def ttft_stats(self):
+        """Time-to-first-token percentiles (ms) over the recent streams."""
+        with self._lock:
+            samples = sorted(self._ttft)
+        if not samples:
+            return {'ttft_samples': 0, 'ttft_p50_ms': None, 'ttft_p95_ms': None}
+        pct = lambda p: round(samples[min(len(samples) - 1, int(p * len(samples)))] * 1000)
+        return {'ttft_samples': len(samples), 'ttft_p50_ms': pct(0.5), 'ttft_p95_ms': pct(0.95)}
+
+    # --- Poll-able jobs ---
+
+    def track(self, owner_id, future):
+        """Register a Future as a job the owner can poll. Returns the job id."""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            for stale in [j for j, (_, created, f) in self._jobs.items()
+                          if f.done() and now - created > self.JOB_TTL_SECONDS]:
+                del self._jobs[stale]
+            self._jobs[job_id] = (owner_id, now, future)
+        return job_id
+
+    def job_status(self, owner_id, job_id):
+        """{'status': 'pending'|'done'|'error', ...} or None if unknown / not the owner's."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None or job[0] != owner_id:
+            return None
+        future = job[2]
+        if not future.done():
+            return {'status': 'pending'}
+        exc = future.exception()
+        if exc is not None:
+            return {'status': 'error', 'message': str(exc)}
+        result = future.result()
+        return {'status': 'done', 'result': getattr(result, 'text', result)}
+
+    def stats(self):
+        ttft = self.ttft_stats()
+        with self._lock:
+            return {
+                'backend': self.backend.name,
+                'workers': self._max_workers,
+                'limits': dict(self.limits),
+                'active': dict(self._active),
+                'inflight_unique': len(self._inflight),
+                'jobs': len(self._jobs),
+                **self.stats_counters,
+                **ttft
+            }
+
+
+ai_gateway = AIGateway.from_env()
+
+
+@app.cli.command('bench-ai-gateway')
+@click.option('--requests', 'total', type=int, default=200, help='Number of AI calls to issue.')
+@click.option('--clients', type=int, default=50, help='Concurrent callers.')
+@click.option('--latency-ms', type=int, default=800, help='Fake backend latency.')
+@click.option('--duplicates', type=float, default=0.3, help='Share of calls repeating an earlier prompt.')
+@click.option('--endpoint', default='chat', help='Gateway endpoint bucket to use.')
+@click.option('--stream', is_flag=True, help='Stream the calls and report time-to-first-token.')
+def bench_ai_gateway_command(total, clients, latency_ms, duplicates, endpoint, stream):
+    """Offline throughput benchmark of the AI gateway against the fake Gemini backend."""
+    gateway = AIGateway(FakeGeminiBackend(latency_ms=latency_ms), max_workers=int(os.getenv('AI_GATEWAY_WORKERS', 8)),
+                        timeout=120, queue_timeout=120)
+    rng = random.Random(7)
+    prompts = []
+    for i in range(total):
+        if prompts and rng.random() < duplicates:
+            prompts.append(rng.choice(prompts))
+        else:
+            prompts.append(f"Explain topic #{i}")
+
+    latencies, errors = [], []
+    lock = threading.Lock()
+
+    def caller(chunk):
+        for prompt in chunk:
+            start = time.perf_counter()
+            try:
+                if stream:
+                    gateway.stream(endpoint, AI_MODEL, prompt, on_delta=lambda delta: None).result()
+                else:
+                    gateway.generate(endpoint, AI_MODEL, prompt)
+                with lock:
+                    latencies.append(time.perf_counter() - start)
+            except Exception as e:
+                with lock:
+                    errors.append(str(e))
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=caller, args=(prompts[i::clients],)) for i in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    pct = lambda p: latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000 if latencies else 0
+    stats = gateway.stats()
+    print(f"[Bench] {total} calls, {clients} clients, limit {gateway.limits[endpoint]} on '{endpoint}', {latency_ms} ms backend")
+    print(f"[Bench] wall {elapsed:.2f}s, throughput {total / elapsed:.1f} calls/s")
+    print(f"[Bench] latency p50 {pct(0.5):.0f} ms, p95 {pct(0.95):.0f} ms")
+    print(f"[Bench] backend calls {stats['submitted']}, coalesced {stats['coalesced']}, rejected {stats['rejected']}, errors {len(errors)}")
+    if stream:
+        print(f"[Bench] time-to-first-token p50 {stats['ttft_p50_ms']} ms, p95 {stats['ttft_p95_ms']} ms")
 
 # ============================================================================
 # TIMEZONE CONFIGURATION
@@ -648,6 +1187,114 @@ AI_MODEL = os.getenv("AI_MODEL", "models/gemini-2.5-flash")
 # Initialize SQLAlchemy for database operations
 db = SQLAlchemy(app)
 
+
+class DBPoolMetrics:
+    """
+    Process-wide counters for connection pool health.
+    Exposed on /admin/metrics/db-pool so pool saturation is visible.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.connects = 0            # New physical connections (TCP + TLS handshakes)
+        self.connect_ms_total = 0.0
+        self.checkouts = 0
+        self.checkins = 0
+        self.checked_out = 0         # Connections currently held by requests
+        self.wait_ms_total = 0.0     # Time spent waiting for a pooled connection
+        self.wait_ms_max = 0.0
+        self.timeouts = 0            # Checkouts that gave up after pool_timeout
+
+    def record_connect(self, elapsed_ms):
+        with self._lock:
+            self.connects += 1
+            self.connect_ms_total += elapsed_ms
+
+    def record_wait(self, elapsed_ms, timed_out=False):
+        with self._lock:
+            self.wait_ms_total += elapsed_ms
+            self.wait_ms_max = max(self.wait_ms_max, elapsed_ms)
+            if timed_out:
+                self.timeouts += 1
+
+    def record_checkout(self):
+        with self._lock:
+            self.checkouts += 1
+            self.checked_out += 1
+
+    def record_checkin(self):
+        with self._lock:
+            self.checkins += 1
+            self.checked_out = max(0, self.checked_out - 1)
+
+    def snapshot(self, pool=None):
+        with self._lock:
+            data = {
+                'mode': DB_POOL_MODE,
+                'connects': self.connects,
+                'avg_connect_ms': round(self.connect_ms_total / self.connects, 2) if self.connects else 0,
+                'checkouts': self.checkouts,
+                'checkins': self.checkins,
+                'checked_out': self.checked_out,
+                'avg_wait_ms': round(self.wait_ms_total / self.checkouts, 2) if self.checkouts else 0,
+                'max_wait_ms': round(self.wait_ms_max, 2),
+                'timeouts': self.timeouts,
+            }
+        if isinstance(pool, QueuePool):
+            data.update({
+                'pool_size': pool.size(),
+                'pool_idle': pool.checkedin(),
+                'pool_in_use': pool.checkedout(),
+                'pool_overflow': pool.overflow(),
+            })
+        return data
+
+
+db_pool_metrics = DBPoolMetrics()
+
+
+def _install_pool_metrics(engine):
+    """Attach checkout/checkin/connect listeners and time pool waits for the given engine."""
+    pool = engine.pool
+
+    @sa_event.listens_for(pool, 'checkout')
+    def _on_checkout(dbapi_conn, conn_record, conn_proxy):
+        db_pool_metrics.record_checkout()
+
+    @sa_event.listens_for(pool, 'checkin')
+    def _on_checkin(dbapi_conn, conn_record):
+        db_pool_metrics.record_checkin()
+
+    @sa_event.listens_for(engine, 'do_connect')
+    def _on_do_connect(dialect, conn_rec, cargs, cparams):
+        # Time the raw driver connect (handshake) and return the connection ourselves
+        started = time.perf_counter()
+        conn = dialect.loaded_dbapi.connect(*cargs, **cparams)
+        db_pool_metrics.record_connect((time.perf_counter() - started) * 1000)
+        return conn
+
+    # Wrap the pool's internal getter to measure queueing time when the pool is exhausted
+    original_do_get = pool._do_get
+
+    def _timed_do_get():
+        started = time.perf_counter()
+        try:
+            conn_record = original_do_get()
+        except sa_exc.TimeoutError:
+            db_pool_metrics.record_wait((time.perf_counter() - started) * 1000, timed_out=True)
+            raise
+        db_pool_metrics.record_wait((time.perf_counter() - started) * 1000)
+        return conn_record
+
+    pool._do_get = _timed_do_get
+
+
+with app.app_context():
+    try:
+        _install_pool_metrics(db.engine)
+    except Exception as e:
+        print(f"[DB] Pool metrics disabled: {e}")
+
 # Email functionality removed
 
 # Initialize Flask-Login for user session management
@@ -754,7 +1401,13 @@ class User(UserMixin, db.Model):
             dict: {'name': str, 'icon': str, 'color': str}
             Example: {'name': 'Gold', 'icon': 'fa-shield-halved', 'color': '#FFD700'}
         """
-        return GamificationService.get_rank(self.level)
+        # Cached per object and keyed by level, so the rank / rank_name /
+        # rank_icon / rank_color properties don't each recompute it
+        cached = self.__dict__.get('_rank_cache')
+        if cached is None or cached[0] != self.level:
+            cached = (self.level, GamificationService.get_rank(self.level))
+            self._rank_cache = cached
+        return cached[1]
 
     @property
     def active_frame_color(self):
@@ -762,19 +1415,18 @@ class User(UserMixin, db.Model):
         Computed property: Returns the color of the user's equipped profile frame
         
         Profile frames are cosmetic items purchased from the shop.
-        This property checks UserItem table for active frame items.
+        Cosmetics are batch-loaded by CosmeticsService (lists call
+        CosmeticsService.annotate once); a lone user falls back to a
+        single cached lookup.
         
         Returns:
             str: Hex color code (e.g., '#FF5733') or None if no frame equipped
         """
         try:
-            # Query all active items for this user
-            active_items = UserItem.query.filter_by(user_id=self.id, is_active=True).all()
-            for u_item in active_items:
-                # Look up item details in shop catalog
-                cat_item = ShopService.ITEMS.get(u_item.item_id)
-                if cat_item and cat_item.get('type') == 'frame':
-                    return cat_item.get('color')
+            frame_id = CosmeticsService.for_user(self)['frame']
+            cat_item = ShopService.ITEMS.get(frame_id) if frame_id else None
+            if cat_item:
+                return cat_item.get('color')
         except Exception:
             pass  # Graceful degradation if shop system unavailable
         return None
@@ -847,7 +1499,7 @@ class User(UserMixin, db.Model):
         Returns:
             dict: User data with computed fields
         """
-        rank_data = GamificationService.get_rank(self.level)
+        rank_data = self.rank_info
         return {
             'id': self.id,
             'first_name': self.first_name,
@@ -1061,6 +1713,7 @@ class GamificationService:
     - Level formula: level = floor(total_xp / 500) + 1
     - Rank lookup: O(1) dictionary lookup by level range
     - Daily cap: Prevents XP farming (max 500 XP/day from focus)
+    - XP writes: single atomic UPDATE ... RETURNING via XPLedger
     
     Power-up Integration:
     - XP Multipliers: Boost XP gains (2x, 3x)
@@ -1086,141 +1739,51 @@ class GamificationService:
         # Level = floor(total_xp / 500) + 1
         return max(1, int(total_xp / 500) + 1)
 
+    # Precomputed lookup: _RANK_BY_LEVEL[level] -> rank descriptor for
+    # levels below RANK_TABLE_SIZE; higher levels bisect over _RANK_BOUNDS.
+    # Descriptors are shared between callers — treat them as read-only.
+    RANK_TABLE_SIZE = 256
+    _RANK_BY_LEVEL = []
+    _RANK_BOUNDS = []       # sorted min_level of each rank
+    _RANK_DESCRIPTORS = []  # descriptor per entry of _RANK_BOUNDS
+    _DEFAULT_RANK = {'name': 'Bronze', 'icon': 'fa-shield-halved', 'color': '#CD7F32'}
+
+    @staticmethod
+    def _build_rank_table():
+        cls = GamificationService
+        ranges = sorted(cls.RANKS.items())
+        cls._RANK_BOUNDS = [min_lvl for (min_lvl, _), _ in ranges]
+        cls._RANK_DESCRIPTORS = [
+            {'name': name, 'icon': icon, 'color': color} for _, (name, icon, color) in ranges
+        ]
+        cls._RANK_BY_LEVEL = [cls._rank_by_bisect(level) for level in range(cls.RANK_TABLE_SIZE)]
+
+    @staticmethod
+    def _rank_by_bisect(level):
+        cls = GamificationService
+        i = bisect.bisect_right(cls._RANK_BOUNDS, level) - 1
+        if i < 0:
+            return cls._DEFAULT_RANK
+        return cls._RANK_DESCRIPTORS[i]
+
     @staticmethod
     def get_rank(level):
+        # O(1) array lookup; bisect over rank boundaries above the table
         if level is None: level = 1
-        for (min_lvl, max_lvl), (name, icon, color) in GamificationService.RANKS.items():
-            if min_lvl <= level <= max_lvl:
-                return {'name': name, 'icon': icon, 'color': color}
-        return {'name': 'Bronze', 'icon': 'fa-shield-halved', 'color': '#CD7F32'}
+        table = GamificationService._RANK_BY_LEVEL
+        if 0 <= level < len(table):
+            return table[level]
+        return GamificationService._rank_by_bisect(level)
 
     @staticmethod
     def add_xp(user_id, source, amount, force_deduct=False):
-        user = User.query.get(user_id)
-        if not user:
-            return
-        
-        # Prevent XP changes for demo/test users
-        # This stops automatic XP increments for presentation/demo accounts
-        demo_emails = ['daksh@gmail.com', 'daksh@studyverse.com', 'demo@studyverse.com']
-        if user.email and user.email.lower() in demo_emails:
-            print(f"XP change blocked for demo user: {user.email}")
-            return {'earned': 0, 'message': 'Demo account - XP locked'}
-
-
-        # 1. Fetch ALL active power-ups for the user
-        active_powerups = ActivePowerUp.query.filter_by(
-            user_id=user.id,
-            is_active=True
-        ).all()
-        
-        # 2. Categorize and clean up expired power-ups
-        xp_multiplier = 1.0
-        time_multiplier = 1.0
-        has_protection = False
-        active_boost = None
-
-        for powerup in active_powerups:
-            if powerup.is_expired():
-                powerup.is_active = False
-                continue
-            
-            # Fetch item details from catalog to know the effect type
-            item_id = powerup.power_up_id
-            cat_item = ShopService.ITEMS.get(item_id)
-            if not cat_item: continue
-
-            effect = cat_item.get('effect')
-            
-            if effect in ['xp_multiplier', 'mega_xp_multiplier']:
-                if powerup.multiplier > xp_multiplier:
-                    xp_multiplier = powerup.multiplier
-                    active_boost = item_id
-            elif effect == 'time_multiplier':
-                if powerup.multiplier > time_multiplier:
-                    time_multiplier = powerup.multiplier
-            elif effect == 'xp_protection':
-                has_protection = True
-        
-        # 3. Handle XP loss protection
-        if amount < 0:
-            if not force_deduct and has_protection:
-                return {'earned': 0, 'message': 'XP Protection Active! No XP lost.'}
-            
-            # Direct deduction logic
-            user.total_xp = max(0, user.total_xp + amount) # Check bounds? Or allow negative? keeping 0 floor
-            
-            # Log negative history
-            log = XPHistory(user_id=user.id, source=source, amount=amount)
-            db.session.add(log)
-            db.session.commit()
-            return {'earned': amount, 'new_total': user.total_xp}
-
-        # 4. Apply special multipliers based on source (e.g., Double Time for focus)
-        actual_multiplier = xp_multiplier
-        if source == 'focus' and time_multiplier > 1.0:
-            # If both XP boost and Double Time are active, they might stack or we take the highest.
-            # Usually, Double Time specifically doubles the focus reward.
-            actual_multiplier *= time_multiplier
-
-        # 5. Cap Focus XP daily (Check BEFORE multipliers to keep cap consistent)
-        if source == 'focus':
-            today_start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
-            daily_focus_xp = db.session.query(db.func.sum(XPHistory.amount))\
-                .filter(XPHistory.user_id == user.id, XPHistory.source == 'focus', XPHistory.timestamp >= today_start)\
-                .scalar() or 0
-            
-            # Simple daily cap logic: max 500 XP from focus per day
-            if daily_focus_xp >= 500:
-                return {'earned': 0, 'message': 'Daily Focus XP cap reached!'}
-            
-            if daily_focus_xp + amount > 500:
-                amount = 500 - daily_focus_xp
-
-        if amount <= 0:
-            return
-
-        # Apply multiplier
-        original_amount = amount
-        if actual_multiplier > 1.0:
-            amount = int(amount * actual_multiplier)
+        """Award (or deduct) XP for one user. See XPLedger for the atomic write path."""
+        return XPLedger.apply(user_id, source, amount, force_deduct=force_deduct)
 
-        user.total_xp += amount
-        
-        # Level Up Check
-        new_level = GamificationService.calculate_level(user.total_xp)
-        leveled_up = False
-        if new_level > user.level:
-            user.level = new_level
-            leveled_up = True
-            
-        # Log History
-        log = XPHistory(user_id=user.id, source=source, amount=amount)
-        db.session.add(log)
-        
-        # Update Streak (if not already updated today)
-        GamificationService.update_streak(user)
-        
-        # Check Badges
-        GamificationService.check_badges(user)
-        
-        db.session.commit()
-        
-        result = {
-            'earned': amount, 
-            'new_total': user.total_xp, 
-            'leveled_up': leveled_up,
-            'new_level': user.level,
-            'rank': GamificationService.get_rank(user.level)
-        }
-        
-        # Add multiplier info if active
-        if actual_multiplier > 1.0:
-            result['multiplier'] = actual_multiplier
-            result['base_amount'] = original_amount
-            result['boost_active'] = active_boost
-        
-        return result
+    @staticmethod
+    def add_xp_batch(awards, source):
+        """Award XP to several users in one transaction, e.g. {user_id: amount} for a battle draw."""
+        return XPLedger.apply_many(awards, source)
 
     @staticmethod
     def update_streak(user):
@@ -1239,42 +1802,229 @@ class GamificationService:
 
     @staticmethod
     def check_badges(user):
-        # 1. Streak Badges
-        if user.current_streak >= 30:
-            GamificationService.award_badge(user, 'Consistency King')
-        
-        # 2. XP Badges (Level based roughly)
-        if user.level >= 10:
-             GamificationService.award_badge(user, 'Rising Star')
-        if user.level >= 50:
-             GamificationService.award_badge(user, 'Dedicated Scholar')
-        if user.level >= 100:
-             GamificationService.award_badge(user, 'Centurion')
-             
-        # More rules can be added here
-        
+        """Full evaluation of one user's current metrics (badges normally come from BadgeEngine events)."""
+        return badge_engine.evaluate_user(user)
+
     @staticmethod
     def award_badge(user, badge_name):
-        badge = Badge.query.filter_by(name=badge_name).first()
-        if not badge:
-            # Create default if missing (lazy init)
-            if badge_name == 'Consistency King':
-                badge = Badge(name='Consistency King', description='Achieve a 30-day streak', icon='fa-fire', criteria_type='streak', criteria_value=30)
-            elif badge_name == 'Rising Star':
-                badge = Badge(name='Rising Star', description='Reach Level 10', icon='fa-star', criteria_type='level', criteria_value=10)
-            elif badge_name == 'Dedicated Scholar':
-                badge = Badge(name='Dedicated Scholar', description='Reach Level 50', icon='fa-book-open', criteria_type='level', criteria_value=50)
-            elif badge_name == 'Centurion':
-                badge = Badge(name='Centurion', description='Reach Level 100', icon='fa-crown', criteria_type='level', criteria_value=100)
-            else:
-                return 
-            db.session.add(badge)
+        return badge_engine.award(user.id, badge_name)
+
+
+GamificationService._build_rank_table()
+
+
+@app.cli.command('bench-rank-lookup')
+@click.option('--users', type=int, default=1000, help='Simulated leaderboard size.')
+@click.option('--rounds', type=int, default=20, help='Timed repetitions.')
+def bench_rank_lookup_command(users, rounds):
+    """Micro-benchmark: rank lookups for a leaderboard render (linear scan vs lookup table)."""
+    def linear_get_rank(level):
+        # Previous implementation, kept here for comparison
+        for (min_lvl, max_lvl), (name, icon, color) in GamificationService.RANKS.items():
+            if min_lvl <= level <= max_lvl:
+                return {'name': name, 'icon': icon, 'color': color}
+        return {'name': 'Bronze', 'icon': 'fa-shield-halved', 'color': '#CD7F32'}
+
+    rng = random.Random(42)
+    board = [User(id=i + 1, first_name=f"User{i}", level=rng.randint(1, 150)) for i in range(users)]
+    card = app.jinja_env.from_string(
+        "{% for u in board %}<i class=\"fa-solid {{ u.rank_icon }}\" style=\"color: {{ u.rank_color }}\"></i>"
+        "{{ u.rank_name }} {{ u.rank }}{% endfor %}"
+    )
+
+    def timed(fn):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            fn()
+        return (time.perf_counter() - start) / rounds * 1000
+
+    # Four rank computations per card, like the old properties did
+    linear_ms = timed(lambda: [linear_get_rank(u.level)['name'] for u in board for _ in range(4)])
+    table_ms = timed(lambda: [GamificationService.get_rank(u.level)['name'] for u in board for _ in range(4)])
+    render_ms = timed(lambda: card.render(board=board))
+
+    print(f"[Bench] {users} users x {rounds} rounds")
+    print(f"[Bench] linear scan lookups:   {linear_ms:.3f} ms / render")
+    print(f"[Bench] lookup table lookups:  {table_ms:.3f} ms / render")
+    print(f"[Bench] template (cached rank): {render_ms:.3f} ms / render")
+
+
+# ------------------------------
+# BADGE ENGINE
+# ------------------------------
+
+class BadgeEngine:
+    """
+    Rule-driven badge awards.
+
+    DS concept:
+    - Catalog loaded once: badge name -> Badge.id (missing rows are created
+      in one insert at startup instead of lazily per award)
+    - Rules per metric: sorted list of (threshold, badge_id); an event
+      (user, metric, old_value, new_value) only awards the badges whose
+      threshold lies in (old_value, new_value] — two bisects, no query
+      unless something was actually crossed
+    - Awards are one SELECT for already-earned pairs + one bulk INSERT
+
+    Events are raised where the metric changes (XPLedger for level / streak,
+    quiz_submit, battle judging, pomodoro_save_session). Nothing commits
+    here — awards join the caller's transaction.
+    """
+
+    CATALOG = (
+        {'name': 'Consistency King', 'description': 'Achieve a 30-day streak', 'icon': 'fa-fire', 'criteria_type': 'streak', 'criteria_value': 30},
+        {'name': 'Rising Star', 'description': 'Reach Level 10', 'icon': 'fa-star', 'criteria_type': 'level', 'criteria_value': 10},
+        {'name': 'Dedicated Scholar', 'description': 'Reach Level 50', 'icon': 'fa-book-open', 'criteria_type': 'level', 'criteria_value': 50},
+        {'name': 'Centurion', 'description': 'Reach Level 100', 'icon': 'fa-crown', 'criteria_type': 'level', 'criteria_value': 100},
+        {'name': 'Quiz Master', 'description': 'Score 100% on a quiz', 'icon': 'fa-brain', 'criteria_type': 'quiz_perfect', 'criteria_value': 1},
+        {'name': 'First Victory', 'description': 'Win a code battle', 'icon': 'fa-trophy', 'criteria_type': 'wins', 'criteria_value': 1},
+        {'name': 'Arena Champion', 'description': 'Win 10 code battles', 'icon': 'fa-khanda', 'criteria_type': 'wins', 'criteria_value': 10},
+        {'name': 'Deep Focus', 'description': 'Log 10 hours of focus time', 'icon': 'fa-hourglass-half', 'criteria_type': 'focus_hours', 'criteria_value': 10},
+        {'name': 'Focus Legend', 'description': 'Log 100 hours of focus time', 'icon': 'fa-clock', 'criteria_type': 'focus_hours', 'criteria_value': 100},
+    )
+
+    BACKFILL_BATCH_SIZE = 500
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = {}       # badge name -> Badge.id
+        self._rules = {}     # metric -> ([thresholds], [badge_ids]) sorted by threshold
+        self._loaded = False
+
+    def load(self, create=True):
+        """
+        Build the rule table from the catalog rows. With create=True (startup
+        / CLI) missing rows are inserted first on a separate connection, so
+        the caller's session is never committed. Request-path loads pass
+        create=False and only read.
+        """
+        with self._lock:
+            created = 0
+            existing = {name: bid for bid, name in db.session.query(Badge.id, Badge.name).all()}
+            missing = [dict(b) for b in self.CATALOG if b['name'] not in existing]
+            if missing and create:
+                try:
+                    with db.engine.begin() as conn:
+                        conn.execute(Badge.__table__.insert(), missing)
+                    created = len(missing)
+                except sa_exc.IntegrityError:
+                    pass  # Another loader inserted them first
+                existing = self._read_catalog()
+                missing = [b for b in self.CATALOG if b['name'] not in existing]
+
+            rules = {}
+            for badge in self.CATALOG:
+                if badge['name'] in existing:
+                    rules.setdefault(badge['criteria_type'], []).append((badge['criteria_value'], existing[badge['name']]))
+            self._rules = {
+                metric: ([t for t, _ in sorted(entries)], [bid for _, bid in sorted(entries)])
+                for metric, entries in rules.items()
+            }
+            self._ids = existing
+            self._loaded = not missing  # Incomplete catalog: retry until startup creates it
+        print(f"[Badges] Catalog loaded: {len(self.CATALOG)} rules, {created} badges created, {len(missing)} missing")
+
+    @staticmethod
+    def _read_catalog():
+        """name -> id read on its own connection (sees rows committed by other loaders)."""
+        with db.engine.connect() as conn:
+            return {name: bid for bid, name in conn.execute(db.select(Badge.id, Badge.name)).all()}
+
+    def ensure_loaded(self):
+        if not self._loaded:
+            self.load(create=False)
+
+    def crossed(self, metric, old_value, new_value):
+        """Badge ids whose threshold lies in (old_value, new_value]."""
+        rule = self._rules.get(metric)
+        if not rule or new_value is None or new_value <= (old_value or 0):
+            return []
+        thresholds, badge_ids = rule
+        lo = bisect.bisect_right(thresholds, old_value or 0)
+        hi = bisect.bisect_right(thresholds, new_value)
+        return badge_ids[lo:hi]
+
+    def _award_pairs(self, pairs):
+        """Insert (user_id, badge_id) pairs that aren't earned yet. Returns the new pairs."""
+        if not pairs:
+            return []
+        user_ids = {uid for uid, _ in pairs}
+        badge_ids = {bid for _, bid in pairs}
+        earned = set(db.session.query(UserBadge.user_id, UserBadge.badge_id).filter(
+            UserBadge.user_id.in_(user_ids),
+            UserBadge.badge_id.in_(badge_ids)
+        ).all())
+        new_pairs = sorted(set(pairs) - earned)
+        if new_pairs:
+            now = datetime.utcnow()
+            db.session.execute(UserBadge.__table__.insert(), [
+                {'user_id': uid, 'badge_id': bid, 'earned_at': now} for uid, bid in new_pairs
+            ])
+        return new_pairs
+
+    def evaluate(self, events):
+        """events: iterable of (user_id, metric, old_value, new_value). Awards crossed badges (no commit)."""
+        self.ensure_loaded()
+        pairs = set()
+        for user_id, metric, old_value, new_value in events:
+            for badge_id in self.crossed(metric, old_value, new_value):
+                pairs.add((user_id, badge_id))
+        return self._award_pairs(pairs)
+
+    def award(self, user_id, badge_name):
+        """Award a catalog badge by name (no commit)."""
+        self.ensure_loaded()
+        badge_id = self._ids.get(badge_name)
+        if badge_id is None:
+            return []
+        return self._award_pairs({(user_id, badge_id)})
+
+    def evaluate_user(self, user):
+        return self.evaluate([
+            (user.id, 'streak', 0, user.longest_streak or user.current_streak or 0),
+            (user.id, 'level', 0, user.level or 1),
+        ])
+
+    def backfill(self, batch_size=None):
+        """Evaluate every user's current metrics in id-ordered batches. Returns badges awarded."""
+        self.ensure_loaded()
+        batch_size = batch_size or self.BACKFILL_BATCH_SIZE
+        awarded, last_id = 0, 0
+        while True:
+            users = db.session.query(User.id, User.level, User.longest_streak, User.current_streak)\
+                .filter(User.id > last_id).order_by(User.id).limit(batch_size).all()
+            if not users:
+                break
+            ids = [u.id for u in users]
+            last_id = ids[-1]
+
+            wins = dict(db.session.query(XPHistory.user_id, db.func.count(XPHistory.id)).filter(
+                XPHistory.user_id.in_(ids), XPHistory.source == 'battle_win'
+            ).group_by(XPHistory.user_id).all())
+            focus_minutes = dict(db.session.query(StudySession.user_id, db.func.sum(StudySession.duration)).filter(
+                StudySession.user_id.in_(ids), StudySession.mode == 'focus'
+            ).group_by(StudySession.user_id).all())
+
+            events = []
+            for u in users:
+                events.append((u.id, 'level', 0, u.level or 1))
+                events.append((u.id, 'streak', 0, max(u.longest_streak or 0, u.current_streak or 0)))
+                events.append((u.id, 'wins', 0, wins.get(u.id, 0)))
+                events.append((u.id, 'focus_hours', 0, (focus_minutes.get(u.id) or 0) // 60))
+            awarded += len(self.evaluate(events))
             db.session.commit()
-            
-        if not UserBadge.query.filter_by(user_id=user.id, badge_id=badge.id).first():
-            ub = UserBadge(user_id=user.id, badge_id=badge.id)
-            db.session.add(ub)
+        return awarded
+
+
+badge_engine = BadgeEngine()
+
 
+@app.cli.command('backfill-badges')
+@click.option('--batch-size', type=int, default=None, help='Users evaluated per batch.')
+def backfill_badges_command(batch_size):
+    """Award badges for metrics users already reached (streak, level, battle wins, focus hours)."""
+    awarded = badge_engine.backfill(batch_size)
+    print(f"[Badges] Backfill complete: {awarded} badges awarded")
 
 
 class Todo(db.Model):
@@ -1316,6 +2066,23 @@ class ChatMessage(db.Model):
     is_group = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+class ChatSummary(db.Model):
+    """
+    ChatSummary Model - Rolling summary of a user's personal AI chat
+
+    Purpose: Long chats send this summary plus the last few raw messages
+    instead of resending the whole history on every turn.
+
+    - One row per user; covers every ChatMessage with id <= last_message_id
+    - Folded forward incrementally in the background by ChatSummaryService
+    """
+    __tablename__ = 'chat_summary'
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    summary = db.Column(db.Text, nullable=False, default='')
+    last_message_id = db.Column(db.Integer, nullable=False, default=0)
+    message_count = db.Column(db.Integer, nullable=False, default=0)  # Messages folded in so far
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
 class StudySession(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -1331,6 +2098,668 @@ class TopicProficiency(db.Model):
     completed = db.Column(db.Boolean, default=False)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+def upsert_insert(table):
+    """
+    Dialect-specific INSERT supporting .on_conflict_do_update().
+    PostgreSQL and SQLite (3.24+) share the same ON CONFLICT syntax.
+    """
+    if db.engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    return dialect_insert(table)
+
+
+class UserDailyStats(db.Model):
+    """
+    UserDailyStats Model - Per-user, per-day activity rollup
+
+    Purpose: Charts and analytics read a handful of small rows instead of
+    re-aggregating StudySession / Todo / HabitLog / XPHistory on every view.
+
+    - One row per (user_id, stat_date); stat_date is the user's local (IST) date
+    - Maintained incrementally in the same transaction as the activity itself
+    - Rebuilt from history with: flask --app app backfill-daily-stats
+    """
+    __tablename__ = 'user_daily_stats'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    stat_date = db.Column(db.Date, nullable=False)
+    study_minutes = db.Column(db.Integer, default=0, nullable=False)    # All Pomodoro sessions (focus + breaks)
+    focus_minutes = db.Column(db.Integer, default=0, nullable=False)    # Focus sessions only
+    tasks_completed = db.Column(db.Integer, default=0, nullable=False)
+    goals_completed = db.Column(db.Integer, default=0, nullable=False)  # High-priority tasks completed
+    habits_done = db.Column(db.Integer, default=0, nullable=False)
+    xp_earned = db.Column(db.Integer, default=0, nullable=False)        # Gross XP gained (positive only)
+    xp_net = db.Column(db.Integer, default=0, nullable=False)           # Gains minus losses
+    xp_focus = db.Column(db.Integer, default=0, nullable=False)
+    xp_task = db.Column(db.Integer, default=0, nullable=False)
+    xp_habit = db.Column(db.Integer, default=0, nullable=False)
+    xp_quiz = db.Column(db.Integer, default=0, nullable=False)
+    xp_battle = db.Column(db.Integer, default=0, nullable=False)
+    xp_other = db.Column(db.Integer, default=0, nullable=False)
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'stat_date', name='uq_user_daily_stats'),
+    )
+
+
+class DailyStatsService:
+    """
+    Incremental maintenance of UserDailyStats.
+
+    bump() issues a single INSERT ... ON CONFLICT DO UPDATE (PostgreSQL and
+    SQLite both support it), so concurrent requests add to the same row
+    safely. It never commits — the caller's commit makes the rollup and the
+    activity atomic.
+    """
+
+    COUNTER_COLUMNS = (
+        'study_minutes', 'focus_minutes', 'tasks_completed', 'goals_completed', 'habits_done',
+        'xp_earned', 'xp_net', 'xp_focus', 'xp_task', 'xp_habit', 'xp_quiz', 'xp_battle', 'xp_other',
+    )
+
+    # XPHistory.source -> rollup column (sources not listed go to xp_other)
+    XP_SOURCE_COLUMNS = {
+        'focus': 'xp_focus',
+        'session_goal': 'xp_focus',
+        'task': 'xp_task',
+        'task_undo': 'xp_task',
+        'habit': 'xp_habit',
+        'quiz': 'xp_quiz',
+        'battle_win': 'xp_battle',
+        'battle_draw': 'xp_battle',
+        'battle': 'xp_battle',
+    }
+
+    @staticmethod
+    def local_date(dt=None):
+        """UTC datetime -> user's local calendar date (IST)."""
+        dt = dt or datetime.utcnow()
+        if dt.tzinfo is None:
+            dt = utc.localize(dt)
+        return dt.astimezone(IST).date()
+
+    @staticmethod
+    def xp_deltas(source, amount):
+        column = DailyStatsService.XP_SOURCE_COLUMNS.get(source, 'xp_other')
+        deltas = {'xp_net': amount, column: amount}
+        if amount > 0:
+            deltas['xp_earned'] = amount
+        return deltas
+
+    @staticmethod
+    def bump(user_id, when=None, **deltas):
+        """
+        Add deltas (e.g. focus_minutes=25, tasks_completed=1) to the user's row for the day of `when`.
+        `when` is a UTC datetime, or a date that is already local (e.g. HabitLog.completed_date).
+        """
+        deltas = {k: int(v) for k, v in deltas.items() if v}
+        if not user_id or not deltas:
+            return
+        unknown = set(deltas) - set(DailyStatsService.COUNTER_COLUMNS)
+        if unknown:
+            raise ValueError(f"Unknown daily stats columns: {sorted(unknown)}")
+
+        table = UserDailyStats.__table__
+        values = {c: 0 for c in DailyStatsService.COUNTER_COLUMNS}
+        values.update(deltas)
+        values['user_id'] = user_id
+        values['stat_date'] = when if when is not None and not isinstance(when, datetime) else DailyStatsService.local_date(when)
+
+        stmt = upsert_insert(UserDailyStats.__table__).values(**values)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['user_id', 'stat_date'],
+            set_={c: table.c[c] + stmt.excluded[c] for c in deltas}
+        )
+        db.session.execute(stmt)
+
+    @staticmethod
+    def bump_xp(user_id, source, amount, when=None):
+        DailyStatsService.bump(user_id, when, **DailyStatsService.xp_deltas(source, amount))
+
+    @staticmethod
+    def get_range(user_id, start_date, end_date):
+        """{date: UserDailyStats} for start_date..end_date inclusive (missing days are absent)."""
+        rows = UserDailyStats.query.filter(
+            UserDailyStats.user_id == user_id,
+            UserDailyStats.stat_date >= start_date,
+            UserDailyStats.stat_date <= end_date
+        ).all()
+        return {r.stat_date: r for r in rows}
+
+    @staticmethod
+    def backfill(user_id=None):
+        """
+        Rebuild rollup rows from raw history (StudySession, Todo, HabitLog, XPHistory).
+        Existing rows for the affected users are replaced. Returns number of rows written.
+        """
+        totals = {}  # (user_id, date) -> {column: value}
+
+        def add(uid, when, **deltas):
+            if not uid or when is None:
+                return
+            row = totals.setdefault((uid, DailyStatsService.local_date(when)), {})
+            for k, v in deltas.items():
+                row[k] = row.get(k, 0) + int(v or 0)
+
+        def scoped(query, column):
+            return query.filter(column == user_id) if user_id else query
+
+        for uid, when, duration, mode in scoped(
+            db.session.query(StudySession.user_id, StudySession.completed_at, StudySession.duration, StudySession.mode),
+            StudySession.user_id
+        ).yield_per(1000):
+            add(uid, when, study_minutes=duration, focus_minutes=duration if mode == 'focus' else 0)
+
+        for uid, when, priority in scoped(
+            db.session.query(Todo.user_id, Todo.completed_at, Todo.priority).filter(Todo.completed == True),
+            Todo.user_id
+        ).yield_per(1000):
+            add(uid, when, tasks_completed=1, goals_completed=1 if priority == 'high' else 0)
+
+        for uid, day in scoped(
+            db.session.query(Habit.user_id, HabitLog.completed_date).join(Habit, Habit.id == HabitLog.habit_id),
+            Habit.user_id
+        ).yield_per(1000):
+            # HabitLog only stores a date; treat it as that local day
+            row = totals.setdefault((uid, day), {})
+            row['habits_done'] = row.get('habits_done', 0) + 1
+
+        for uid, when, source, amount in scoped(
+            db.session.query(XPHistory.user_id, XPHistory.timestamp, XPHistory.source, XPHistory.amount),
+            XPHistory.user_id
+        ).yield_per(1000):
+            add(uid, when, **DailyStatsService.xp_deltas(source, amount or 0))
+
+        delete_q = UserDailyStats.query
+        if user_id:
+            delete_q = delete_q.filter(UserDailyStats.user_id == user_id)
+        delete_q.delete(synchronize_session=False)
+
+        rows = []
+        for (uid, day), counters in totals.items():
+            values = {c: 0 for c in DailyStatsService.COUNTER_COLUMNS}
+            values.update(counters)
+            rows.append(dict(values, user_id=uid, stat_date=day))
+        if rows:
+            db.session.execute(UserDailyStats.__table__.insert(), rows)
+        db.session.commit()
+        return len(rows)
+
+
+@app.cli.command('backfill-daily-stats')
+@click.option('--user-id', type=int, default=None, help='Only rebuild this user')
+def backfill_daily_stats_command(user_id):
+    """Rebuild the user_daily_stats rollup from raw history."""
+    written = DailyStatsService.backfill(user_id)
+    print(f"[DailyStats] Backfill complete: {written} rows written")
+
+
+class XPBucket(db.Model):
+    """
+    XPBucket Model - XP earned per user per ISO week / calendar month
+
+    Purpose: Weekly and monthly leaderboards read one row per user instead of
+    summing XPHistory. Fed by GamificationService.add_xp.
+
+    - period_type: 'week' (period_key '2026-W07') or 'month' (period_key '2026-02')
+    - Periods follow the user's local (IST) date, like UserDailyStats
+    """
+    __tablename__ = 'xp_bucket'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    period_type = db.Column(db.String(10), nullable=False)
+    period_key = db.Column(db.String(10), nullable=False)
+    xp = db.Column(db.Integer, default=0, nullable=False)
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'period_type', 'period_key', name='uq_xp_bucket'),
+        db.Index('ix_xp_bucket_board', 'period_type', 'period_key', 'xp'),
+    )
+
+
+class XPBucketService:
+    """Maintains XPBucket rows and serves the weekly / monthly / friends leaderboards."""
+
+    PERIODS = ('week', 'month')
+    TOP_CACHE_SIZE = 100
+    TOP_CACHE_TTL = 60  # seconds
+
+    _top_cache = {}  # (period_type, period_key) -> (expires_at, [entry, ...])
+    _top_cache_lock = threading.Lock()
+
+    @staticmethod
+    def period_key(period_type, day=None):
+        day = day or DailyStatsService.local_date()
+        if period_type == 'week':
+            iso_year, iso_week, _ = day.isocalendar()
+            return f"{iso_year}-W{iso_week:02d}"
+        return day.strftime('%Y-%m')
+
+    @staticmethod
+    def record(user_id, amount, when=None):
+        """Add XP to the user's current week and month buckets (no commit)."""
+        if not user_id or not amount:
+            return
+        day = DailyStatsService.local_date(when)
+        table = XPBucket.__table__
+        for period_type in XPBucketService.PERIODS:
+            stmt = upsert_insert(table).values(
+                user_id=user_id,
+                period_type=period_type,
+                period_key=XPBucketService.period_key(period_type, day),
+                xp=int(amount)
+            )
+            stmt = stmt.on_conflict_do_update(
+                index_elements=['user_id', 'period_type', 'period_key'],
+                set_={'xp': table.c.xp + stmt.excluded.xp}
+            )
+            db.session.execute(stmt)
+
+    @staticmethod
+    def _board_query(period_type, period_key, user_ids=None):
+        query = db.session.query(XPBucket.xp, User).join(User, User.id == XPBucket.user_id).filter(
+            XPBucket.period_type == period_type,
+            XPBucket.period_key == period_key,
+            XPBucket.xp > 0,
+            User.is_admin == False,
+            User.is_banned == False
+        )
+        if user_ids is not None:
+            query = query.filter(XPBucket.user_id.in_(user_ids))
+        else:
+            query = query.filter(User.is_public_profile == True)
+        return query.order_by(XPBucket.xp.desc(), XPBucket.user_id.asc())
+
+    @staticmethod
+    def _entry(user, xp):
+        return {
+            'user_id': user.id,
+            'name': f"{user.first_name} {user.last_name or ''}".strip(),
+            'avatar': user.get_avatar(64),
+            'level': user.level,
+            'xp': int(xp),
+        }
+
+    @staticmethod
+    def _cached_top(period_type, period_key):
+        """Top 100 for a global board, cached for TOP_CACHE_TTL seconds."""
+        cache_key = (period_type, period_key)
+        with XPBucketService._top_cache_lock:
+            cached = XPBucketService._top_cache.get(cache_key)
+            if cached and cached[0] > time.time():
+                return cached[1]
+        rows = XPBucketService._board_query(period_type, period_key).limit(XPBucketService.TOP_CACHE_SIZE).all()
+        entries = [XPBucketService._entry(user, xp) for xp, user in rows]
+        with XPBucketService._top_cache_lock:
+            XPBucketService._top_cache[cache_key] = (time.time() + XPBucketService.TOP_CACHE_TTL, entries)
+        return entries
+
+    @staticmethod
+    def encode_cursor(xp, user_id):
+        return f"{xp}.{user_id}"
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            xp, user_id = cursor.split('.', 1)
+            return int(xp), int(user_id)
+        except (AttributeError, ValueError):
+            return None
+
+    @staticmethod
+    def _after(entries, after):
+        if not after:
+            return entries
+        xp, uid = after
+        return [e for e in entries if e['xp'] < xp or (e['xp'] == xp and e['user_id'] > uid)]
+
+    @staticmethod
+    def get_board(period_type, limit=20, cursor=None, user_ids=None, period_key=None):
+        """
+        One page of a leaderboard ordered by (xp desc, user_id asc).
+        Keyset pagination: the cursor is the (xp, user_id) of the last row returned.
+        Pages inside the global top 100 are served from the cache.
+        """
+        period_key = period_key or XPBucketService.period_key(period_type)
+        limit = max(1, min(int(limit or 20), 100))
+        after = XPBucketService.decode_cursor(cursor) if cursor else None
+
+        entries = None
+        if user_ids is None:
+            top = XPBucketService._cached_top(period_type, period_key)
+            remaining = XPBucketService._after(top, after)
+            # Serve from cache only when it also holds the look-ahead row (limit + 1) that
+            # decides has_more, or when the whole board is shorter than the cache
+            if len(remaining) > limit or len(top) < XPBucketService.TOP_CACHE_SIZE:
+                entries = remaining[:limit + 1]
+
+        if entries is None:
+            query = XPBucketService._board_query(period_type, period_key, user_ids)
+            if after:
+                query = query.filter(db.or_(
+                    XPBucket.xp < after[0],
+                    db.and_(XPBucket.xp == after[0], XPBucket.user_id > after[1])
+                ))
+            entries = [XPBucketService._entry(user, xp) for xp, user in query.limit(limit + 1).all()]
+
+        has_more = len(entries) > limit
+        entries = entries[:limit]
+        next_cursor = None
+        if has_more and entries:
+            next_cursor = XPBucketService.encode_cursor(entries[-1]['xp'], entries[-1]['user_id'])
+        return {
+            'period': period_type,
+            'period_key': period_key,
+            'entries': entries,
+            'next_cursor': next_cursor,
+        }
+
+    @staticmethod
+    def backfill():
+        """Rebuild all buckets from XPHistory. Returns number of rows written."""
+        totals = {}
+        for uid, when, amount in db.session.query(
+            XPHistory.user_id, XPHistory.timestamp, XPHistory.amount
+        ).yield_per(1000):
+            if when is None:
+                continue
+            day = DailyStatsService.local_date(when)
+            for period_type in XPBucketService.PERIODS:
+                key = (uid, period_type, XPBucketService.period_key(period_type, day))
+                totals[key] = totals.get(key, 0) + int(amount or 0)
+
+        XPBucket.query.delete(synchronize_session=False)
+        rows = [
+            {'user_id': uid, 'period_type': ptype, 'period_key': pkey, 'xp': xp}
+            for (uid, ptype, pkey), xp in totals.items()
+        ]
+        if rows:
+            db.session.execute(XPBucket.__table__.insert(), rows)
+        db.session.commit()
+        with XPBucketService._top_cache_lock:
+            XPBucketService._top_cache.clear()
+        return len(rows)
+
+
+@app.cli.command('backfill-xp-buckets')
+def backfill_xp_buckets_command():
+    """Rebuild weekly / monthly XP buckets from XPHistory."""
+    written = XPBucketService.backfill()
+    print(f"[XPBuckets] Backfill complete: {written} rows written")
+
+
+# ------------------------------
+# XP LEDGER
+# ------------------------------
+
+class DailyFocusCounter:
+    """
+    Running focus XP per user for the current local day, so the daily focus
+    cap doesn't need a SUM over XPHistory on every award.
+
+    DS concept:
+    - Hash map user_id -> (day, base focus XP granted today)
+    - reserve() checks and claims the remaining cap under one lock, so two
+      concurrent focus awards can't both pass the check
+    - Seeded lazily from UserDailyStats.xp_focus (post-multiplier, so the
+      seed errs on the side of the cap after a restart)
+    """
+
+    def __init__(self, cap):
+        self.cap = cap
+        self._lock = threading.Lock()
+        self._totals = {}
+
+    def reserve(self, user_id, amount):
+        """Claim up to `amount` of today's remaining cap. Returns the granted amount."""
+        day = DailyStatsService.local_date()
+        with self._lock:
+            entry = self._totals.get(user_id)
+            seeded = entry[1] if entry and entry[0] == day else None
+        if seeded is None:
+            seeded = db.session.query(UserDailyStats.xp_focus).filter_by(
+                user_id=user_id, stat_date=day
+            ).scalar() or 0
+
+        with self._lock:
+            entry = self._totals.get(user_id)
+            used = entry[1] if entry and entry[0] == day else seeded
+            granted = max(0, min(amount, self.cap - used))
+            self._totals[user_id] = (day, used + granted)
+            return granted
+
+    def refund(self, user_id, amount):
+        """Give back a reservation whose transaction didn't go through."""
+        if amount <= 0:
+            return
+        day = DailyStatsService.local_date()
+        with self._lock:
+            entry = self._totals.get(user_id)
+            if entry and entry[0] == day:
+                self._totals[user_id] = (day, max(0, entry[1] - amount))
+
+
+class XPLedger:
+    """
+    Atomic XP writes behind GamificationService.add_xp.
+
+    Every award is one UPDATE "user" SET total_xp = total_xp + :n ... RETURNING
+    statement. Level, streak and the zero floor are computed inside the same
+    statement, so concurrent awards (socket events + HTTP) can't lose XP and
+    no read-modify-write round trip is needed. The XPHistory row and the
+    daily / period rollups ride in the same transaction.
+
+    Round trips per award: UPDATE ... RETURNING and commit (power-ups are cached).
+    """
+
+    DEMO_EMAILS = ('daksh@gmail.com', 'daksh@studyverse.com', 'demo@studyverse.com')
+    FOCUS_DAILY_CAP = 500
+    XP_PER_LEVEL = 500
+
+    focus_counter = DailyFocusCounter(FOCUS_DAILY_CAP)
+
+    @staticmethod
+    def active_effects(user_ids):
+        """user_id -> active power-up effects (PowerUpCache: a dict hit when warm)."""
+        if not user_ids:
+            return {}
+        return powerup_cache.get_many(user_ids)
+
+    @staticmethod
+    def _multiplier(effects, source):
+        multiplier = effects['xp']
+        if source == 'focus' and effects['time'] > 1.0:
+            # Double Time stacks on top of an XP boost for focus rewards
+            multiplier *= effects['time']
+        return multiplier
+
+    @staticmethod
+    def _not_demo():
+        return db.or_(User.email.is_(None), db.func.lower(User.email).notin_(XPLedger.DEMO_EMAILS))
+
+    @staticmethod
+    def _credit_stmt(user_ids, amount):
+        """total_xp += amount, level-up and streak update in one statement."""
+        today = datetime.utcnow().date()
+        total = db.func.coalesce(User.total_xp, 0) + amount
+        level = db.func.coalesce(User.level, 1)
+        computed_level = total // XPLedger.XP_PER_LEVEL + 1
+        streak = db.case(
+            (User.last_activity_date == today, db.func.coalesce(User.current_streak, 0)),
+            (User.last_activity_date == today - timedelta(days=1), db.func.coalesce(User.current_streak, 0) + 1),
+            else_=1
+        )
+        longest = db.func.coalesce(User.longest_streak, 0)
+        return db.update(User).where(
+            User.id.in_(list(user_ids)), XPLedger._not_demo()
+        ).values(
+            total_xp=total,
+            level=db.case((computed_level > level, computed_level), else_=level),
+            current_streak=streak,
+            longest_streak=db.case((streak > longest, streak), else_=longest),
+            last_activity_date=today
+        ).returning(
+            User.id, User.total_xp, User.level, User.current_streak
+        ).execution_options(synchronize_session=False)
+
+    @staticmethod
+    def _debit_stmt(user_id, amount):
+        """total_xp -= amount with a floor at 0."""
+        total = db.func.coalesce(User.total_xp, 0) + amount
+        return db.update(User).where(
+            User.id == user_id, XPLedger._not_demo()
+        ).values(
+            total_xp=db.case((total < 0, 0), else_=total)
+        ).returning(
+            User.id, User.total_xp, User.level
+        ).execution_options(synchronize_session=False)
+
+    @staticmethod
+    def _record(user_id, source, amount):
+        db.session.add(XPHistory(user_id=user_id, source=source, amount=amount))
+        DailyStatsService.bump_xp(user_id, source, amount)
+        XPBucketService.record(user_id, amount)
+
+    @staticmethod
+    def _not_applied(user_id):
+        """No row came back from the UPDATE: unknown user or a demo account."""
+        email = db.session.query(User.email).filter_by(id=user_id).scalar()
+        if email and email.lower() in XPLedger.DEMO_EMAILS:
+            print(f"XP change blocked for demo user: {email}")
+            return {'earned': 0, 'message': 'Demo account - XP locked'}
+        return None
+
+    @staticmethod
+    def _credit_result(row, amount, base_amount, multiplier, boost):
+        calculate_level = GamificationService.calculate_level
+        leveled_up = (
+            row.level == calculate_level(row.total_xp)
+            and calculate_level(row.total_xp - amount) < row.level
+        )
+        result = {
+            'earned': amount,
+            'new_total': row.total_xp,
+            'leveled_up': leveled_up,
+            'new_level': row.level,
+            'rank': GamificationService.get_rank(row.level)
+        }
+        if multiplier > 1.0:
+            result['multiplier'] = multiplier
+            result['base_amount'] = base_amount
+            result['boost_active'] = boost
+        return result
+
+    @staticmethod
+    def _badge_events(row, amount):
+        """Level / streak transitions caused by a credit, for BadgeEngine."""
+        old_level = min(row.level, GamificationService.calculate_level(row.total_xp - amount))
+        return [
+            (row.id, 'level', old_level, row.level),
+            (row.id, 'streak', row.current_streak - 1, row.current_streak),
+        ]
+
+    @staticmethod
+    def apply(user_id, source, amount, force_deduct=False):
+        effects = XPLedger.active_effects([user_id])[user_id]
+
+        # XP loss: protection power-up blocks it unless the deduction is forced
+        if amount < 0:
+            if not force_deduct and effects['protection']:
+                return {'earned': 0, 'message': 'XP Protection Active! No XP lost.'}
+            row = db.session.execute(XPLedger._debit_stmt(user_id, amount)).first()
+            if row is None:
+                return XPLedger._not_applied(user_id)
+            XPLedger._record(user_id, source, amount)
+            db.session.commit()
+            rank_index.update_score(row.id, row.level, row.total_xp)
+            return {'earned': amount, 'new_total': row.total_xp}
+
+        # Daily focus cap is applied to the base amount, before multipliers
+        reserved = 0
+        if source == 'focus':
+            reserved = amount = XPLedger.focus_counter.reserve(user_id, amount)
+            if amount <= 0:
+                return {'earned': 0, 'message': 'Daily Focus XP cap reached!'}
+        if amount <= 0:
+            return
+
+        multiplier = XPLedger._multiplier(effects, source)
+        base_amount = amount
+        if multiplier > 1.0:
+            amount = int(amount * multiplier)
+
+        try:
+            row = db.session.execute(XPLedger._credit_stmt([user_id], amount)).first()
+            if row is None:
+                XPLedger.focus_counter.refund(user_id, reserved)
+                return XPLedger._not_applied(user_id)
+            XPLedger._record(user_id, source, amount)
+            badge_engine.evaluate(XPLedger._badge_events(row, amount))
+            db.session.commit()
+        except Exception:
+            XPLedger.focus_counter.refund(user_id, reserved)
+            raise
+
+        rank_index.update_score(row.id, row.level, row.total_xp)
+        return XPLedger._credit_result(row, amount, base_amount, multiplier, effects['boost'])
+
+    @staticmethod
+    def apply_many(awards, source):
+        """
+        Credit several users in one transaction: {user_id: base_amount} -> {user_id: result}.
+
+        One power-up query for everyone, one UPDATE ... RETURNING per distinct
+        final amount, one commit. Users without a returned row (unknown / demo)
+        are left out of the result.
+        """
+        awards = {uid: int(amount) for uid, amount in awards.items() if amount and amount > 0}
+        if not awards:
+            return {}
+        effects = XPLedger.active_effects(list(awards))
+
+        plans = {}  # final amount -> [(user_id, base_amount, reserved)]
+        for uid, amount in awards.items():
+            reserved = 0
+            if source == 'focus':
+                reserved = amount = XPLedger.focus_counter.reserve(uid, amount)
+                if amount <= 0:
+                    continue
+            multiplier = XPLedger._multiplier(effects[uid], source)
+            final = int(amount * multiplier) if multiplier > 1.0 else amount
+            plans.setdefault(final, []).append((uid, amount, reserved))
+
+        rows, results = [], {}
+        try:
+            for final, entries in plans.items():
+                base = {uid: (amount, reserved) for uid, amount, reserved in entries}
+                for row in db.session.execute(XPLedger._credit_stmt(list(base), final)).all():
+                    XPLedger._record(row.id, source, final)
+                    multiplier = XPLedger._multiplier(effects[row.id], source)
+                    results[row.id] = XPLedger._credit_result(
+                        row, final, base[row.id][0], multiplier, effects[row.id]['boost']
+                    )
+                    rows.append(row)
+            badge_engine.evaluate([
+                event for row in rows for event in XPLedger._badge_events(row, results[row.id]['earned'])
+            ])
+            db.session.commit()
+        except Exception:
+            for entries in plans.values():
+                for uid, _, reserved in entries:
+                    XPLedger.focus_counter.refund(uid, reserved)
+            raise
+
+        for entries in plans.values():
+            for uid, _, reserved in entries:
+                if uid not in results:
+                    XPLedger.focus_counter.refund(uid, reserved)
+        for row in rows:
+            rank_index.update_score(row.id, row.level, row.total_xp)
+        return results
+
+
 class Group(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
@@ -1373,6 +2802,46 @@ class SyllabusDocument(db.Model):
     
     user = db.relationship('User', backref='syllabus_documents')
 
+class SyllabusChunk(db.Model):
+    """
+    SyllabusChunk Model - Paragraph-sized piece of a syllabus for retrieval
+
+    Purpose: Chat, quiz and focus plans send the few chunks relevant to the
+    question instead of the first 3000 characters of the whole document.
+
+    - Built once per document at upload (SyllabusIndex.build)
+    - terms: compact JSON {term: count} used for BM25 scoring
+    - Rebuilt for older documents with: flask --app app backfill-syllabus-index
+    """
+    __tablename__ = 'syllabus_chunk'
+    id = db.Column(db.Integer, primary_key=True)
+    document_id = db.Column(db.Integer, db.ForeignKey('syllabus_document.id'), nullable=False, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    ordinal = db.Column(db.Integer, nullable=False)       # Position in the document
+    content = db.Column(db.Text, nullable=False)
+    terms = db.Column(db.Text, nullable=False)            # JSON {term: term frequency}
+    term_count = db.Column(db.Integer, nullable=False)    # Chunk length in terms (BM25 length norm)
+
+class SyllabusExtraction(db.Model):
+    """
+    SyllabusExtraction Model - Content-addressed cache of PDF extraction results
+
+    Purpose: The same course PDF uploaded again (by anyone) reuses the
+    PyPDF2 text and the Gemini chapter/subtask JSON instead of re-running them.
+
+    - Keyed by SHA-256 of the PDF bytes
+    - tasks_json is NULL when AI extraction failed (retried on the next upload)
+    - LRU eviction by last_used_at (SyllabusExtractionCache)
+    """
+    __tablename__ = 'syllabus_extraction'
+    content_hash = db.Column(db.String(64), primary_key=True)
+    extracted_text = db.Column(db.Text, nullable=False, default='')
+    tasks_json = db.Column(db.Text, nullable=True)
+    file_size = db.Column(db.Integer, nullable=True)
+    hit_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_used_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
 class Event(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -1450,40 +2919,138 @@ class Stack:
 
 
 class LRUCache:
-    """LRU Cache using dict + list (simplified).
+    """O(1) LRU cache with optional TTL and byte budget.
 
     DS concept:
-    - Hash map (dict) for O(1) key lookup
-    - List to track usage order for eviction
+    - OrderedDict = hash map + doubly linked list, so lookup, move_to_end
+      and popitem(last=False) are all O(1)
+    - Least recently used entry sits at the front and is evicted first when
+      either `capacity` entries or `max_bytes` of values are exceeded
+    - Entries older than `ttl_seconds` count as misses and are dropped
     """
 
-    def __init__(self, capacity=50):
+    def __init__(self, capacity=50, ttl_seconds=None, max_bytes=None):
         self.capacity = capacity
-        self.cache = {}
-        self.order = []  # most recent at end
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._data = OrderedDict()  # key -> (expires_at, size, value); most recent at end
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def _sizeof(value):
+        if isinstance(value, str):
+            return len(value.encode('utf-8'))
+        return sys.getsizeof(value)
+
+    def _drop_locked(self, key):
+        _, size, _ = self._data.pop(key)
+        self.bytes -= size
 
     def get(self, key):
-        if key not in self.cache:
-            return None
-        if key in self.order:
-            self.order.remove(key)
-        self.order.append(key)
-        return self.cache[key]
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] is not None and entry[0] < time.time():
+                self._drop_locked(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[2]
 
     def put(self, key, value):
-        if key in self.cache:
-            self.cache[key] = value
-            if key in self.order:
-                self.order.remove(key)
-            self.order.append(key)
-            return
+        size = self._sizeof(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return  # Larger than the whole budget — not worth caching
+        expires_at = time.time() + self.ttl_seconds if self.ttl_seconds else None
+        with self._lock:
+            if key in self._data:
+                self._drop_locked(key)
+            self._data[key] = (expires_at, size, value)
+            self.bytes += size
+            while len(self._data) > self.capacity or (self.max_bytes is not None and self.bytes > self.max_bytes):
+                oldest = next(iter(self._data))
+                self._drop_locked(oldest)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._data),
+                'capacity': self.capacity,
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'ttl_seconds': self.ttl_seconds,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+
+class RedisCacheBackend:
+    """Optional shared second-level cache (Redis) so gunicorn workers share hits.
+
+    Enabled when CHAT_CACHE_REDIS_URL is set and the redis package is
+    installed. Every call fails soft: a Redis outage is just a cache miss.
+    """
+
+    def __init__(self, url, ttl_seconds, prefix='studyverse:chat:'):
+        self.ttl_seconds = ttl_seconds
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(url, socket_timeout=0.5, socket_connect_timeout=0.5)
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    @staticmethod
+    def from_env(ttl_seconds):
+        url = os.getenv('CHAT_CACHE_REDIS_URL')
+        if not url:
+            return None
+        if not REDIS_AVAILABLE:
+            print("[ChatCache] CHAT_CACHE_REDIS_URL set but redis is not installed; using per-process cache")
+            return None
+        return RedisCacheBackend(url, ttl_seconds)
 
-        if len(self.cache) >= self.capacity:
-            oldest = self.order.pop(0)
-            del self.cache[oldest]
+    def get(self, key):
+        try:
+            value = self._client.get(self.prefix + key)
+        except Exception:
+            self.errors += 1
+            return None
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value.decode('utf-8')
 
-        self.cache[key] = value
-        self.order.append(key)
+    def put(self, key, value):
+        try:
+            self._client.setex(self.prefix + key, self.ttl_seconds, value)
+        except Exception:
+            self.errors += 1
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'errors': self.errors}
 
 
 # ------------------------------
@@ -1531,6 +3098,8 @@ class AuthService:
         )
         db.session.add(user)
         db.session.commit()
+        rank_index.update(user)
+        user_search_index.update(user)
 
         # Award XP to BOTH referrer and new user
         if referrer:
@@ -1624,8 +3193,202 @@ class GroupService:
         return Group.query.get(membership.group_id)
 
 
+class SyllabusIndex:
+    """
+    BM25 retrieval over paragraph chunks of one syllabus document.
+
+    DS concept:
+    - Chunking: paragraphs merged / split to ~CHUNK_TOKENS each
+    - Sparse term vectors: each chunk stores {term: tf} (SyllabusChunk.terms)
+    - Inverted index: term -> [(chunk position, tf)], built when a document
+      is first queried and kept in a small LRU (OrderedDict) of documents
+    - Top-k by BM25 with a heap; results go back in document order
+    """
+
+    CHUNK_TOKENS = 150
+    K1 = 1.5
+    B = 0.75
+    CACHE_DOCS = 64
+    STOPWORDS = frozenset(
+        "a an and are as at be by for from has have how i in is it its of on or that the this to was "
+        "were what when where which who why will with you your can do does about into than then there "
+        "these those we our they their me my explain tell give please".split()
+    )
+    TERM_RE = re.compile(r"\w+", re.UNICODE)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._docs = OrderedDict()  # document_id -> loaded index
+        self._building = set()      # document ids with a background build in flight
+
+    @staticmethod
+    def tokenize(text: str) -> list:
+        terms = []
+        for word in SyllabusIndex.TERM_RE.findall((text or '').lower()):
+            if (len(word) < 2 and not word.isdigit()) or word in SyllabusIndex.STOPWORDS:
+                continue
+            if len(word) > 4 and word.endswith('s') and not word.endswith('ss'):
+                word = word[:-1]  # Light plural folding: "chapters" ~ "chapter"
+            terms.append(word)
+        return terms
+
+    @staticmethod
+    def chunk(text: str) -> list:
+        """Split text into ~CHUNK_TOKENS pieces on paragraph, then line, boundaries."""
+        target = SyllabusIndex.CHUNK_TOKENS
+        pieces = []
+        for para in re.split(r"\n\s*\n", text or ''):
+            para = para.strip()
+            if not para:
+                continue
+            if PromptBuilder.estimate_tokens(para) <= target:
+                pieces.append(para)
+                continue
+            # PDF text often has no blank lines: fall back to lines, then hard cuts
+            for line in para.split('\n'):
+                line = line.strip()
+                while PromptBuilder.estimate_tokens(line) > target:
+                    cut = PromptBuilder._fit_chars(line, target)
+                    space = line.rfind(' ', 0, cut)
+                    cut = space if space > cut // 2 else cut
+                    pieces.append(line[:cut].strip())
+                    line = line[cut:].strip()
+                if line:
+                    pieces.append(line)
+
+        chunks, current, used = [], [], 0
+        for piece in pieces:
+            cost = PromptBuilder.estimate_tokens(piece)
+            if current and used + cost > target:
+                chunks.append('\n'.join(current))
+                current, used = [], 0
+            current.append(piece)
+            used += cost
+        if current:
+            chunks.append('\n'.join(current))
+        return chunks
+
+    def build(self, doc: SyllabusDocument):
+        """(Re)build the chunks of one document (no commit)."""
+        SyllabusChunk.query.filter_by(document_id=doc.id).delete()
+        rows = []
+        for ordinal, content in enumerate(self.chunk(doc.extracted_text)):
+            tf = Counter(self.tokenize(content))
+            if not tf:
+                continue
+            rows.append({
+                'document_id': doc.id, 'user_id': doc.user_id, 'ordinal': ordinal, 'content': content,
+                'terms': json.dumps(tf, separators=(',', ':')), 'term_count': sum(tf.values())
+            })
+        if rows:
+            db.session.execute(SyllabusChunk.__table__.insert(), rows)
+        self.invalidate(doc.id)
+        return len(rows)
+
+    def invalidate(self, document_id):
+        with self._lock:
+            self._docs.pop(document_id, None)
+
+    def _load(self, doc: SyllabusDocument):
+        with self._lock:
+            loaded = self._docs.get(doc.id)
+            if loaded is not None:
+                self._docs.move_to_end(doc.id)
+                return loaded
+
+        rows = (
+            db.session.query(SyllabusChunk.ordinal, SyllabusChunk.content, SyllabusChunk.terms, SyllabusChunk.term_count)
+            .filter_by(document_id=doc.id)
+            .order_by(SyllabusChunk.ordinal)
+            .all()
+        )
+        if not rows:
+            if doc.extracted_text:
+                # Uploaded before the index existed: build it off the request path
+                self._queue_build(doc.id)
+            return {'chunks': [], 'lengths': [], 'avg_length': 0, 'postings': {}}  # Not cached
+
+        postings = {}
+        for pos, (_, _, terms, _) in enumerate(rows):
+            for term, tf in json.loads(terms).items():
+                postings.setdefault(term, []).append((pos, tf))
+        lengths = [row.term_count for row in rows]
+        loaded = {
+            'chunks': [(row.ordinal, row.content) for row in rows],
+            'lengths': lengths,
+            'avg_length': (sum(lengths) / len(lengths)) if lengths else 0,
+            'postings': postings,
+        }
+        with self._lock:
+            self._docs[doc.id] = loaded
+            self._docs.move_to_end(doc.id)
+            while len(self._docs) > self.CACHE_DOCS:
+                self._docs.popitem(last=False)
+        return loaded
+
+    def _queue_build(self, document_id):
+        """Build one unindexed document in a background thread (its own session), once at a time."""
+        with self._lock:
+            if document_id in self._building:
+                return
+            self._building.add(document_id)
+        threading.Thread(target=self._build_in_background, args=(document_id,),
+                         daemon=True, name=f"syllabus-index-{document_id}").start()
+
+    def _build_in_background(self, document_id):
+        try:
+            with app.app_context():
+                try:
+                    doc = db.session.get(SyllabusDocument, document_id)
+                    has_chunks = db.session.query(SyllabusChunk.id).filter_by(document_id=document_id).first()
+                    if doc and not has_chunks:
+                        count = self.build(doc)
+                        db.session.commit()
+                        print(f"[SyllabusIndex] Built {count} chunks for document {document_id}")
+                except Exception as e:
+                    db.session.rollback()
+                    print(f"[SyllabusIndex] Background build failed for document {document_id}: {e}")
+                finally:
+                    db.session.remove()
+        finally:
+            with self._lock:
+                self._building.discard(document_id)
+
+    def search(self, doc: SyllabusDocument, query: str, k: int = 5) -> list:
+        """Top-k chunks for query as [(ordinal, content)] in document order. Empty if nothing matches."""
+        index = self._load(doc)
+        n = len(index['chunks'])
+        if not n:
+            return []
+        scores = {}
+        for term in set(self.tokenize(query)):
+            postings = index['postings'].get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for pos, tf in postings:
+                norm = 1 - self.B + self.B * index['lengths'][pos] / (index['avg_length'] or 1)
+                scores[pos] = scores.get(pos, 0.0) + idf * tf * (self.K1 + 1) / (tf + self.K1 * norm)
+        best = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+        return sorted(index['chunks'][pos] for pos, _ in best)
+
+
+syllabus_index = SyllabusIndex()
+
+
+@app.cli.command('backfill-syllabus-index')
+def backfill_syllabus_index_command():
+    """Build retrieval chunks for every syllabus document."""
+    total = 0
+    doc_ids = [doc_id for (doc_id,) in db.session.query(SyllabusDocument.id).order_by(SyllabusDocument.id)]
+    for doc_id in doc_ids:
+        total += syllabus_index.build(db.session.get(SyllabusDocument, doc_id))
+        db.session.commit()
+    print(f"[SyllabusIndex] Backfill complete: {total} chunks")
+
+
 class SyllabusService:
-    """PDF syllabus upload + extraction and retrieval (simple)."""
+    """PDF syllabus upload + extraction and retrieval (BM25 over chunks, see SyllabusIndex)."""
 
     @staticmethod
     def save_syllabus(user_id: int, filename: str, extracted_text: str) -> SyllabusDocument:
@@ -1636,14 +3399,113 @@ class SyllabusService:
 
         doc = SyllabusDocument(user_id=user_id, filename=filename, extracted_text=extracted_text)
         db.session.add(doc)
+        db.session.flush()
+        syllabus_index.build(doc)
         db.session.commit()
         return doc
 
+    @staticmethod
+    def get_active_document(user_id: int, syllabus_id: int = None):
+        """The requested document if it is the user's, else the newest (restore bumps created_at)."""
+        if syllabus_id:
+            doc = SyllabusDocument.query.filter_by(id=syllabus_id, user_id=user_id).first()
+            if doc:
+                return doc
+        return SyllabusDocument.query.filter_by(user_id=user_id).order_by(SyllabusDocument.created_at.desc()).first()
+
     @staticmethod
     def get_syllabus_text(user_id: int) -> str:
-        doc = SyllabusDocument.query.filter_by(user_id=user_id).first()
+        doc = SyllabusService.get_active_document(user_id)
         return doc.extracted_text if doc else ""
 
+    @staticmethod
+    def relevant_text(user_id: int, query: str, k: int = 5, syllabus_id: int = None) -> str:
+        """
+        Top-k syllabus chunks for query from the active document, joined in
+        document order. Falls back to the start of the document if nothing matches.
+        """
+        doc = SyllabusService.get_active_document(user_id, syllabus_id)
+        if not doc or not doc.extracted_text:
+            return ""
+        chunks = syllabus_index.search(doc, query, k)
+        if not chunks:
+            return doc.extracted_text
+        return "\n...\n".join(content for _, content in chunks)
+
+    @staticmethod
+    def extract_text_from_pdf(path: str) -> str:
+        """PyPDF2 text (used as context for chat). Scanned PDFs may yield no text."""
+        try:
+            from PyPDF2 import PdfReader
+            reader = PdfReader(path)
+            return "\n".join((page.extract_text() or '') for page in reader.pages).strip()
+        except Exception as e:
+            print(f"[Syllabus] Text extraction failed for {path}: {e}")
+            return ""
+
+    @staticmethod
+    def create_todos_from_tasks(user_id: int, syllabus_id: int, tasks: list, target_date_str: str = None) -> int:
+        """
+        Create chapter + subtask Todos from AI tasks with one bulk insert (no commit).
+        (title, category) pairs the user already has are skipped using one
+        set-based query instead of a .first() per task. Returns the number created.
+        """
+        items = []  # (title, category, priority, is_chapter) in plan order
+        for task in tasks or []:
+            chapter = str(task.get("title", "")).strip() or "Chapter"
+            chapter_category = chapter[:50]
+            items.append((chapter[:200], chapter_category, 'high', True))  # Chapters are main goals
+            subtasks = task.get("subtasks", [])
+            if isinstance(subtasks, list):
+                for sub in subtasks:
+                    sub_title = str(sub).strip()
+                    if sub_title:
+                        items.append((sub_title[:200], chapter_category, 'medium', False))
+        if not items:
+            return 0
+
+        # Spread the items over the days until the target date
+        target_date = None
+        days_diff = 1
+        if target_date_str:
+            try:
+                target_date = datetime.strptime(target_date_str, '%Y-%m-%d')
+                days_diff = max(1, (target_date - datetime.now()).days)  # Minimum 1 day
+            except ValueError:
+                pass
+        items_per_day = math.ceil(len(items) / days_diff)
+
+        existing = set(
+            db.session.query(Todo.title, Todo.category)
+            .filter(Todo.user_id == user_id, Todo.is_group == False,
+                    Todo.category.in_(sorted({category for _, category, _, _ in items})))
+            .all()
+        )
+        rows = []
+        position = 0
+        now = datetime.now()
+        for title, category, priority, is_chapter in items:
+            if (title, category) in existing:
+                if is_chapter:
+                    position += 1  # Chapters keep their slot in the schedule
+                continue
+            existing.add((title, category))
+            due_date = now + timedelta(days=position // items_per_day)
+            rows.append({
+                'user_id': user_id,
+                'title': title,
+                'completed': False,
+                'priority': priority,
+                'due_date': due_date.strftime('%Y-%m-%d') if target_date else None,
+                'category': category,
+                'is_group': False,
+                'syllabus_id': syllabus_id,  # Link to this syllabus
+            })
+            position += 1
+        if rows:
+            db.session.execute(Todo.__table__.insert(), rows)
+        return len(rows)
+
     @staticmethod
     def extract_tasks_from_pdf(pdf_bytes: bytes) -> list:
         if not AI_API_KEY:
@@ -1777,27 +3639,131 @@ class SyllabusService:
 # ------------------------------
 # API HELPER (Fix for missing function)
 # ------------------------------
-def call_ai_api(messages):
+class PromptBuilder:
     """
-    Call Google Gemini API with automatic key rotation on quota exhaustion.
-    messages: list of dicts [{'role': 'user', 'content': '...'}]
-    Returns: str (response content)
+    Token-budgeted prompt assembly.
+
+    Every section has a fixed token budget, so a long syllabus, question or
+    chat can't push the system prompt out of the request (the old code
+    sliced the last 3000 characters of the flattened prompt):
+    - system, syllabus excerpt, summary: trimmed to their budget
+    - history: newest turns first until the budget is used, older dropped
+    - question: trimmed keeping its start and end
+
+    Tokens are estimated locally (~4 ASCII chars per token, 1 per other
+    char) instead of calling Gemini's count_tokens on every turn.
     """
-    if not gemini_rotator.available:
-        raise ValueError("No Gemini API keys configured. Set AI_API_KEY_1, AI_API_KEY_2, etc. in environment.")
 
-    conversation_history = ""
-    for m in messages:
-        role = "User" if m['role'] == 'user' else "Model"
-        conversation_history += f"{role}: {m['content']}\n"
+    BUDGETS = {'system': 400, 'syllabus': 750, 'summary': 300, 'history': 800, 'question': 500}
+    TOTAL_BUDGET = int(os.getenv('PROMPT_TOKEN_BUDGET', 1500))  # build_ai_prompt (one-off prompts)
+    CHARS_PER_TOKEN = 4
+    GAP = "\n…\n"
+
+    @staticmethod
+    def estimate_tokens(text: str) -> int:
+        if not text:
+            return 0
+        ascii_chars = len(text.encode('ascii', 'ignore'))
+        return -(-ascii_chars // PromptBuilder.CHARS_PER_TOKEN) + (len(text) - ascii_chars)
+
+    @staticmethod
+    def _fit_chars(text: str, budget: int) -> int:
+        """Length of the longest prefix of text that fits in budget tokens (binary search)."""
+        lo, hi = 0, min(len(text), max(0, budget) * PromptBuilder.CHARS_PER_TOKEN)
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if PromptBuilder.estimate_tokens(text[:mid]) <= budget:
+                lo = mid
+            else:
+                hi = mid - 1
+        return lo
+
+    @staticmethod
+    def truncate(text: str, budget: int, keep: str = 'head') -> str:
+        """Cut text to ~budget tokens, keeping the 'head', the 'tail' or both 'ends'."""
+        if not text or PromptBuilder.estimate_tokens(text) <= budget:
+            return text or ''
+        budget -= 1  # Room for the gap marker
+        if keep == 'tail':
+            window = text[-max(0, budget) * PromptBuilder.CHARS_PER_TOKEN:] if budget > 0 else ''
+            n = PromptBuilder._fit_chars(window[::-1], budget)
+            return "…" + window[len(window) - n:] if n else ''
+        if keep == 'ends':
+            budget += 1 - PromptBuilder.estimate_tokens(PromptBuilder.GAP)
+            head = PromptBuilder.truncate(text, budget // 2 + 1, 'head').rstrip('…').rstrip()
+            tail = PromptBuilder.truncate(text, budget - budget // 2 + 1, 'tail').lstrip('…').lstrip()
+            return head + PromptBuilder.GAP + tail
+        return text[:PromptBuilder._fit_chars(text, budget)] + "…"
+
+    @staticmethod
+    def format_turn(message: dict) -> str:
+        role = "User" if message['role'] == 'user' else "Model"
+        return f"{role}: {message['content']}"
+
+    @staticmethod
+    def fit_history(messages: list, budget: int) -> list:
+        """Formatted turns (oldest -> newest) that fit in budget, newest kept first."""
+        per_turn = max(1, budget // 2)  # One long reply can't use up the whole history budget
+        kept, used = [], 0
+        for message in reversed(messages):
+            line = PromptBuilder.truncate(PromptBuilder.format_turn(message), per_turn, 'ends')
+            cost = PromptBuilder.estimate_tokens(line)
+            if used + cost > budget:
+                break
+            kept.append(line)
+            used += cost
+        kept.reverse()
+        return kept
+
+    @staticmethod
+    def build(system: str, question: str, syllabus: str = '', summary: str = '', history=()) -> str:
+        """Assemble a chat prompt: system, syllabus excerpt, summary, recent turns, question."""
+        budgets = PromptBuilder.BUDGETS
+        sections = [PromptBuilder.truncate(system, budgets['system'])]
+        if syllabus:
+            sections.append(
+                "[REFERENCE MATERIAL - SYLLABUS/CONTENT]\n"
+                + PromptBuilder.truncate(syllabus, budgets['syllabus'])
+                + "\n[END REFERENCE MATERIAL]\n(Use the above material ONLY if the user asks about it.)"
+            )
+        if summary:
+            sections.append(
+                "[EARLIER IN THIS CONVERSATION - SUMMARY]\n"
+                + PromptBuilder.truncate(summary, budgets['summary'])
+                + "\n[END SUMMARY]"
+            )
+        turns = PromptBuilder.fit_history(list(history), budgets['history'])
+        if turns:
+            sections.append("\n".join(turns))
+        sections.append("User Question: " + PromptBuilder.truncate(question, budgets['question'], 'ends'))
+        return "\n\n".join(sections)
 
-    # Limit context to last 3000 chars to stay within free-tier token limits
-    final_prompt = conversation_history[-3000:]
+
+def build_ai_prompt(messages):
+    """
+    Flatten chat messages into the single prompt string sent to Gemini.
+    The last message (the actual request) is always kept; older turns are
+    dropped oldest-first to stay within PromptBuilder.TOTAL_BUDGET tokens.
+    """
+    if not messages:
+        return ""
+    last = PromptBuilder.truncate(PromptBuilder.format_turn(messages[-1]), PromptBuilder.TOTAL_BUDGET, 'ends')
+    remaining = PromptBuilder.TOTAL_BUDGET - PromptBuilder.estimate_tokens(last)
+    earlier = PromptBuilder.fit_history(messages[:-1], remaining) if remaining > 0 else []
+    return "\n".join(earlier + [last]) + "\n"
+
+
+def call_ai_prompt(prompt, endpoint='chat'):
+    """
+    Send an already assembled prompt string through the AI gateway
+    (bounded pool, key scheduling). Returns: str (response content)
+    """
+    if not gemini_keys.available and ai_gateway.backend.name == 'gemini':
+        raise ValueError("No Gemini API keys configured. Set AI_API_KEY_1, AI_API_KEY_2, etc. in environment.")
 
     try:
         model_id = os.environ.get("GEMINI_MODEL", AI_MODEL)
-        # Use rotator — automatically switches key on quota exhaustion
-        response = gemini_rotator.generate_content(model_id, final_prompt)
+        response = ai_gateway.generate(endpoint, model_id, prompt)
         return response.text
 
     except Exception as e:
@@ -1805,18 +3771,70 @@ def call_ai_api(messages):
         raise e
 
 
+def call_ai_api(messages, endpoint='chat'):
+    """
+    Call Google Gemini API through the AI gateway (bounded pool, key scheduling).
+    messages: list of dicts [{'role': 'user', 'content': '...'}]
+    endpoint: gateway concurrency bucket ('chat', 'battle', 'quiz', ...)
+    Returns: str (response content)
+    """
+    return call_ai_prompt(build_ai_prompt(messages), endpoint)
+
+
 class ChatService:
     """Personal + group AI chat.
 
     Uses DS concept:
-    - LRU cache to avoid repeated calls for same query.
+    - LRU cache to avoid repeated calls for same query. Keys are per user and
+      include hashes of the syllabus and recent history that went into the
+      prompt, so one user's answer is never served to another.
     """
 
-    _cache = LRUCache(capacity=100)
+    CACHE_TTL = int(os.getenv('CHAT_CACHE_TTL', 3600))
+    _cache = LRUCache(
+        capacity=int(os.getenv('CHAT_CACHE_SIZE', 200)),
+        ttl_seconds=CACHE_TTL,
+        max_bytes=int(os.getenv('CHAT_CACHE_MAX_BYTES', 4 * 1024 * 1024))
+    )
+    _shared_cache = RedisCacheBackend.from_env(CACHE_TTL)
+
+    @staticmethod
+    def _digest(text):
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def cache_key(user_id, message, syllabus_text, history):
+        """(user_id, normalized message, syllabus hash, history hash) -> cache key."""
+        normalized = ' '.join((message or '').lower().split())
+        syllabus_hash = ChatService._digest(syllabus_text or '')
+        history_hash = ChatService._digest(json.dumps(history, sort_keys=True))
+        return ChatService._digest(f"{user_id}|{normalized}|{syllabus_hash}|{history_hash}")
+
+    @staticmethod
+    def _cache_get(key):
+        cached = ChatService._cache.get(key)
+        if cached is None and ChatService._shared_cache is not None:
+            cached = ChatService._shared_cache.get(key)
+            if cached is not None:
+                ChatService._cache.put(key, cached)  # Promote to the local tier
+        return cached
+
+    @staticmethod
+    def _cache_put(key, response):
+        ChatService._cache.put(key, response)
+        if ChatService._shared_cache is not None:
+            ChatService._shared_cache.put(key, response)
+
+    @staticmethod
+    def cache_stats():
+        stats = {'local': ChatService._cache.stats()}
+        if ChatService._shared_cache is not None:
+            stats['shared'] = ChatService._shared_cache.stats()
+        return stats
 
     @staticmethod
-    def build_system_prompt(user: User, syllabus_text: str) -> str:
-        base = (
+    def build_system_prompt(user: User) -> str:
+        return (
             "You are StudyVerse, an expert AI Study Coach and academic mentor. "
             "Your goal is to help students learn effectively, stay motivated, and organize their studies.\n"
             "Guidelines:\n"
@@ -1826,74 +3844,298 @@ class ChatService:
             "4. Keep responses concise but helpful. Avoid long monologues unless necessary.\n"
             "5. Remember the context of the conversation."
         )
-        if syllabus_text:
-            base += "\n\n[REFERENCE MATERIAL - SYLLABUS/CONTENT]\n" + syllabus_text[:3000] + "\n[END REFERENCE MATERIAL]\n(Use the above material ONLY if the user asks about it.)"
-        return base
 
     @staticmethod
-    def generate_focus_plan(user: User) -> str:
+    def focus_plan_messages(user: User) -> list:
         # Get pending tasks
         todos = Todo.query.filter_by(user_id=user.id, completed=False).limit(10).all()
         tasks_text = "\n".join([f"- {t.title} (Priority: {t.priority})" for t in todos])
         
-        syllabus_text = SyllabusService.get_syllabus_text(user.id)
+        # Syllabus chunks that match the pending tasks
+        syllabus_text = SyllabusService.relevant_text(user.id, tasks_text, k=3)
         
         prompt = (
             "You are a study coach. Based on the user's pending tasks and syllabus, "
             "create a short, actionable 3-step study plan for today. "
             "Format nicely with Markdown. Keep it encouraging.\n\n"
             f"Pending Tasks:\n{tasks_text}\n\n"
-            f"Syllabus Context:\n{syllabus_text[:1000]}"
+            f"Syllabus Context:\n{PromptBuilder.truncate(syllabus_text, 400)}"
         )
         
-        messages = [{'role': 'user', 'content': prompt}]
-        return call_ai_api(messages)
+        return [{'role': 'user', 'content': prompt}]
+
+    @staticmethod
+    def generate_focus_plan(user: User) -> str:
+        return call_ai_api(ChatService.focus_plan_messages(user))
+
+    @staticmethod
+    def prepare_chat(user: User, message: str):
+        """Returns (cache_key, cached_reply_or_None, prompt string) for a personal chat turn."""
+        # 1. Get Context (Syllabus + rolling summary + last few raw turns)
+        syllabus_text = SyllabusService.relevant_text(user.id, message)
+        summary, history = ChatSummaryService.context(user.id)
+        if history and history[-1]['role'] == 'user' and history[-1]['content'] == message:
+            history.pop()  # The question itself was already stored by the route
+
+        # 2. Check Cache (keyed by everything that shapes the answer)
+        cache_key = ChatService.cache_key(user.id, message, syllabus_text, [summary, history])
+        cached = ChatService._cache_get(cache_key)
+        if cached:
+            return cache_key, cached, None
+        
+        # 3. Build Prompt (fixed token budget per section)
+        prompt = PromptBuilder.build(
+            ChatService.build_system_prompt(user), message,
+            syllabus=syllabus_text, summary=summary, history=history
+        )
+        return cache_key, None, prompt
+
+    @staticmethod
+    def error_reply(exc: Exception) -> str:
+        return f"I'm having trouble connecting to my brain right now. Please try again later. (Error: {str(exc)})"
 
     @staticmethod
     def generate_chat_response(user: User, message: str) -> str:
-        # 1. Check Cache
-        cached = ChatService._cache.get(message)
+        cache_key, cached, prompt = ChatService.prepare_chat(user, message)
         if cached:
             return cached
-
-        # 2. Get Context (Syllabus)
-        syllabus_text = SyllabusService.get_syllabus_text(user.id)
-        
-        # 3. Build Prompt
-        system_prompt = ChatService.build_system_prompt(user, syllabus_text)
-        
-        # We should ideally fetch recent chat history here for context window
-        recent_chats = ChatMessage.query.filter_by(user_id=user.id, is_group=False).order_by(ChatMessage.created_at.desc()).limit(5).all()
-        history = []
-        for msg in reversed(recent_chats):
-            history.append({'role': msg.role, 'content': msg.content})
-            
-        messages = history + [{'role': 'user', 'content': f"{system_prompt}\n\nUser Question: {message}"}]
         
         # 4. Call API
         try:
-            response = call_ai_api(messages)
+            response = call_ai_prompt(prompt)
             # 5. Cache Result
-            ChatService._cache.put(message, response)
+            ChatService._cache_put(cache_key, response)
             return response
         except Exception as e:
-            return f"I'm having trouble connecting to my brain right now. Please try again later. (Error: {str(e)})"
+            return ChatService.error_reply(e)
             
     @staticmethod
     def personal_reply(user: User, message: str) -> str:
         """Wrapper for generate_chat_response for backward compatibility / keeping naming consistent in routes"""
         return ChatService.generate_chat_response(user, message)
 
+
+class ChatSummaryService:
+    """
+    Rolling per-user summary of the personal AI chat (ChatSummary table).
+
+    The prompt carries the last RECENT_MESSAGES raw turns; everything older
+    is represented by the summary. Once FOLD_BATCH older messages are not
+    covered yet, they are folded into the summary with one small AI call
+    on a background thread, so the chat request never waits for it.
+    """
+
+    RECENT_MESSAGES = 6
+    FOLD_BATCH = 6
+    FOLD_MAX = 40           # Messages folded per call (a long backlog catches up over a few turns)
+    FOLD_TURN_TOKENS = 200  # Per-message cap inside the fold prompt
+    _lock = threading.Lock()
+    _refreshing = set()
+
+    @staticmethod
+    def context(user_id: int):
+        """(summary text, recent raw history as [{'role', 'content'}]) for the prompt."""
+        row = db.session.get(ChatSummary, user_id)
+        covered = row.last_message_id if row else 0
+        recent = (
+            ChatMessage.query
+            .filter(ChatMessage.user_id == user_id, ChatMessage.is_group == False, ChatMessage.id > covered)
+            .order_by(ChatMessage.id.desc())
+            .limit(ChatSummaryService.RECENT_MESSAGES + 1)  # +1: the question just stored
+            .all()
+        )
+        history = [{'role': m.role, 'content': m.content} for m in reversed(recent)]
+        return (row.summary if row else ''), history
+
+    @staticmethod
+    def fold_prompt(summary: str, messages: list) -> str:
+        turns = "\n".join(
+            PromptBuilder.truncate(PromptBuilder.format_turn({'role': m.role, 'content': m.content}),
+                                   ChatSummaryService.FOLD_TURN_TOKENS, 'ends')
+            for m in messages
+        )
+        words = PromptBuilder.BUDGETS['summary'] * 3 // 5
+        return (
+            "Update the running summary of a student's conversation with their AI study coach. "
+            f"Keep it under {words} words: topics discussed, the student's goals and facts about them, "
+            "and anything still unresolved. Plain text, no preamble.\n\n"
+            f"Current summary:\n{summary or '(none yet)'}\n\n"
+            f"New messages:\n{turns}\n\n"
+            "Updated summary:"
+        )
+
+    @staticmethod
+    def maybe_refresh(user_id: int):
+        """Fold older messages into the summary in the background (one refresh per user at a time)."""
+        with ChatSummaryService._lock:
+            if user_id in ChatSummaryService._refreshing:
+                return
+            ChatSummaryService._refreshing.add(user_id)
+        threading.Thread(target=ChatSummaryService._refresh, args=(user_id,), daemon=True).start()
+
+    @staticmethod
+    def _refresh(user_id: int):
+        try:
+            with app.app_context():
+                row = db.session.get(ChatSummary, user_id)
+                covered = row.last_message_id if row else 0
+
+                # The newest RECENT_MESSAGES stay raw; fold what is older than them
+                recent_ids = [
+                    msg_id for (msg_id,) in db.session.query(ChatMessage.id)
+                    .filter(ChatMessage.user_id == user_id, ChatMessage.is_group == False)
+                    .order_by(ChatMessage.id.desc())
+                    .limit(ChatSummaryService.RECENT_MESSAGES)
+                ]
+                if len(recent_ids) < ChatSummaryService.RECENT_MESSAGES:
+                    return
+                pending = (
+                    ChatMessage.query
+                    .filter(ChatMessage.user_id == user_id, ChatMessage.is_group == False,
+                            ChatMessage.id > covered, ChatMessage.id < min(recent_ids))
+                    .order_by(ChatMessage.id.asc())
+                    .limit(ChatSummaryService.FOLD_MAX)
+                    .all()
+                )
+                if len(pending) < ChatSummaryService.FOLD_BATCH:
+                    return
+
+                prompt = ChatSummaryService.fold_prompt(row.summary if row else '', pending)
+                summary = (call_ai_prompt(prompt, endpoint='summary') or '').strip()
+                if not summary:
+                    return
+                if row is None:
+                    row = ChatSummary(user_id=user_id, message_count=0)
+                    db.session.add(row)
+                row.summary = PromptBuilder.truncate(summary, PromptBuilder.BUDGETS['summary'])
+                row.last_message_id = pending[-1].id
+                row.message_count = (row.message_count or 0) + len(pending)
+                db.session.commit()
+        except Exception as e:
+            print(f"[ChatSummary] Refresh failed for user {user_id}: {e}")
+        finally:
+            with ChatSummaryService._lock:
+                ChatSummaryService._refreshing.discard(user_id)
+
+
+class ChatStreamService:
+    """
+    Token-by-token personal chat over Socket.IO.
+
+    /chat/send (stream=true) stores the user message, queues a Gemini stream
+    on the AI gateway and returns at once. Deltas go to the user's
+    `user_{id}` room as `chat_token`; when the stream ends the assistant
+    ChatMessage is written once and `chat_done` (or `chat_error`) is sent.
+    A `chat_cancel` socket event stops the stream; the partial answer is kept.
+
+    DS concept:
+    - Hash map (user_id, stream_id) -> threading.Event for cancellation
+    """
+
+    STREAM_ID_RE = re.compile(r'^[A-Za-z0-9_-]{8,64}$')
+    _lock = threading.Lock()
+    _active = {}
+
+    @staticmethod
+    def start(user: User, message: str, stream_id: str = None) -> str:
+        """Start streaming a reply; returns the stream id (client-supplied ids are kept if valid)."""
+        if not stream_id or not ChatStreamService.STREAM_ID_RE.match(stream_id):
+            stream_id = uuid.uuid4().hex
+        user_id = user.id
+        room = f"user_{user_id}"
+
+        cache_key, cached, prompt = ChatService.prepare_chat(user, message)
+        if cached:
+            socketio.emit('chat_token', {'stream_id': stream_id, 'delta': cached}, room=room)
+            ChatStreamService._finish(user_id, stream_id, cached)
+            return stream_id
+
+        cancel_event = threading.Event()
+        with ChatStreamService._lock:
+            ChatStreamService._active[(user_id, stream_id)] = cancel_event
+        try:
+            future = ai_gateway.stream(
+                'chat', os.environ.get("GEMINI_MODEL", AI_MODEL), prompt,
+                on_delta=lambda delta: socketio.emit('chat_token', {'stream_id': stream_id, 'delta': delta}, room=room),
+                cancel_event=cancel_event
+            )
+        except Exception:
+            with ChatStreamService._lock:
+                ChatStreamService._active.pop((user_id, stream_id), None)
+            raise
+        future.add_done_callback(lambda f: ChatStreamService._on_done(user_id, stream_id, cache_key, f))
+        return stream_id
+
+    @staticmethod
+    def cancel(user_id: int, stream_id: str) -> bool:
+        with ChatStreamService._lock:
+            cancel_event = ChatStreamService._active.get((user_id, stream_id))
+        if cancel_event is None:
+            return False
+        cancel_event.set()
+        return True
+
+    @staticmethod
+    def _on_done(user_id, stream_id, cache_key, future):
+        with ChatStreamService._lock:
+            ChatStreamService._active.pop((user_id, stream_id), None)
+        exc = future.exception()
+        if exc is not None:
+            print(f"[ChatStream] Stream {stream_id} for user {user_id} failed: {exc}")
+            ChatStreamService._finish(user_id, stream_id, ChatService.error_reply(exc), error=True)
+            return
+        reply, cancelled = future.result()
+        if reply and not cancelled:
+            ChatService._cache_put(cache_key, reply)
+        ChatStreamService._finish(user_id, stream_id, reply, cancelled=cancelled)
+
+    @staticmethod
+    def _finish(user_id, stream_id, reply, cancelled=False, error=False):
+        """Persist the assistant message (once) and tell the client the stream is over."""
+        ai_timestamp = None
+        if reply:
+            try:
+                with app.app_context():
+                    ai_msg = ChatMessage(user_id=user_id, role='assistant', content=reply, is_group=False)
+                    db.session.add(ai_msg)
+                    db.session.commit()
+                    ai_timestamp = to_ist_time(ai_msg.created_at)
+                ChatSummaryService.maybe_refresh(user_id)
+            except Exception as e:
+                print(f"[ChatStream] Failed to save reply for stream {stream_id}: {e}")
+        socketio.emit('chat_error' if error else 'chat_done', {
+            'stream_id': stream_id,
+            'reply': reply,
+            'cancelled': cancelled,
+            'ai_timestamp': ai_timestamp
+        }, room=f"user_{user_id}")
+
 @app.route('/api/ai/plan', methods=['GET'])
 @login_required
 def ai_plan():
     try:
+        if request.args.get('async') == '1':
+            # Return right away; the client polls /api/ai/jobs/<job_id>
+            model_id = os.environ.get("GEMINI_MODEL", AI_MODEL)
+            prompt = build_ai_prompt(ChatService.focus_plan_messages(current_user))
+            job_id = ai_gateway.track(current_user.id, ai_gateway.submit('chat', model_id, prompt))
+            return jsonify({'status': 'pending', 'job_id': job_id}), 202
         plan = ChatService.generate_focus_plan(current_user)
         return jsonify({'status': 'success', 'plan': plan})
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)})
 
 
+@app.route('/api/ai/jobs/<job_id>', methods=['GET'])
+@login_required
+def ai_job_status(job_id):
+    """Poll an AI job started with ?async=1."""
+    status = ai_gateway.job_status(current_user.id, job_id)
+    if status is None:
+        return jsonify({'status': 'error', 'message': 'Job not found'}), 404
+    return jsonify(status)
+
+
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(int(user_id))
@@ -2105,11 +4347,7 @@ def signin():
 def logout():
     print(f"Logging out user: {current_user.id}")
     # Set last_seen to past to ensure immediate offline status
-    try:
-        current_user.last_seen = datetime.utcnow() - timedelta(minutes=15)
-        db.session.commit()
-    except:
-        pass
+    presence.mark_offline(current_user.id)
         
     logout_user()
     session.clear()
@@ -2170,6 +4408,8 @@ def google_callback():
             )
             db.session.add(user)
             db.session.commit()
+            rank_index.update(user)
+            user_search_index.update(user)
             
             # Email functionality removed
         else:
@@ -2233,6 +4473,8 @@ def google_auth():
         )
         db.session.add(user)
         db.session.commit()
+        rank_index.update(user)
+        user_search_index.update(user)
         
         # Email functionality removed
     
@@ -2278,16 +4520,153 @@ def admin_required(f):
     return decorated_function
 
 # ============================================================================
-# ONLINE USERS TRACKER - In-memory set of currently connected user IDs
+# ONLINE USERS TRACKER - Write-behind presence buffer
 # ============================================================================
 
-# Tracks user IDs currently active (updated on every request, cleared on logout)
-# Uses a simple set for O(1) add/remove/lookup — resets on server restart (ephemeral by design)
-online_users = set()
-
 # How many minutes of inactivity before a user is considered "offline"
 ONLINE_THRESHOLD_MINUTES = 5
 
+# How often buffered last_seen timestamps are written to the database
+PRESENCE_FLUSH_SECONDS = int(os.getenv('PRESENCE_FLUSH_SECONDS', 30))
+
+
+class PresenceBuffer:
+    """
+    In-memory last-seen tracker with periodic bulk flush.
+    Every request only touches a dict; one background thread writes all
+    pending timestamps in a single UPDATE every PRESENCE_FLUSH_SECONDS.
+
+    DS concept:
+    - Hash map user_id -> last_seen for O(1) touch/lookup
+    - Separate "dirty" map so each flush writes only changed rows
+    """
+
+    def __init__(self, flush_interval=PRESENCE_FLUSH_SECONDS):
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._last_seen = {}   # user_id -> datetime (recent activity, served to readers)
+        self._pending = {}     # user_id -> datetime (not yet written to the DB)
+        self._thread = None
+
+    def touch(self, user_id, ts=None):
+        """Record activity for a user (called on every request)."""
+        ts = ts or datetime.utcnow()
+        with self._lock:
+            self._last_seen[user_id] = ts
+            self._pending[user_id] = ts
+
+    def mark_offline(self, user_id):
+        """Push last_seen into the past so the user drops off immediately (logout)."""
+        self.touch(user_id, datetime.utcnow() - timedelta(minutes=ONLINE_THRESHOLD_MINUTES * 3))
+
+    def last_seen(self, user_id, fallback=None):
+        """Freshest known last_seen: buffered value if newer than the DB column."""
+        with self._lock:
+            ts = self._last_seen.get(user_id)
+        if ts is None:
+            return fallback
+        if fallback is None:
+            return ts
+        return max(ts, fallback)
+
+    def is_online(self, user_id, fallback=None):
+        ts = self.last_seen(user_id, fallback)
+        if ts is None:
+            return False
+        return datetime.utcnow() - ts < timedelta(minutes=ONLINE_THRESHOLD_MINUTES)
+
+    def online_ids(self):
+        """IDs of users active within ONLINE_THRESHOLD_MINUTES."""
+        threshold = datetime.utcnow() - timedelta(minutes=ONLINE_THRESHOLD_MINUTES)
+        with self._lock:
+            return {uid for uid, ts in self._last_seen.items() if ts >= threshold}
+
+    def online_count(self):
+        return len(self.online_ids())
+
+    def seed(self):
+        """Load recently active users from the DB (after a restart the buffer is empty)."""
+        threshold = datetime.utcnow() - timedelta(minutes=ONLINE_THRESHOLD_MINUTES)
+        try:
+            with app.app_context():
+                rows = db.session.query(User.id, User.last_seen).filter(User.last_seen >= threshold).all()
+                db.session.remove()
+        except Exception as e:
+            print(f"[Presence] Seed skipped: {e}")
+            return
+        with self._lock:
+            for uid, ts in rows:
+                if uid not in self._last_seen:
+                    self._last_seen[uid] = ts
+
+    def flush(self):
+        """Write all pending timestamps in one statement. Returns number of rows written."""
+        with self._lock:
+            if not self._pending:
+                return 0
+            batch = self._pending
+            self._pending = {}
+
+        items = list(batch.items())
+        try:
+            with app.app_context():
+                if db.engine.dialect.name == 'postgresql':
+                    # UPDATE ... FROM (VALUES ...) — one round trip for the whole batch
+                    params = {}
+                    values = []
+                    for i, (uid, ts) in enumerate(items):
+                        values.append(f"(:id{i}, CAST(:ts{i} AS TIMESTAMP))")
+                        params[f'id{i}'] = uid
+                        params[f'ts{i}'] = ts
+                    sql = (
+                        'UPDATE "user" AS u SET last_seen = v.ts '
+                        f'FROM (VALUES {", ".join(values)}) AS v(id, ts) '
+                        'WHERE u.id = v.id'
+                    )
+                    db.session.execute(db.text(sql), params)
+                else:
+                    # executemany fallback (SQLite)
+                    db.session.execute(
+                        db.text('UPDATE "user" SET last_seen = :ts WHERE id = :id'),
+                        [{'id': uid, 'ts': ts} for uid, ts in items]
+                    )
+                db.session.commit()
+                db.session.remove()
+        except Exception as e:
+            print(f"[Presence] Flush failed ({len(items)} users): {e}")
+            # Put the batch back unless newer activity has already replaced it
+            with self._lock:
+                for uid, ts in items:
+                    if uid not in self._pending:
+                        self._pending[uid] = ts
+            return 0
+
+        self._prune()
+        return len(items)
+
+    def _prune(self):
+        """Drop entries old enough that the DB column is authoritative again."""
+        cutoff = datetime.utcnow() - timedelta(minutes=ONLINE_THRESHOLD_MINUTES * 2)
+        with self._lock:
+            for uid in [uid for uid, ts in self._last_seen.items() if ts < cutoff and uid not in self._pending]:
+                del self._last_seen[uid]
+
+    def _run(self):
+        self.seed()
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True, name="presence-flush")
+            self._thread.start()
+
+
+presence = PresenceBuffer()
+presence.start()
+atexit.register(presence.flush)  # Don't lose the last few seconds of activity on shutdown
+
 # ============================================================================
 # BAN CHECK + LAST SEEN MIDDLEWARE
 # ============================================================================
@@ -2296,9 +4675,8 @@ ONLINE_THRESHOLD_MINUTES = 5
 def check_ban_status():
     """
     Runs on EVERY request:
-    1. Updates user's last_seen timestamp (powers the admin activity tracker)
-    2. Adds user to the in-memory online_users set
-    3. Checks if user is banned → logs them out immediately if so
+    1. Records activity in the presence buffer (no DB write — flushed in bulk)
+    2. Checks if user is banned → logs them out immediately if so
     """
     # Skip for static files and auth routes to avoid unnecessary DB hits
     if request.endpoint and (request.endpoint.startswith('static') or request.endpoint == 'auth'):
@@ -2314,14 +4692,8 @@ def check_ban_status():
             flash(f'Your account has been banned. Reason: {user.ban_reason or "Violation of terms"}', 'error')
             return redirect(url_for('auth'))
 
-        # ── Update last_seen + online set ──────────────────────────────────
         if user:
-            try:
-                user.last_seen = datetime.utcnow()
-                db.session.commit()
-            except Exception:
-                db.session.rollback()
-            online_users.add(current_user.id)
+            presence.touch(current_user.id)
 
     return None
 
@@ -2372,6 +4744,7 @@ class AdminService:
         user.banned_by = admin_id
         
         db.session.commit()
+        rank_index.update(user)
         
         AdminService.log_action(
             admin_id=admin_id,
@@ -2394,6 +4767,7 @@ class AdminService:
         user.banned_by = None
         
         db.session.commit()
+        rank_index.update(user)
         
         AdminService.log_action(
             admin_id=admin_id,
@@ -2430,12 +4804,16 @@ class AdminService:
 
         # 4. Standard one-to-many dependencies
         Todo.query.filter_by(user_id=user_id).delete()
+        ChatSummary.query.filter_by(user_id=user_id).delete()
         ChatMessage.query.filter_by(user_id=user_id).delete()
         StudySession.query.filter_by(user_id=user_id).delete()
         TopicProficiency.query.filter_by(user_id=user_id).delete()
         Event.query.filter_by(user_id=user_id).delete()
+        SyllabusChunk.query.filter_by(user_id=user_id).delete()
         SyllabusDocument.query.filter_by(user_id=user_id).delete()
         XPHistory.query.filter_by(user_id=user_id).delete()
+        UserDailyStats.query.filter_by(user_id=user_id).delete()
+        XPBucket.query.filter_by(user_id=user_id).delete()
         UserItem.query.filter_by(user_id=user_id).delete()
         ActivePowerUp.query.filter_by(user_id=user_id).delete()
         UserBadge.query.filter_by(user_id=user_id).delete()
@@ -2452,6 +4830,11 @@ class AdminService:
         # 6. Delete User
         db.session.delete(user)
         db.session.commit()
+        rank_index.remove(user_id)
+        proficiency_matrix.mark_dirty(user_id)
+        friend_graph.remove_user(user_id)
+        user_search_index.remove(user_id)
+        powerup_cache.invalidate(user_id)
         
         # Log action after commit
         AdminService.log_action(
@@ -2491,6 +4874,7 @@ class SupportService:
         )
         db.session.add(msg)
         db.session.commit()
+        invalidate_support_context(user_id)
         return ticket
     
     @staticmethod
@@ -2519,6 +4903,7 @@ class SupportService:
         )
         db.session.add(msg)
         db.session.commit()
+        invalidate_support_context(user_id)
         
         return ticket
     
@@ -2556,6 +4941,7 @@ class SupportService:
         db.session.add(msg)
         ticket.updated_at = datetime.utcnow()
         db.session.commit()
+        invalidate_support_context(ticket.user_id)
         return msg
 
     @staticmethod
@@ -2572,6 +4958,134 @@ class SupportService:
         return query.order_by(SupportTicket.updated_at.desc()).all()
 
 
+# ============================================================================
+# PER-USER TEMPLATE CONTEXT CACHE
+# ============================================================================
+
+class UserContextCache:
+    """
+    Caches the DB-backed parts of the template context per user, so the
+    context processors don't re-query on every render_template.
+
+    Sections:
+    - 'cosmetics': active theme / frame (UserItem)
+    - 'friends':   accepted friends with profile data (Friendship + User)
+    - 'support':   unread support ticket count
+
+    Entries are dropped explicitly by the write paths that change them
+    (equip/unequip, friend accept/reject, support messages) and expire
+    after CONTEXT_CACHE_TTL seconds as a safety net.
+    """
+
+    ADMIN = 'admin'  # Shared bucket: every admin sees the same unread count
+
+    def __init__(self, ttl_seconds=60):
+        self.ttl = ttl_seconds
+        self._lock = threading.Lock()
+        self._data = {}  # (owner, section) -> (expires_at, value)
+
+    def get(self, owner, section):
+        with self._lock:
+            entry = self._data.get((owner, section))
+            if not entry:
+                return None
+            if entry[0] < time.time():
+                del self._data[(owner, section)]
+                return None
+            return entry[1]
+
+    def set(self, owner, section, value):
+        with self._lock:
+            self._data[(owner, section)] = (time.time() + self.ttl, value)
+
+    def get_or_load(self, owner, section, loader):
+        value = self.get(owner, section)
+        if value is None:
+            value = loader()
+            self.set(owner, section, value)
+        return value
+
+    def invalidate(self, owner, section=None):
+        """Drop one section (or all sections) for an owner."""
+        with self._lock:
+            if section:
+                self._data.pop((owner, section), None)
+            else:
+                for key in [k for k in self._data if k[0] == owner]:
+                    del self._data[key]
+
+
+context_cache = UserContextCache(ttl_seconds=int(os.getenv('CONTEXT_CACHE_TTL', 60)))
+
+
+def invalidate_support_context(user_id):
+    """A ticket changed: refresh the owner's badge and the shared admin badge."""
+    context_cache.invalidate(user_id, 'support')
+    context_cache.invalidate(UserContextCache.ADMIN, 'support')
+
+
+class CosmeticsService:
+    """
+    Batch loader for equipped cosmetics (active theme / frame).
+
+    Replaces the per-user UserItem query behind User.active_frame_color:
+    annotate() resolves a whole list of users with at most one IN query and
+    stores the result on each object. Results go through the 'cosmetics'
+    section of context_cache, which equip / unequip invalidate.
+    """
+
+    @staticmethod
+    def _empty():
+        return {'theme': None, 'frame': None}
+
+    @staticmethod
+    def load_many(user_ids):
+        """user_id -> {'theme': item_id, 'frame': item_id}; cache misses in one query."""
+        result, missing = {}, []
+        for uid in set(user_ids):
+            cached = context_cache.get(uid, 'cosmetics')
+            if cached is None:
+                missing.append(uid)
+            else:
+                result[uid] = cached
+
+        if missing:
+            loaded = {uid: CosmeticsService._empty() for uid in missing}
+            rows = db.session.query(UserItem.user_id, UserItem.item_id).filter(
+                UserItem.user_id.in_(missing),
+                UserItem.is_active == True
+            ).all()
+            for uid, item_id in rows:
+                cat_item = ShopService.ITEMS.get(item_id)
+                if cat_item and cat_item['type'] in ('theme', 'frame') and loaded[uid][cat_item['type']] is None:
+                    loaded[uid][cat_item['type']] = item_id
+            for uid, cosmetics in loaded.items():
+                context_cache.set(uid, 'cosmetics', cosmetics)
+            result.update(loaded)
+        return result
+
+    @staticmethod
+    def annotate(users):
+        """Attach cosmetics to each User so active_frame_color needs no query."""
+        users = [u for u in users if u is not None]
+        cosmetics = CosmeticsService.load_many([u.id for u in users])
+        for u in users:
+            u._cosmetics = cosmetics.get(u.id, CosmeticsService._empty())
+        return users
+
+    @staticmethod
+    def invalidate(user):
+        """Equip / unequip committed: drop the cached entry and the object's annotation."""
+        context_cache.invalidate(user.id, 'cosmetics')
+        user.__dict__.pop('_cosmetics', None)
+
+    @staticmethod
+    def for_user(user):
+        if user.__dict__.get('_cosmetics') is None:
+            CosmeticsService.annotate([user])
+        return user._cosmetics
+
+
 # ============================================================================
 # CONTEXT PROCESSORS (Inject data into all templates)
 # ============================================================================
@@ -2583,311 +5097,377 @@ def inject_support_notifications():
             if current_user.is_admin:
                 # Total unread tickets for admin
                 # Count tickets where admin has unread messages
-                unread_support = SupportTicket.query.filter(
-                    SupportTicket.status.in_(['open', 'in_progress']),
-                    SupportTicket.admin_unread_count > 0
-                ).count()
+                unread_support = context_cache.get_or_load(
+                    UserContextCache.ADMIN, 'support',
+                    lambda: SupportTicket.query.filter(
+                        SupportTicket.status.in_(['open', 'in_progress']),
+                        SupportTicket.admin_unread_count > 0
+                    ).count()
+                )
             else:
                 # Total unread tickets for user
-                unread_support = SupportTicket.query.filter(
-                    SupportTicket.user_id == current_user.id,
-                    SupportTicket.user_unread_count > 0
-                ).count()
+                unread_support = context_cache.get_or_load(
+                    current_user.id, 'support',
+                    lambda: SupportTicket.query.filter(
+                        SupportTicket.user_id == current_user.id,
+                        SupportTicket.user_unread_count > 0
+                    ).count()
+                )
         except:
             pass # Handle case where tables don't exist yet
             
     return dict(unread_support_count=unread_support)
 
 # ============================================================================
-# DASHBOARD (Main App Interface)
+# DASHBOARD AGGREGATION SERVICE
 # ============================================================================
 
-@app.route('/dashboard')
-@login_required
-def dashboard():
-    # Redirect admins to admin panel
-    if current_user.is_admin:
-        return redirect(url_for('admin_dashboard'))
-    
-    # Dashboard logic starts here
-    total_todos = Todo.query.filter_by(user_id=current_user.id).count()
-    completed_todos = Todo.query.filter_by(user_id=current_user.id, completed=True).count()
-    remaining_todos = max(total_todos - completed_todos, 0)
+@dataclass
+class DashboardSnapshot:
+    """Everything dashboard.html renders, computed in a fixed number of queries."""
+    total_todos: int = 0
+    completed_todos: int = 0
+    remaining_todos: int = 0
+    weekly_hours: float = 0.0
+    completion_percent: int = 0
+    avg_proficiency: int = 0
+    topics_covered: int = 0
+    topic_rows: list = field(default_factory=list)
+    recent_todos: list = field(default_factory=list)
+    upcoming_todos: list = field(default_factory=list)
+    online_users: int = 1
+    quests: list = field(default_factory=list)
+    today_study_mins: int = 0
+    weekly_stats: dict = field(default_factory=dict)
+    habits: list = field(default_factory=list)
+    today_log_ids: set = field(default_factory=set)
+    habit_chart: list = field(default_factory=list)
+    completed_parent_tasks: list = field(default_factory=list)
+    completed_events_week: list = field(default_factory=list)
+    important_event: object = None
+    important_todo: object = None
+    important_todo_label: str = "High Priority Task"
+
+    def as_context(self):
+        """Template kwargs (shallow — ORM rows are passed through untouched)."""
+        return {f.name: getattr(self, f.name) for f in fields(self)}
+
+
+class DashboardService:
+    """
+    Builds the dashboard with grouped queries and the UserDailyStats rollup
+    instead of per-day / per-row lookups. The number of queries is constant
+    no matter how many todos or sessions a user has.
+    """
 
-    week_ago = datetime.utcnow() - timedelta(days=7)
-    weekly_minutes = (
-        db.session.query(db.func.coalesce(db.func.sum(StudySession.duration), 0))
-        .filter(StudySession.user_id == current_user.id)
-        .filter(StudySession.completed_at >= week_ago)
-        .scalar()
-    )
-    weekly_hours = round((weekly_minutes or 0) / 60.0, 1)
+    @staticmethod
+    def _todo_counters(user_id, today):
+        """Total, completed and completed-today (quest) counts in one pass."""
+        created_today = db.func.date(Todo.created_at) == today
+        row = db.session.query(
+            db.func.count(Todo.id),
+            db.func.coalesce(db.func.sum(db.case((Todo.completed == True, 1), else_=0)), 0),
+            db.func.coalesce(db.func.sum(db.case((db.and_(Todo.completed == True, created_today), 1), else_=0)), 0),
+        ).filter(Todo.user_id == user_id).one()
+        return int(row[0] or 0), int(row[1] or 0), int(row[2] or 0)
+
+    @staticmethod
+    def _completed_categories(user_id, start_of_week):
+        """Categories where every subtask is done and at least one finished this week."""
+        rows = db.session.query(
+            Todo.category,
+            db.func.count(Todo.id),
+            db.func.coalesce(db.func.sum(db.case((Todo.completed == True, 1), else_=0)), 0),
+            db.func.max(Todo.completed_at),
+        ).filter(
+            Todo.user_id == user_id,
+            Todo.category != None,
+            db.func.trim(Todo.category) != ''
+        ).group_by(Todo.category).all()
+        return [
+            cat for cat, total, done, last_done in rows
+            if total == done and last_done and last_done >= start_of_week
+        ]
+
+    @staticmethod
+    def _build_quests(today_completed, today_study_mins):
+        return [
+            {
+                'description': 'Complete 3 tasks',
+                'icon': 'fa-check-circle',
+                'xp_reward': 50,
+                'progress': min(today_completed, 3),
+                'target': 3,
+                'completed': today_completed >= 3
+            },
+            {
+                'description': 'Study for 30 minutes',
+                'icon': 'fa-clock',
+                'xp_reward': 75,
+                'progress': min(today_study_mins, 30),
+                'target': 30,
+                'completed': today_study_mins >= 30
+            },
+            # Log in daily (always complete if you're seeing this)
+            {
+                'description': 'Log in today',
+                'icon': 'fa-door-open',
+                'xp_reward': 25,
+                'progress': 1,
+                'target': 1,
+                'completed': True
+            },
+        ]
+
+    @staticmethod
+    def build_snapshot(user_id) -> DashboardSnapshot:
+        snap = DashboardSnapshot()
+        now = datetime.utcnow()
+        today = now.date()
+        local_today = DailyStatsService.local_date(now)
+        # Align to current week (Monday - Sunday)
+        start_of_week_date = today - timedelta(days=today.weekday())
+        start_of_week = datetime.combine(start_of_week_date, datetime.min.time())
+        local_week_start = local_today - timedelta(days=local_today.weekday())
+        dates = [local_week_start + timedelta(days=i) for i in range(7)]
+
+        # Daily rollup rows cover the weekly chart, the last 7 days and today's quest
+        daily = DailyStatsService.get_range(user_id, min(local_week_start, local_today - timedelta(days=6)), local_today)
+
+        # --- Counters ---
+        total, completed, today_completed = DashboardService._todo_counters(user_id, today)
+        snap.total_todos = total
+        snap.completed_todos = completed
+        snap.remaining_todos = max(total - completed, 0)
+        snap.completion_percent = int((completed / total) * 100) if total else 0
+
+        # --- Study minutes (last 7 days, today's quest) ---
+        weekly_minutes = sum(
+            row.study_minutes for day, row in daily.items() if day > local_today - timedelta(days=7)
+        )
+        snap.weekly_hours = round(weekly_minutes / 60.0, 1)
+        snap.today_study_mins = daily[local_today].study_minutes if local_today in daily else 0
+
+        # --- Topics ---
+        snap.topic_rows = (
+            TopicProficiency.query
+            .filter_by(user_id=user_id)
+            .order_by(TopicProficiency.updated_at.desc())
+            .limit(6)
+            .all()
+        )
+        avg_prof, topics_covered = db.session.query(
+            db.func.coalesce(db.func.avg(TopicProficiency.proficiency), 0),
+            db.func.count(TopicProficiency.id),
+        ).filter(TopicProficiency.user_id == user_id).one()
+        snap.avg_proficiency = int(round(avg_prof or 0))
+        snap.topics_covered = int(topics_covered or 0)
+
+        snap.recent_todos = (
+            Todo.query
+            .filter_by(user_id=user_id)
+            .order_by(Todo.created_at.desc())
+            .limit(5)
+            .all()
+        )
+        snap.upcoming_todos = (
+            Todo.query
+            .filter_by(user_id=user_id, completed=False)
+            .order_by(Todo.id.desc())
+            .limit(5)
+            .all()
+        )
+
+        # --- Completed parent tasks & this week's finished events ---
+        snap.completed_parent_tasks = DashboardService._completed_categories(user_id, start_of_week)
+        week_date_strs = [d.strftime('%Y-%m-%d') for d in dates]
+        snap.completed_events_week = (
+            Event.query
+            .filter_by(user_id=user_id, is_notified=True)
+            .filter(Event.date.in_(week_date_strs))
+            .order_by(Event.date.desc(), Event.time.desc())
+            .all()
+        )
+
+        # Count online users (active in last 5 minutes) — at least 1 for the current user
+        snap.online_users = max(presence.online_count(), 1)
+
+        snap.quests = DashboardService._build_quests(today_completed, snap.today_study_mins)
+
+        # --- Weekly chart ---
+        daily_stats = []
+        total_focus_week = total_tasks_week = total_goals_week = 0
+        for d in dates:
+            row = daily.get(d)
+            d_focus = row.study_minutes if row else 0
+            d_tasks = row.tasks_completed if row else 0
+            d_goals = row.goals_completed if row else 0
+            total_focus_week += d_focus
+            total_tasks_week += d_tasks
+            total_goals_week += d_goals
+            # Normalize for chart (Max 4 hours focus = 100%, Max 5 tasks = 100%)
+            daily_stats.append({
+                'day': d.strftime('%a'),
+                'focus_pct': int(min((d_focus / 240) * 100, 100)),
+                'task_pct': int(min((d_tasks / 5) * 100, 100)),
+                'focus_mins': d_focus,
+                'task_count': d_tasks
+            })
+        snap.weekly_stats = {
+            'total_focus': total_focus_week,
+            'total_tasks': total_tasks_week,
+            'total_goals': total_goals_week,
+            'chart': daily_stats
+        }
 
-    completion_percent = int((completed_todos / total_todos) * 100) if total_todos else 0
+        # --- Habits ---
+        snap.habits = Habit.query.filter_by(user_id=user_id).all()
+        if snap.habits:
+            snap.today_log_ids = {
+                habit_id for (habit_id,) in db.session.query(HabitLog.habit_id).filter(
+                    HabitLog.habit_id.in_([h.id for h in snap.habits]),
+                    HabitLog.completed_date == local_today
+                ).all()
+            }
 
-    topic_rows = (
-        TopicProficiency.query
-        .filter_by(user_id=current_user.id)
-        .order_by(TopicProficiency.updated_at.desc())
-        .limit(6)
-        .all()
-    )
-    avg_proficiency = (
-        db.session.query(db.func.coalesce(db.func.avg(TopicProficiency.proficiency), 0))
-        .filter(TopicProficiency.user_id == current_user.id)
-        .scalar()
-    )
-    avg_proficiency = int(round(avg_proficiency or 0))
-    topics_covered = TopicProficiency.query.filter_by(user_id=current_user.id).count()
+        # --- Important items ---
+        now_ist = datetime.now(IST)
+        today_str = now_ist.strftime('%Y-%m-%d')
+        time_str = now_ist.strftime('%H:%M')
 
-    recent_todos = (
-        Todo.query
-        .filter_by(user_id=current_user.id)
-        .order_by(Todo.created_at.desc())
-        .limit(5)
-        .all()
-    )
-    upcoming_todos = (
-        Todo.query
-        .filter_by(user_id=current_user.id, completed=False)
-        .order_by(Todo.id.desc())
-        .limit(5)
-        .all()
-    )
+        # Next event today or in the future (NULL time = all-day event)
+        snap.important_event = Event.query.filter(
+            Event.user_id == user_id,
+            Event.date >= today_str
+        ).filter(
+            db.or_(
+                Event.date > today_str,
+                db.and_(Event.date == today_str, db.or_(Event.time >= time_str, Event.time == None, Event.time == ''))
+            )
+        ).order_by(Event.date.asc(), Event.time.asc()).first()
 
-    # -------------------------
-    # COMPLETED PARENT TASKS
-    # (Categories where every subtask is done)
-    # -------------------------
-    all_user_todos = Todo.query.filter_by(user_id=current_user.id).all()
-    cat_map = {}
-    for t in all_user_todos:
-        cat = t.category if (t.category and t.category.strip()) else None
-        if not cat: continue
-        if cat not in cat_map:
-            cat_map[cat] = []
-        cat_map[cat].append(t)
-    
-    completed_parent_tasks = []
-    today_utc = datetime.utcnow()
-    start_of_week = today_utc - timedelta(days=today_utc.weekday())
-    start_of_week = start_of_week.replace(hour=0, minute=0, second=0, microsecond=0)
-
-    for cat, tasks in cat_map.items():
-        if all(tk.completed for tk in tasks):
-            # Check if at least one was completed this week
-            # Or if it's a recently finished project
-            recent_completion = any(tk.completed_at and tk.completed_at >= start_of_week for tk in tasks)
-            if recent_completion:
-                completed_parent_tasks.append(cat)
-
-    # -------------------------
-    # WEEKLY COMPLETED EVENTS
-    # -------------------------
-    today_date = datetime.utcnow().date()
-    start_of_week_date = today_date - timedelta(days=today_date.weekday())
-    week_date_strs = [(start_of_week_date + timedelta(days=i)).strftime('%Y-%m-%d') for i in range(7)]
-    
-    completed_events_week = (
-        Event.query
-        .filter_by(user_id=current_user.id, is_notified=True)
-        .filter(Event.date.in_(week_date_strs))
-        .order_by(Event.date.desc(), Event.time.desc())
-        .all()
-    )
-    
-    
-    # Count online users (active in last 5 minutes)
-    online_threshold = datetime.utcnow() - timedelta(minutes=5)
-    online_users = User.query.filter(User.last_seen >= online_threshold).count()
-    # Add at least 1 for current user
-    if online_users < 1:
-        online_users = 1
-    
-    # Daily Quests (simple example quests based on user activity)
-    quests = []
-    # Quest 1: Complete 3 tasks today
-    today_completed = Todo.query.filter_by(user_id=current_user.id, completed=True).filter(
-        db.func.date(Todo.created_at) == datetime.utcnow().date()
-    ).count()
-    quests.append({
-        'description': 'Complete 3 tasks',
-        'icon': 'fa-check-circle',
-        'xp_reward': 50,
-        'progress': min(today_completed, 3),
-        'target': 3,
-        'completed': today_completed >= 3
-    })
-    
-    # Quest 2: Study for 30 minutes
-    today_study_mins = (
-        db.session.query(db.func.coalesce(db.func.sum(StudySession.duration), 0))
-        .filter(StudySession.user_id == current_user.id)
-        .filter(db.func.date(StudySession.completed_at) == datetime.utcnow().date())
-        .scalar()
-    ) or 0
-    quests.append({
-        'description': 'Study for 30 minutes',
-        'icon': 'fa-clock',
-        'xp_reward': 75,
-        'progress': min(today_study_mins, 30),
-        'target': 30,
-        'completed': today_study_mins >= 30
-    })
-    
-    # Quest 3: Log in daily (always complete if you're seeing this)
-    # Quest 3: Log in daily (always complete if you're seeing this)
-    quests.append({
-        'description': 'Log in today',
-        'icon': 'fa-door-open',
-        'xp_reward': 25,
-        'progress': 1,
-        'target': 1,
-        'completed': True
-    })
+        # High priority uncompleted task, falling back to the next due task
+        snap.important_todo = Todo.query.filter_by(
+            user_id=user_id,
+            completed=False,
+            priority='high'
+        ).order_by(Todo.id.desc()).first()
+        if not snap.important_todo:
+            snap.important_todo = Todo.query.filter(
+                Todo.user_id == user_id,
+                Todo.completed == False,
+                Todo.due_date != None,
+                Todo.due_date >= today_str
+            ).order_by(Todo.due_date.asc()).first()
+            if snap.important_todo:
+                snap.important_todo_label = "Upcoming Task"
+
+        return snap
+
+
+@app.cli.command('bench-dashboard-queries')
+@click.option('--sizes', default='1,50,500', help='Comma-separated rows per table for each throwaway user.')
+def bench_dashboard_queries_command(sizes):
+    """
+    Check that DashboardService.build_snapshot runs the same number of SQL
+    statements no matter how much data a user has. Creates throwaway users
+    with growing amounts of todos / sessions / habits / events, counts
+    statements with a before_cursor_execute listener, and exits non-zero if
+    the count grows. Run against a development database.
+    """
+    sizes = sorted({max(1, int(n)) for n in sizes.split(',') if n.strip()})
+    now = datetime.utcnow()
+    local_today = DailyStatsService.local_date(now)
+    user_ids = []
+
+    def seed(n):
+        user = User(email=f"bench-{uuid.uuid4().hex[:8]}@example.invalid", first_name='Bench',
+                    last_name='Dashboard', total_xp=0, level=1)
+        db.session.add(user)
+        db.session.flush()
+        uid = user.id
+        user_ids.append(uid)
+        db.session.execute(Todo.__table__.insert(), [{
+            'user_id': uid, 'title': f"Task {i}", 'completed': i % 2 == 0, 'priority': 'high' if i % 5 == 0 else 'medium',
+            'category': f"Chapter {i % 10}", 'is_group': False, 'created_at': now - timedelta(days=i % 14),
+            'completed_at': now - timedelta(days=i % 14) if i % 2 == 0 else None,
+            'due_date': (local_today + timedelta(days=i % 10)).strftime('%Y-%m-%d'),
+        } for i in range(n)])
+        db.session.execute(StudySession.__table__.insert(), [{
+            'user_id': uid, 'duration': 25, 'mode': 'focus', 'completed_at': now - timedelta(hours=i % 200)
+        } for i in range(n)])
+        db.session.execute(Event.__table__.insert(), [{
+            'user_id': uid, 'title': f"Event {i}", 'date': (local_today + timedelta(days=i % 30)).strftime('%Y-%m-%d')
+        } for i in range(n)])
+        db.session.execute(TopicProficiency.__table__.insert(), [{
+            'user_id': uid, 'topic_name': f"Topic {i}", 'proficiency': i % 100
+        } for i in range(n)])
+        for i in range(max(1, n // 10)):
+            habit = Habit(user_id=uid, title=f"Habit {i}")
+            db.session.add(habit)
+            db.session.flush()
+            db.session.execute(HabitLog.__table__.insert(), [
+                {'habit_id': habit.id, 'completed_date': local_today - timedelta(days=d)} for d in range(7)
+            ])
+        for d in range(7):
+            DailyStatsService.bump(uid, when=local_today - timedelta(days=d), study_minutes=n, focus_minutes=n,
+                                   tasks_completed=n // 2, habits_done=max(1, n // 10))
+        db.session.commit()
+        return uid
 
-    # -------------------------
-    # WEEKLY STATS CALCULATION
-    # -------------------------
-    today = datetime.utcnow().date()
-    # Align to current week (Monday - Sunday)
-    start_of_week = today - timedelta(days=today.weekday()) 
-    dates = [start_of_week + timedelta(days=i) for i in range(7)]
-    
-    daily_stats = []
-    total_focus_week = 0
-    total_tasks_week = 0
-    total_goals_week = 0 
-    
-    for d in dates:
-        # 1. Daily Focus Mins
-        d_focus = db.session.query(db.func.sum(StudySession.duration)).filter(
-            StudySession.user_id == current_user.id,
-            db.func.date(StudySession.completed_at) == d
-        ).scalar() or 0
-        
-        # 2. Daily Tasks Completed (Using real completed_at)
-        d_tasks = Todo.query.filter(
-            Todo.user_id == current_user.id,
-            Todo.completed == True,
-            db.func.date(Todo.completed_at) == d
-        ).count()
-        
-        # 3. Daily Goals (High Priority Completed)
-        d_goals = Todo.query.filter(
-            Todo.user_id == current_user.id,
-            Todo.completed == True,
-            Todo.priority == 'high',
-            db.func.date(Todo.completed_at) == d
-        ).count()
-        
-        total_focus_week += d_focus
-        total_tasks_week += d_tasks
-        total_goals_week += d_goals
-        
-        # Normalize for chart (Max 4 hours focus = 100%, Max 5 tasks = 100%)
-        focus_pct = min((d_focus / 240) * 100, 100) # 4 hours max bar
-        task_pct = min((d_tasks / 5) * 100, 100)    # 5 tasks max bar
-        
-        daily_stats.append({
-            'day': d.strftime('%a'),
-            'focus_pct': int(focus_pct),
-            'task_pct': int(task_pct),
-            'focus_mins': d_focus,
-            'task_count': d_tasks
-        })
+    statements = []
 
-    weekly_stats = {
-        'total_focus': total_focus_week,
-        'total_tasks': total_tasks_week,
-        'total_goals': total_goals_week,
-        'chart': daily_stats
-    }
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
 
-    # -------------------------
-    # HABIT TRACKER DATA
-    # -------------------------
-    # Get all active habits
-    habits = Habit.query.filter_by(user_id=current_user.id).all()
-    
-    # Get logged habits for today
-    today_logs = HabitLog.query.filter(
-        HabitLog.habit_id.in_([h.id for h in habits]),
-        HabitLog.completed_date == datetime.utcnow().date()
-    ).all()
-    today_log_ids = {log.habit_id for log in today_logs}
+    results = []
+    try:
+        seeded = [(n, seed(n)) for n in sizes]
+        DashboardService.build_snapshot(seeded[0][1])  # Warm-up (one-time loads don't count)
+        db.session.rollback()
+        sa_event.listen(db.engine, 'before_cursor_execute', count_statement)
+        try:
+            for n, uid in seeded:
+                statements.clear()
+                DashboardService.build_snapshot(uid)
+                results.append((n, len(statements)))
+                db.session.rollback()
+        finally:
+            sa_event.remove(db.engine, 'before_cursor_execute', count_statement)
+    finally:
+        # Clean up the throwaway users
+        habit_ids = [h for (h,) in db.session.query(Habit.id).filter(Habit.user_id.in_(user_ids))]
+        if habit_ids:
+            HabitLog.query.filter(HabitLog.habit_id.in_(habit_ids)).delete(synchronize_session=False)
+        for model in (Habit, Todo, StudySession, Event, TopicProficiency, UserDailyStats):
+            model.query.filter(model.user_id.in_(user_ids)).delete(synchronize_session=False)
+        User.query.filter(User.id.in_(user_ids)).delete(synchronize_session=False)
+        db.session.commit()
+        for uid in user_ids:
+            rank_index.remove(uid)
 
-    # Calculate Weekly Progress (Mon-Sun) - Habit Completion %
-    habit_chart = []
-    total_habits_count = len(habits)
-    
-    # -------------------------
-    # IMPORTANT ITEMS (For Important Card)
-    # -------------------------
-    now_ist = datetime.now(IST)
-    today_str = now_ist.strftime('%Y-%m-%d')
-    time_str = now_ist.strftime('%H:%M')
+    for n, count in results:
+        print(f"[Bench] {n:>6} rows per table: {count} statements")
+    ok = len({count for _, count in results}) == 1
+    print(f"[Bench] dashboard query count {'constant: OK' if ok else 'grows with data: FAILED'}")
+    if not ok:
+        raise SystemExit(1)
 
-    # Next event today or in the future
-    # Handle NULL time by assuming it's an all-day event (so '00:00')
-    important_event = Event.query.filter(
-        Event.user_id == current_user.id,
-        Event.date >= today_str
-    ).filter(
-        # Logic: If date > today, any time is fine. If date == today, time must be >= now OR null (all day)
-        db.or_(
-            Event.date > today_str,
-            db.and_(Event.date == today_str, db.or_(Event.time >= time_str, Event.time == None, Event.time == ''))
-        )
-    ).order_by(Event.date.asc(), Event.time.asc()).first()
 
-    # High priority uncompleted task
-    important_todo = Todo.query.filter_by(
-        user_id=current_user.id,
-        completed=False,
-        priority='high'
-    ).order_by(Todo.id.desc()).first()
+# ============================================================================
+# DASHBOARD (Main App Interface)
+# ============================================================================
 
-    important_todo_label = "High Priority Task"
+@app.route('/dashboard')
+@login_required
+def dashboard():
+    # Redirect admins to admin panel
+    if current_user.is_admin:
+        return redirect(url_for('admin_dashboard'))
     
-    # Fallback: If no high priority task, show next due task
-    if not important_todo:
-        important_todo = Todo.query.filter(
-            Todo.user_id == current_user.id,
-            Todo.completed == False,
-            Todo.due_date != None,
-            Todo.due_date >= today_str
-        ).order_by(Todo.due_date.asc()).first()
-        
-        if important_todo:
-            important_todo_label = "Upcoming Task"
-             
-
-    return render_template(
-        'dashboard.html',
-        total_todos=total_todos,
-        completed_todos=completed_todos,
-        remaining_todos=remaining_todos,
-        weekly_hours=weekly_hours,
-        completion_percent=completion_percent,
-        avg_proficiency=avg_proficiency,
-        topics_covered=topics_covered,
-        topic_rows=topic_rows,
-        recent_todos=recent_todos,
-        upcoming_todos=upcoming_todos,
-        online_users=online_users,
-        quests=quests,
-        today_study_mins=today_study_mins,
-        weekly_stats=weekly_stats,
-        habits=habits,
-        today_log_ids=today_log_ids,
-        habit_chart=habit_chart,
-        completed_parent_tasks=completed_parent_tasks,
-        completed_events_week=completed_events_week,
-        important_event=important_event,
-        important_todo=important_todo,
-        important_todo_label=important_todo_label
-    )
+    # Dashboard logic starts here (all aggregation lives in DashboardService)
+    snapshot = DashboardService.build_snapshot(current_user.id)
+    return render_template('dashboard.html', **snapshot.as_context())
 
 @app.route('/chat')
 @login_required
@@ -2912,6 +5492,18 @@ def chat_send():
         db.session.add(user_msg)
         db.session.commit()
 
+        # Streaming mode: reply arrives as chat_token events on the user's room
+        if data.get('stream'):
+            try:
+                stream_id = ChatStreamService.start(current_user, content, data.get('stream_id'))
+            except AIGatewayBusy as e:
+                return jsonify({'status': 'error', 'message': str(e)}), 503
+            return jsonify({
+                'status': 'streaming',
+                'stream_id': stream_id,
+                'user_timestamp': to_ist_time(user_msg.created_at)
+            }), 202
+
         # Generate AI response (Context Aware)
         reply = ChatService.generate_chat_response(current_user, content)
         
@@ -2919,6 +5511,7 @@ def chat_send():
         ai_msg = ChatMessage(user_id=current_user.id, role='assistant', content=reply, is_group=False)
         db.session.add(ai_msg)
         db.session.commit()
+        ChatSummaryService.maybe_refresh(current_user.id)
         
         # Return response with IST timestamps
         return jsonify({
@@ -2944,9 +5537,16 @@ def chat_send():
     reply = ChatService.personal_reply(current_user, content)
     db.session.add(ChatMessage(user_id=current_user.id, role='assistant', content=reply, is_group=False))
     db.session.commit()
+    ChatSummaryService.maybe_refresh(current_user.id)
 
     return redirect(url_for('chat'))
 
+@socketio.on('chat_cancel')
+def handle_chat_cancel(data):
+    """Stop a streaming chat reply; whatever was generated so far is saved."""
+    if current_user.is_authenticated and isinstance(data, dict):
+        ChatStreamService.cancel(current_user.id, str(data.get('stream_id') or ''))
+
 # ----------------------------------------------------
 # USER SUPPORT CENTER
 # ----------------------------------------------------
@@ -3000,6 +5600,7 @@ def support_detail(ticket_id):
         if unread_msgs:
             ticket.user_unread_count = 0
             db.session.commit()
+            invalidate_support_context(ticket.user_id)
 
     messages = SupportMessage.query.filter_by(ticket_id=ticket.id).order_by(SupportMessage.created_at.asc()).all()
     return render_template('support/detail.html', ticket=ticket, messages=messages)
@@ -3050,6 +5651,166 @@ class ActivePowerUp(db.Model):
             return False
         return datetime.utcnow() > self.expires_at
 
+
+class PowerUpCache:
+    """
+    Per-user cache of active power-up effects + background expiry sweeper.
+
+    DS concept:
+    - Hash map user_id -> {'xp', 'time', 'protection', 'boost', 'expires_at'}
+      where expires_at is the earliest expiry among the user's power-ups, so
+      a cached state is reloaded as soon as any of them runs out
+    - Min-heap of (expires_at, power_up_row_id, user_id): the sweeper pops
+      everything that is due, in time order, and deactivates it with one
+      bulk UPDATE instead of flipping rows inside unrelated transactions
+
+    ShopService.buy_item calls activated() after committing a new power-up.
+    """
+
+    SWEEP_MAX_SLEEP = 300  # seconds between checks when nothing is due sooner
+    SWEEP_RETRY = 30
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._states = {}
+        self._heap = []
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def _empty_state():
+        return {'xp': 1.0, 'time': 1.0, 'protection': False, 'boost': None, 'expires_at': None}
+
+    @staticmethod
+    def _load(user_ids):
+        """Effect states for the given users from one query over their unexpired power-ups."""
+        states = {uid: PowerUpCache._empty_state() for uid in user_ids}
+        powerups = ActivePowerUp.query.filter(
+            ActivePowerUp.user_id.in_(list(states)),
+            ActivePowerUp.is_active == True,
+            db.or_(ActivePowerUp.expires_at.is_(None), ActivePowerUp.expires_at > datetime.utcnow())
+        ).all()
+        for powerup in powerups:
+            state = states[powerup.user_id]
+            if powerup.expires_at and (state['expires_at'] is None or powerup.expires_at < state['expires_at']):
+                state['expires_at'] = powerup.expires_at
+
+            cat_item = ShopService.ITEMS.get(powerup.power_up_id)
+            if not cat_item:
+                continue
+            effect = cat_item.get('effect')
+            if effect in ['xp_multiplier', 'mega_xp_multiplier']:
+                if powerup.multiplier > state['xp']:
+                    state['xp'] = powerup.multiplier
+                    state['boost'] = powerup.power_up_id
+            elif effect == 'time_multiplier':
+                state['time'] = max(state['time'], powerup.multiplier)
+            elif effect == 'xp_protection':
+                state['protection'] = True
+        return states
+
+    def get_many(self, user_ids):
+        """user_id -> copy of the effect state. Cache misses are loaded together in one query."""
+        now = datetime.utcnow()
+        result, missing = {}, []
+        with self._lock:
+            for uid in set(user_ids):
+                state = self._states.get(uid)
+                if state is not None and (state['expires_at'] is None or state['expires_at'] > now):
+                    result[uid] = dict(state)
+                else:
+                    missing.append(uid)
+        if missing:
+            loaded = self._load(missing)
+            with self._lock:
+                self._states.update(loaded)
+            result.update({uid: dict(state) for uid, state in loaded.items()})
+        return result
+
+    def get(self, user_id):
+        return self.get_many([user_id])[user_id]
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._states.pop(user_id, None)
+
+    def activated(self, powerup):
+        """A power-up was committed: drop the user's cached state and schedule its expiry."""
+        self.invalidate(powerup.user_id)
+        if powerup.expires_at:
+            with self._lock:
+                heapq.heappush(self._heap, (powerup.expires_at, powerup.id, powerup.user_id))
+                is_next = self._heap[0][1] == powerup.id
+            if is_next:
+                self._wakeup.set()  # Sweeper may be sleeping past this expiry
+
+    def seed(self):
+        """Schedule every active power-up that has an expiry (after a restart the heap is empty)."""
+        try:
+            with app.app_context():
+                rows = db.session.query(ActivePowerUp.expires_at, ActivePowerUp.id, ActivePowerUp.user_id).filter(
+                    ActivePowerUp.is_active == True,
+                    ActivePowerUp.expires_at.isnot(None)
+                ).all()
+                db.session.remove()
+        except Exception as e:
+            print(f"[PowerUps] Seed skipped: {e}")
+            return 0
+        with self._lock:
+            self._heap.extend(tuple(row) for row in rows)
+            heapq.heapify(self._heap)
+        return len(rows)
+
+    def sweep(self):
+        """Deactivate every due power-up in one UPDATE. Returns seconds until the next check."""
+        now = datetime.utcnow()
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                due.append(heapq.heappop(self._heap))
+            next_at = self._heap[0][0] if self._heap else None
+
+        if due:
+            try:
+                with app.app_context():
+                    ActivePowerUp.query.filter(
+                        ActivePowerUp.id.in_([powerup_id for _, powerup_id, _ in due]),
+                        ActivePowerUp.is_active == True
+                    ).update({'is_active': False}, synchronize_session=False)
+                    db.session.commit()
+                    db.session.remove()
+            except Exception as e:
+                print(f"[PowerUps] Sweep failed ({len(due)} power-ups): {e}")
+                with self._lock:
+                    for entry in due:
+                        heapq.heappush(self._heap, entry)
+                return self.SWEEP_RETRY
+            for _, _, uid in due:
+                self.invalidate(uid)
+            print(f"[PowerUps] Deactivated {len(due)} expired power-ups")
+
+        if next_at is None:
+            return self.SWEEP_MAX_SLEEP
+        return min(self.SWEEP_MAX_SLEEP, max(1, (next_at - now).total_seconds()))
+
+    def _run(self):
+        self.seed()
+        delay = 0
+        while True:
+            self._wakeup.wait(delay)
+            self._wakeup.clear()
+            delay = self.sweep()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True, name="powerup-sweeper")
+            self._thread.start()
+
+
+powerup_cache = PowerUpCache()
+powerup_cache.start()
+
+
 class ShopService:
     # Hardcoded catalog for now
     ITEMS = {
@@ -3148,82 +5909,114 @@ class ShopService:
         }
     }
 
+    # Inventory rows that may repeat (stacked consumables); everything else
+    # is owned at most once — enforced by the uq_user_item_owned index below.
+    STACKABLE_ITEM_IDS = ('streak_freeze',)
+
+    # Duration-based power-ups: effect -> multiplier stored on ActivePowerUp
+    POWER_UP_MULTIPLIERS = {
+        'xp_multiplier': 2.0,
+        'mega_xp_multiplier': 5.0,
+        'time_multiplier': 2.0,
+        'xp_protection': 0.0,  # Special case - prevents XP loss
+    }
+
+    @staticmethod
+    def _spend_stmt(user_id, price, bonus_xp=0):
+        """Guarded spend: UPDATE ... SET total_xp = total_xp - price WHERE total_xp >= price."""
+        values = {'total_xp': User.total_xp - price + bonus_xp}
+        if bonus_xp:
+            computed_level = (User.total_xp - price + bonus_xp) // XPLedger.XP_PER_LEVEL + 1
+            values['level'] = db.case((computed_level > User.level, computed_level), else_=User.level)
+        return db.update(User).where(
+            User.id == user_id,
+            User.total_xp >= price
+        ).values(**values).returning(
+            User.total_xp, User.level
+        ).execution_options(synchronize_session=False)
+
     @staticmethod
     def buy_item(user: User, item_id: str):
+        """
+        One transaction: (inventory INSERT) + guarded UPDATE ... RETURNING + COMMIT.
+
+        The unique index rejects a second copy of a non-consumable and the
+        WHERE total_xp >= price guard rejects overspending, so concurrent
+        double-clicks can't double-buy or double-spend.
+        """
         item = ShopService.ITEMS.get(item_id)
         if not item:
             return {'status': 'error', 'message': 'Item not found.'}
-        
-        # Check ownership (unless consumable)
-        if item['type'] != 'consumable':
-            owned = UserItem.query.filter_by(user_id=user.id, item_id=item_id).first()
-            if owned:
-                return {'status': 'error', 'message': 'You already own this item!'}
 
-        # Check funds
-        if user.total_xp < item['price']:
-            needed = item['price'] - user.total_xp
-            return {'status': 'error', 'message': f"Short on funds! You need {needed} more XP to unlock this."}
+        price = item['price']
+        effect = item.get('effect') if item['type'] == 'consumable' else None
+        power_up = None
 
-        # Deduct XP
-        user.total_xp -= item['price']
-        
-        # Handle Consumables (Power-Ups)
-        if item['type'] == 'consumable':
-            effect = item.get('effect')
-            
-            if effect == 'instant_level':
-                # Instant Level Up - Add 500 XP to level up
-                user.total_xp += 500
-                old_level = user.level
-                user.level = GamificationService.calculate_level(user.total_xp)
-                db.session.commit()
-                return {'status': 'success', 'message': f"Level Up! You are now level {user.level}! 🎉", 'new_xp': user.total_xp}
-            
-            elif effect in ['xp_multiplier', 'mega_xp_multiplier', 'time_multiplier', 'xp_protection']:
-                # Duration-based power-ups
+        try:
+            # 1. Inventory / power-up row (non-consumables hit uq_user_item_owned if already owned)
+            if effect in ShopService.POWER_UP_MULTIPLIERS:
                 duration = item.get('duration', 86400)  # Default 24 hours
-                expires_at = datetime.utcnow() + timedelta(seconds=duration)
-                
-                # Determine multiplier
-                if effect == 'xp_multiplier':
-                    multiplier = 2.0
-                elif effect == 'mega_xp_multiplier':
-                    multiplier = 5.0
-                elif effect == 'time_multiplier':
-                    multiplier = 2.0
-                else:  # xp_protection
-                    multiplier = 0.0  # Special case - prevents XP loss
-                
-                # Create active power-up
                 power_up = ActivePowerUp(
                     user_id=user.id,
                     power_up_id=item_id,
                     activated_at=datetime.utcnow(),
-                    expires_at=expires_at,
-                    multiplier=multiplier,
+                    expires_at=datetime.utcnow() + timedelta(seconds=duration),
+                    multiplier=ShopService.POWER_UP_MULTIPLIERS[effect],
                     is_active=True
                 )
                 db.session.add(power_up)
-                db.session.commit()
-                
-                # Calculate hours remaining
-                hours = duration / 3600
-                return {'status': 'success', 'message': f"{item['name']} activated! Effect lasts for {int(hours)} hours. ⚡", 'new_xp': user.total_xp}
-            
-            else:
-                # Unknown effect - just store as item
-                new_item = UserItem(user_id=user.id, item_id=item_id)
-                db.session.add(new_item)
-                db.session.commit()
-                return {'status': 'success', 'message': f"Purchased {item['name']}!", 'new_xp': user.total_xp}
-        
-        # Handle Themes and Frames
-        new_item = UserItem(user_id=user.id, item_id=item_id)
-        db.session.add(new_item)
+                db.session.flush()
+            elif effect != 'instant_level':
+                db.session.execute(UserItem.__table__.insert().values(
+                    user_id=user.id, item_id=item_id, purchased_at=datetime.utcnow(), is_active=False
+                ))
+
+            # 2. Spend (Instant Level Up adds 500 XP in the same statement)
+            bonus_xp = 500 if effect == 'instant_level' else 0
+            row = db.session.execute(ShopService._spend_stmt(user.id, price, bonus_xp)).first()
+            if row is None:
+                db.session.rollback()
+                balance = db.session.query(User.total_xp).filter_by(id=user.id).scalar() or 0
+                needed = max(0, price - balance)
+                return {'status': 'error', 'message': f"Short on funds! You need {needed} more XP to unlock this."}
+
+            db.session.commit()
+        except sa_exc.IntegrityError:
+            db.session.rollback()
+            return {'status': 'error', 'message': 'You already own this item!'}
+
+        rank_index.update_score(user.id, row.level, row.total_xp)
+
+        if effect == 'instant_level':
+            return {'status': 'success', 'message': f"Level Up! You are now level {row.level}! 🎉", 'new_xp': row.total_xp}
+        if power_up is not None:
+            powerup_cache.activated(power_up)
+            hours = item.get('duration', 86400) / 3600
+            return {'status': 'success', 'message': f"{item['name']} activated! Effect lasts for {int(hours)} hours. ⚡", 'new_xp': row.total_xp}
+        return {'status': 'success', 'message': f"Purchased {item['name']}!", 'new_xp': row.total_xp}
+
+    @staticmethod
+    def ensure_ownership_index():
+        """
+        Create uq_user_item_owned on existing databases (create_all only covers
+        new tables). Duplicate non-stackable rows left by earlier double-clicks
+        are collapsed first, keeping the active copy if there is one.
+        """
+        duplicates = db.session.query(UserItem.user_id, UserItem.item_id).filter(
+            UserItem.item_id.notin_(ShopService.STACKABLE_ITEM_IDS)
+        ).group_by(UserItem.user_id, UserItem.item_id).having(db.func.count(UserItem.id) > 1).all()
+        removed = 0
+        for user_id, item_id in duplicates:
+            rows = UserItem.query.filter_by(user_id=user_id, item_id=item_id)\
+                .order_by(UserItem.is_active.desc(), UserItem.id.asc()).all()
+            for extra in rows[1:]:
+                db.session.delete(extra)
+                removed += 1
         db.session.commit()
-        
-        return {'status': 'success', 'message': f"Purchased {item['name']}!", 'new_xp': user.total_xp}
+        db.session.execute(CreateIndex(uq_user_item_owned, if_not_exists=True))
+        db.session.commit()
+        if removed:
+            print(f"[Shop] Removed {removed} duplicate inventory rows")
 
     @staticmethod
     def equip_item(user: User, item_id: str):
@@ -3257,6 +6050,7 @@ class ShopService:
             # Activate new
             owned.is_active = True
             db.session.commit()
+            CosmeticsService.invalidate(user)
             return {'status': 'success', 'message': f"Equipped {item['name']}!"}
 
         if item['type'] == 'frame':
@@ -3276,11 +6070,71 @@ class ShopService:
             # Activate new
             owned.is_active = True
             db.session.commit()
+            CosmeticsService.invalidate(user)
             return {'status': 'success', 'message': f"Equipped {item['name']}!"}
 
         return {'status': 'error', 'message': 'This item cannot be equipped.'}
 
 
+# One copy per (user, item) for everything except stackable consumables.
+# Partial index so repeated streak_freeze rows stay allowed.
+_owned_item_filter = UserItem.item_id.notin_(ShopService.STACKABLE_ITEM_IDS)
+uq_user_item_owned = db.Index(
+    'uq_user_item_owned', UserItem.user_id, UserItem.item_id,
+    unique=True,
+    postgresql_where=_owned_item_filter,
+    sqlite_where=_owned_item_filter
+)
+
+
+@app.cli.command('stress-purchase')
+@click.option('--threads', type=int, default=50, help='Parallel buy attempts.')
+@click.option('--item-id', default='theme_aurora', help='Non-consumable item to buy.')
+def stress_purchase_command(threads, item_id):
+    """
+    Concurrency check for ShopService.buy_item: fire N parallel buys of one
+    item for a throwaway user and verify a single copy and a single charge.
+    Run against a development database.
+    """
+    item = ShopService.ITEMS[item_id]
+    starting_xp = item['price'] * 3
+    user = User(email=f"stress-{uuid.uuid4().hex[:8]}@example.invalid", first_name='Stress',
+                last_name='Test', total_xp=starting_xp, level=1)
+    db.session.add(user)
+    db.session.commit()
+    user_id = user.id
+
+    barrier = threading.Barrier(threads)
+    outcomes = []
+
+    def attempt():
+        with app.app_context():
+            buyer = db.session.get(User, user_id)
+            barrier.wait()
+            outcomes.append(ShopService.buy_item(buyer, item_id)['status'])
+            db.session.remove()
+
+    workers = [threading.Thread(target=attempt) for _ in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+
+    db.session.expire_all()
+    copies = UserItem.query.filter_by(user_id=user_id, item_id=item_id).count()
+    balance = db.session.get(User, user_id).total_xp
+    ok = outcomes.count('success') == 1 and copies == 1 and balance == starting_xp - item['price']
+    print(f"[Shop] {threads} parallel buys: {outcomes.count('success')} succeeded, "
+          f"{copies} copies, balance {starting_xp} -> {balance}: {'OK' if ok else 'FAILED'}")
+
+    UserItem.query.filter_by(user_id=user_id).delete()
+    User.query.filter_by(id=user_id).delete()
+    db.session.commit()
+    rank_index.remove(user_id)
+    if not ok:
+        raise SystemExit(1)
+
+
 @app.route('/shop')
 @login_required
 def shop():
@@ -3319,6 +6173,7 @@ def shop_unequip(item_id):
     if user_item:
         user_item.is_active = False
         db.session.commit()
+        CosmeticsService.invalidate(current_user._get_current_object())
         flash(f'Item unequipped successfully!', 'success')
     else:
         flash('Item not found.', 'error')
@@ -3349,12 +6204,9 @@ def group_chat():
         )
         
         # Attach online status (Active within last 5 minutes)
-        now = datetime.utcnow()
-
         for m in members:
-            # If last_seen is None, assume offline.
-            # 5 minutes threshold
-            if m.last_seen and (now - m.last_seen).total_seconds() < 300:
+            # Buffered activity first, DB column as fallback (None = offline)
+            if presence.is_online(m.id, m.last_seen):
                 m.is_online_status = True
                 online_count += 1
             else:
@@ -3550,22 +6402,10 @@ def inject_gamification():
         next_level_xp = current_user.level * 500
         progress_percent = int(((current_user.total_xp % 500) / 500) * 100)
         
-        # Get active theme
-        active_theme_item = (
-            db.session.query(UserItem)
-            .filter_by(user_id=current_user.id, is_active=True)
-            .all()
-        )
-        
-        active_theme = None
-        active_frame = None
-        for u_item in active_theme_item:
-             # Find the first active item that is a 'theme'
-             cat_item = ShopService.ITEMS.get(u_item.item_id)
-             if cat_item and cat_item['type'] == 'theme':
-                 active_theme = u_item.item_id
-             elif cat_item and cat_item['type'] == 'frame':
-                 active_frame = u_item.item_id
+        # Get active theme / frame (cached per user, invalidated on equip/unequip)
+        cosmetics = CosmeticsService.for_user(current_user._get_current_object())
+        active_theme = cosmetics['theme']
+        active_frame = cosmetics['frame']
 
         return dict(
             rank_name=rank_info['name'],
@@ -3584,13 +6424,19 @@ def inject_gamification():
 def todos_toggle(todo_id):
     todo = Todo.query.filter_by(id=todo_id, user_id=current_user.id).first_or_404()
     todo.completed = not todo.completed
+    is_goal = 1 if todo.priority == 'high' else 0
     
-    # Update timestamp
+    # Update timestamp (and the daily rollup for the day it was completed)
     if todo.completed:
         todo.completed_at = datetime.utcnow()
+        DailyStatsService.bump(current_user.id, todo.completed_at, tasks_completed=1, goals_completed=is_goal)
     else:
+        if todo.completed_at:
+            DailyStatsService.bump(current_user.id, todo.completed_at, tasks_completed=-1, goals_completed=-is_goal)
         todo.completed_at = None
     
+    proficiency_changed = False
+
     # Award XP if completing
     if todo.completed:
         GamificationService.add_xp(current_user.id, 'task', 10)
@@ -3604,6 +6450,7 @@ def todos_toggle(todo_id):
                 db.session.add(topic)
             topic.proficiency += 10
             topic.updated_at = datetime.utcnow()
+            proficiency_changed = True
             
     else:
         # Deduct XP if unchecked
@@ -3615,8 +6462,12 @@ def todos_toggle(todo_id):
             topic = TopicProficiency.query.filter_by(user_id=current_user.id, topic_name=todo.category).first()
             if topic and topic.proficiency >= 10:
                 topic.proficiency -= 10
+                proficiency_changed = True
 
     db.session.commit()
+    # After the commit, so a concurrent matrix refresh can't reload the old rows and clear the flag
+    if proficiency_changed:
+        proficiency_matrix.mark_dirty(current_user.id)
     
     next_url = request.form.get('next') or request.args.get('next')
     if next_url:
@@ -3701,20 +6552,24 @@ def pomodoro_save_session():
         
         # Award XP: 1 XP per minute of focus
         if mode == 'focus':
-            # Check for Double Time power-up to adjust stored duration
-            active_time_boost = ActivePowerUp.query.filter_by(
-                user_id=current_user.id, 
-                power_up_id='double_time',
-                is_active=True
-            ).first()
-            
-            if active_time_boost and not active_time_boost.is_expired():
+            # Check for Double Time power-up to adjust stored duration (cached effect state)
+            if powerup_cache.get(current_user.id)['time'] > 1.0:
                 study_session.duration = duration * 2
                 xp_amount = duration # add_xp will handle the multiplier
             else:
                 xp_amount = duration
-                
+
+            # Rollup + badges first so they commit together with the session (add_xp commits)
+            DailyStatsService.bump(current_user.id, study_session.completed_at,
+                                   study_minutes=study_session.duration, focus_minutes=study_session.duration)
+            focus_total = db.session.query(db.func.sum(StudySession.duration)).filter(
+                StudySession.user_id == current_user.id, StudySession.mode == 'focus'
+            ).scalar() or 0  # includes the session added above (autoflush)
+            badge_engine.evaluate([(current_user.id, 'focus_hours',
+                                    (focus_total - study_session.duration) // 60, focus_total // 60)])
             result = GamificationService.add_xp(current_user.id, 'focus', xp_amount)
+        else:
+            DailyStatsService.bump(current_user.id, study_session.completed_at, study_minutes=duration)
         
         db.session.commit()
         return jsonify({'status': 'success', 'message': 'Session saved'})
@@ -3817,7 +6672,8 @@ def habits_add():
 @login_required
 def habits_toggle(habit_id):
     habit = Habit.query.filter_by(id=habit_id, user_id=current_user.id).first_or_404()
-    today = datetime.utcnow().date()
+    # Same local (IST) day as the habits_done rollup and backfill-daily-stats
+    today = DailyStatsService.local_date()
     
     # Check if logged for today
     log = HabitLog.query.filter_by(habit_id=habit.id, completed_date=today).first()
@@ -3825,11 +6681,13 @@ def habits_toggle(habit_id):
     if log:
         # Uncheck
         db.session.delete(log)
+        DailyStatsService.bump(current_user.id, habits_done=-1)
         db.session.commit()
     else:
         # Check
         log = HabitLog(habit_id=habit.id, completed_date=today)
         db.session.add(log)
+        DailyStatsService.bump(current_user.id, habits_done=1)
         db.session.commit()
         
         # Gamification: Small XP for habit
@@ -3841,23 +6699,27 @@ def habits_toggle(habit_id):
 @login_required
 def habits_delete(habit_id):
     habit = Habit.query.filter_by(id=habit_id, user_id=current_user.id).first_or_404()
+    # Take the deleted check-ins back out of the daily rollup (one bump per local day)
+    log_counts = db.session.query(HabitLog.completed_date, db.func.count(HabitLog.id)).filter(
+        HabitLog.habit_id == habit.id
+    ).group_by(HabitLog.completed_date).all()
+    for day, count in log_counts:
+        DailyStatsService.bump(current_user.id, when=day, habits_done=-count)
     # Logs cascade delete would be better, but manual verify
     HabitLog.query.filter_by(habit_id=habit.id).delete()
     db.session.delete(habit)
     db.session.commit()
-    db.session.commit()
     return redirect(url_for('dashboard'))
 
 @app.route('/api/habits/stats', methods=['GET'])
 @login_required
 def api_habit_stats():
     """Return this week's habit completion for the chart."""
-    today = datetime.now()
+    today = DailyStatsService.local_date()
     start_of_week = today - timedelta(days=today.weekday()) # Monday
     
-    # Get all user habits
-    habits = Habit.query.filter_by(user_id=current_user.id).all()
-    total_habits = len(habits)
+    # Count user habits
+    total_habits = Habit.query.filter_by(user_id=current_user.id).count()
     
     stats = []
     days = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
@@ -3868,21 +6730,13 @@ def api_habit_stats():
             stats.append({'day': days[i], 'pct': 0})
         return jsonify(stats)
 
+    rollup = DailyStatsService.get_range(current_user.id, start_of_week, start_of_week + timedelta(days=6))
+
     for i in range(7):
-        date_obj = start_of_week + timedelta(days=i)
-        date_only = date_obj.date()
-        
-        # Count logs on this day for user's habits
-        # Join HabitLog with Habit to ensure it belongs to user
-        logs_count = (
-            HabitLog.query
-            .join(Habit)
-            .filter(Habit.user_id == current_user.id)
-            .filter(HabitLog.completed_date == date_only)
-            .count()
-        )
+        date_only = start_of_week + timedelta(days=i)
+        logs_count = rollup[date_only].habits_done if date_only in rollup else 0
         
-        pct = int((logs_count / total_habits) * 100)
+        pct = min(int((logs_count / total_habits) * 100), 100)
         stats.append({
             'day': days[i],
             'pct': pct,
@@ -3966,144 +6820,293 @@ def syllabus_restore(doc_id):
     flash(f'Restored {doc.filename} as active syllabus.', 'success')
     return redirect(url_for('syllabus'))
 
-@app.route('/syllabus/upload', methods=['POST'])
-@login_required
-def syllabus_upload():
-    """Upload and extract PDF syllabus."""
-    uploaded = request.files.get('pdf')
-    if not uploaded:
-        flash('Please select a PDF file.', 'error')
-        return redirect(url_for('syllabus'))
+# ------------------------------
+# SYLLABUS UPLOAD JOBS
+# ------------------------------
+class SyllabusExtractionCache:
+    """
+    Content-addressed cache of syllabus extraction results (SyllabusExtraction table).
 
-    filename = uploaded.filename or 'syllabus.pdf'
+    DS concept:
+    - Hash-keyed store: SHA-256(PDF bytes) -> extracted text + AI task JSON,
+      shared across users (the key says nothing about who uploaded it)
+    - LRU eviction: past MAX_ENTRIES rows, the least recently used go first;
+      rows unused for MAX_IDLE_DAYS are dropped too
+    - Hit / partial-hit / miss / eviction counters for the admin metrics
+    """
 
-    pdf_bytes = uploaded.read()
-    if not pdf_bytes:
-        flash('Uploaded PDF was empty.', 'error')
-        return redirect(url_for('syllabus'))
+    MAX_ENTRIES = int(os.getenv('SYLLABUS_CACHE_MAX_ENTRIES', 500))
+    MAX_IDLE_DAYS = int(os.getenv('SYLLABUS_CACHE_MAX_IDLE_DAYS', 90))
 
-    # AI: Extract tasks directly from the PDF using Gemini (real API).
-    tasks = []
-    try:
-        tasks = SyllabusService.extract_tasks_from_pdf(pdf_bytes)
-    except Exception as e:
-        flash(f'AI task extraction failed: {str(e)}', 'error')
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {'hits': 0, 'partial_hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
 
-    # Extract text with PyPDF2 (used as context for chat). Some PDFs (scans) may yield no text.
-    extracted = ""
-    try:
-        from PyPDF2 import PdfReader
-        reader = PdfReader(io.BytesIO(pdf_bytes))
-        parts = []
-        for page in reader.pages:
-            text = page.extract_text() or ''
-            parts.append(text)
-        extracted = "\n".join(parts).strip()
-    except Exception:
-        extracted = ""
+    def _count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
 
-    if not extracted:
-        # Keep a non-empty placeholder because SyllabusDocument.extracted_text is NOT NULL.
-        extracted = f"(No text could be extracted from this PDF. It may be a scanned document.)\nFilename: {filename}"
-        flash('PDF uploaded, but no text could be extracted (might be scanned image). Tasks can still be generated by AI.', 'error')
+    @staticmethod
+    def digest(path: str) -> str:
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                sha.update(block)
+        return sha.hexdigest()
+
+    def get(self, content_hash: str):
+        """{'text', 'tasks' (None if AI extraction must run again)} or None. Commits the LRU touch."""
+        row = db.session.get(SyllabusExtraction, content_hash)
+        if row is None:
+            self._count('misses')
+            return None
+        row.hit_count = (row.hit_count or 0) + 1
+        row.last_used_at = datetime.utcnow()
+        db.session.commit()
+        tasks = json.loads(row.tasks_json) if row.tasks_json is not None else None
+        self._count('hits' if tasks is not None else 'partial_hits')
+        return {'text': row.extracted_text or '', 'tasks': tasks}
+
+    def put(self, content_hash: str, text: str, tasks, file_size: int = None):
+        """Store (or complete) an entry, then evict. tasks=None means AI extraction failed."""
+        row = db.session.get(SyllabusExtraction, content_hash)
+        if row is None:
+            row = SyllabusExtraction(content_hash=content_hash, hit_count=0)
+            db.session.add(row)
+        row.extracted_text = text or ''
+        if tasks is not None:
+            row.tasks_json = json.dumps(tasks, separators=(',', ':'))
+        row.file_size = file_size
+        row.last_used_at = datetime.utcnow()
+        try:
+            db.session.commit()
+        except sa_exc.IntegrityError:
+            db.session.rollback()  # Same PDF stored by a concurrent job
+            return
+        self._count('stores')
+        self.evict()
+
+    def evict(self) -> int:
+        cutoff = datetime.utcnow() - timedelta(days=self.MAX_IDLE_DAYS)
+        removed = SyllabusExtraction.query.filter(SyllabusExtraction.last_used_at < cutoff).delete(synchronize_session=False)
+        overflow = SyllabusExtraction.query.count() - self.MAX_ENTRIES
+        if overflow > 0:
+            oldest = [h for (h,) in db.session.query(SyllabusExtraction.content_hash)
+                      .order_by(SyllabusExtraction.last_used_at.asc()).limit(overflow)]
+            removed += SyllabusExtraction.query.filter(SyllabusExtraction.content_hash.in_(oldest)).delete(synchronize_session=False)
+        db.session.commit()
+        if removed:
+            self._count('evictions', removed)
+        return removed
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self.counters)
+        lookups = counters['hits'] + counters['partial_hits'] + counters['misses']
+        return {
+            **counters,
+            'hit_rate': round(counters['hits'] / lookups, 3) if lookups else None,
+            'entries': SyllabusExtraction.query.count(),
+            'stored_hits': db.session.query(db.func.coalesce(db.func.sum(SyllabusExtraction.hit_count), 0)).scalar(),
+            'max_entries': self.MAX_ENTRIES,
+            'max_idle_days': self.MAX_IDLE_DAYS,
+        }
 
-    doc = SyllabusService.save_syllabus(current_user.id, filename, extracted)
 
-    # Persist AI-generated tasks into real Todos.
-    target_date_str = request.form.get('target_date')
-    target_date = None
-    days_diff = 1
-    
-    if target_date_str:
-        try:
-            target_date = datetime.strptime(target_date_str, '%Y-%m-%d')
-            today = datetime.now()
-            days_diff = (target_date - today).days
-            if days_diff <= 0:
-                 days_diff = 1 # Minimum 1 day
-        except ValueError:
-            pass
+syllabus_extraction_cache = SyllabusExtractionCache()
 
-    # Count total items to be created for distribution
-    total_items = 0
-    if tasks:
-        for task in tasks:
-            total_items += 1 # Chapter task
-            total_items += len(task.get("subtasks", []))
-            
-    items_per_day = 1
-    if total_items > 0 and days_diff > 0:
-        import math
-        items_per_day = math.ceil(total_items / days_diff)
 
-    completed_items_count = 0
-    created_count = 0
-    
-    if tasks:
-        for task in tasks:
-            chapter = str(task.get("title", "")).strip() or "Chapter"
-            subtasks = task.get("subtasks", [])
-            chapter_category = chapter[:50]
+class SyllabusUploadJobs:
+    """
+    Background pipeline for syllabus PDF uploads.
 
-            # Calculate Due Date
-            day_offset = completed_items_count // items_per_day
-            due_date_obj = datetime.now() + timedelta(days=day_offset)
-            due_date_str = due_date_obj.strftime('%Y-%m-%d') if target_date else None
-
-            # Create a parent todo for the chapter
-            chapter_title = chapter[:200]
-            exists = Todo.query.filter_by(user_id=current_user.id, title=chapter_title, category=chapter_category, is_group=False).first()
-            if not exists:
-                db.session.add(Todo(
-                    user_id=current_user.id,
-                    title=chapter_title,
-                    completed=False,
-                    priority='high', # Chapters are main goals
-                    due_date=due_date_str,
-                    category=chapter_category,
-                    is_group=False,
-                    syllabus_id=doc.id  # Link to this syllabus
-                ))
-                created_count += 1
-            
-            completed_items_count += 1
+    The upload request only streams the PDF to disk and returns a job id.
+    A job thread then runs PyPDF2 text extraction and the Gemini task
+    extraction in parallel on a small worker pool, saves the document (and
+    its retrieval chunks) and creates the Todos with one bulk insert.
+    Progress goes to the user's `user_{id}` room as `syllabus_progress`
+    and can also be polled at /syllabus/jobs/<job_id>.
 
-            if isinstance(subtasks, list):
-                for sub in subtasks:
-                    sub_title = str(sub).strip()
-                    if not sub_title:
-                        continue
-                    sub_title = sub_title[:200]
-                    
-                    # Recalculate due date for subtasks as well to distribute them
-                    day_offset = completed_items_count // items_per_day
-                    due_date_obj = datetime.now() + timedelta(days=day_offset)
-                    due_date_str = due_date_obj.strftime('%Y-%m-%d') if target_date else None
-                    
-                    exists = Todo.query.filter_by(user_id=current_user.id, title=sub_title, category=chapter_category, is_group=False).first()
-                    if exists:
+    DS concept:
+    - Hash map job_id -> job state, pruned after JOB_TTL_SECONDS
+    - Content-addressed reuse: a PDF seen before (same SHA-256) skips
+      extraction via SyllabusExtractionCache and is stored once on disk
+    - Set-based dedup of generated tasks (SyllabusService.create_todos_from_tasks)
+    """
+
+    JOB_TTL_SECONDS = 3600
+
+    def __init__(self, upload_dir, max_workers=4):
+        self.upload_dir = upload_dir
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='syllabus-job')
+        self._lock = threading.Lock()
+        self._jobs = {}  # job_id -> state dict
+
+    def submit(self, user_id: int, uploaded, target_date_str: str = None) -> str:
+        """Store the upload and queue its processing. Raises ValueError for an empty file."""
+        job_id = uuid.uuid4().hex
+        filename = (uploaded.filename or 'syllabus.pdf')[:100]
+        os.makedirs(self.upload_dir, exist_ok=True)
+        path = os.path.join(self.upload_dir, f"{user_id}_{job_id}.pdf")
+        uploaded.save(path)  # Streamed to disk, not read into request memory
+        size = os.path.getsize(path)
+        if not size:
+            os.remove(path)
+            raise ValueError('Uploaded PDF was empty.')
+
+        now = time.time()
+        with self._lock:
+            for stale in [j for j, job in self._jobs.items()
+                          if job['status'] in ('done', 'error') and now - job['created_at'] > self.JOB_TTL_SECONDS]:
+                del self._jobs[stale]
+            self._jobs[job_id] = {'user_id': user_id, 'filename': filename, 'status': 'queued', 'stage': 'queued',
+                                  'percent': 0, 'message': 'Queued', 'created_at': now}
+        threading.Thread(target=self._run, args=(job_id, user_id, filename, path, size, target_date_str), daemon=True).start()
+        return job_id
+
+    def status(self, user_id: int, job_id: str):
+        """Job state for its owner, or None."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job['user_id'] != user_id:
+                return None
+            return {k: v for k, v in job.items() if k not in ('user_id', 'created_at')}
+
+    def _progress(self, job_id, user_id, stage, percent, message, status='running', **extra):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.update(status=status, stage=stage, percent=percent, message=message, **extra)
+        socketio.emit('syllabus_progress', {
+            'job_id': job_id, 'status': status, 'stage': stage, 'percent': percent, 'message': message, **extra
+        }, room=f"user_{user_id}")
+
+    @staticmethod
+    def _extract_tasks(path):
+        with open(path, 'rb') as f:
+            return SyllabusService.extract_tasks_from_pdf(f.read())
+
+    def _store(self, path, content_hash):
+        """Keep one copy per distinct PDF: <upload_dir>/<sha256>.pdf"""
+        target = os.path.join(self.upload_dir, f"{content_hash}.pdf")
+        if os.path.exists(target):
+            os.remove(path)
+        else:
+            os.replace(path, target)
+        return target
+
+    def _run(self, job_id, user_id, filename, path, size, target_date_str):
+        try:
+            self._progress(job_id, user_id, 'extracting', 10, 'Reading your PDF...')
+            content_hash = SyllabusExtractionCache.digest(path)
+            path = self._store(path, content_hash)
+            try:
+                with app.app_context():
+                    cached = syllabus_extraction_cache.get(content_hash)
+            except Exception as e:
+                print(f"[SyllabusJob] Extraction cache lookup failed: {e}")
+                cached = None
+
+            extracted, tasks, warnings = "", [], []
+            if cached is not None and cached['tasks'] is not None:
+                extracted, tasks = cached['text'], cached['tasks']
+                self._progress(job_id, user_id, 'cached', 80, 'Same PDF processed before - reusing results')
+            else:
+                futures = {self._executor.submit(self._extract_tasks, path): 'tasks'}
+                if cached is None:
+                    futures[self._executor.submit(SyllabusService.extract_text_from_pdf, path)] = 'text'
+                else:
+                    extracted = cached['text']  # Only the AI part failed last time
+
+                ai_ok = False
+                percent = 10
+                for future in concurrent.futures.as_completed(futures):
+                    percent += 70 // len(futures)
+                    if futures[future] == 'text':
+                        extracted = future.result()
+                        self._progress(job_id, user_id, 'text', percent, 'Text extracted')
                         continue
-                    db.session.add(Todo(
-                        user_id=current_user.id,
-                        title=sub_title,
-                        completed=False,
-                        priority='medium',
-                        due_date=due_date_str,
-                        category=chapter_category,
-                        is_group=False,
-                        syllabus_id=doc.id  # Link to this syllabus
-                    ))
-                    created_count += 1
-                    completed_items_count += 1
+                    try:
+                        tasks = future.result() or []
+                        ai_ok = True
+                        self._progress(job_id, user_id, 'tasks', percent, f'AI found {len(tasks)} chapters')
+                    except Exception as e:
+                        warnings.append(f'AI task extraction failed: {str(e)}')
+                        self._progress(job_id, user_id, 'tasks', percent, 'AI task extraction failed')
+
+                try:
+                    with app.app_context():
+                        syllabus_extraction_cache.put(content_hash, extracted, tasks if ai_ok else None, size)
+                except Exception as e:
+                    print(f"[SyllabusJob] Extraction cache store failed: {e}")
+
+            self._progress(job_id, user_id, 'saving', 85, 'Saving tasks...')
+            extraction_status = 'success'
+            if not extracted:
+                # Keep a non-empty placeholder so the document still shows up as context.
+                extracted = f"(No text could be extracted from this PDF. It may be a scanned document.)\nFilename: {filename}"
+                extraction_status = 'failed'
+                warnings.append('PDF uploaded, but no text could be extracted (might be scanned image). Tasks can still be generated by AI.')
+
+            with app.app_context():
+                doc = SyllabusDocument(user_id=user_id, filename=filename, file_path=path, file_size=size,
+                                       extracted_text=extracted, extraction_status=extraction_status)
+                db.session.add(doc)
+                db.session.flush()
+                syllabus_index.build(doc)
+                created = SyllabusService.create_todos_from_tasks(user_id, doc.id, tasks, target_date_str)
+                db.session.commit()
+                doc_id = doc.id
+
+            message = f'Created {created} tasks from PDF using Gemini!' if created else 'PDF uploaded and processed successfully!'
+            self._progress(job_id, user_id, 'done', 100, message, status='done',
+                           doc_id=doc_id, created=created, warnings=warnings)
+        except Exception as e:
+            print(f"[SyllabusJob] Job {job_id} for user {user_id} failed: {e}")
+            self._progress(job_id, user_id, 'error', 100, f'Processing failed: {str(e)}', status='error')
+
+
+syllabus_jobs = SyllabusUploadJobs(
+    os.getenv('SYLLABUS_UPLOAD_DIR', os.path.join(app.instance_path, 'syllabus_uploads')),
+    max_workers=int(os.getenv('SYLLABUS_JOB_WORKERS', 4))
+)
+
+
+@app.route('/syllabus/upload', methods=['POST'])
+@login_required
+def syllabus_upload():
+    """Queue a PDF syllabus for background extraction; progress arrives over Socket.IO."""
+    wants_json = request.headers.get('X-Requested-With') == 'XMLHttpRequest'
+    uploaded = request.files.get('pdf')
+    if not uploaded:
+        if wants_json:
+            return jsonify({'status': 'error', 'message': 'Please select a PDF file.'}), 400
+        flash('Please select a PDF file.', 'error')
+        return redirect(url_for('syllabus'))
 
-        db.session.commit()
+    try:
+        job_id = syllabus_jobs.submit(current_user.id, uploaded, request.form.get('target_date'))
+    except ValueError as e:
+        if wants_json:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
+        flash(str(e), 'error')
+        return redirect(url_for('syllabus'))
 
-    if created_count > 0:
-        flash(f'Created {created_count} tasks from PDF using Gemini!', 'success')
-    else:
-        flash('PDF uploaded and processed successfully!', 'success')
+    if wants_json:
+        return jsonify({'status': 'queued', 'job_id': job_id}), 202
+    flash('PDF uploaded. Extracting text and tasks in the background - refresh in a minute.', 'success')
     return redirect(url_for('syllabus'))
 
+
+@app.route('/syllabus/jobs/<job_id>')
+@login_required
+def syllabus_job_status(job_id):
+    """Poll a syllabus upload job (fallback when Socket.IO progress is missed)."""
+    job = syllabus_jobs.status(current_user.id, job_id)
+    if job is None:
+        return jsonify({'status': 'error', 'message': 'Job not found'}), 404
+    return jsonify(job)
+
 @app.route('/api/update_proficiency', methods=['POST'])
 @login_required
 def update_proficiency():
@@ -4138,6 +7141,7 @@ def update_proficiency():
         topic.updated_at = datetime.utcnow()
         
     db.session.commit()
+    proficiency_matrix.mark_dirty(current_user.id)
     return jsonify({'status': 'success', 'new_score': topic.proficiency})
 
 
@@ -4199,20 +7203,17 @@ def progress():
     completion_percent = int((completed_todos / total_todos) * 100) if total_todos else 0
 
     week_ago = datetime.utcnow() - timedelta(days=7)
-    weekly_minutes = (
-        db.session.query(db.func.coalesce(db.func.sum(StudySession.duration), 0))
-        .filter(StudySession.user_id == current_user.id)
-        .filter(StudySession.completed_at >= week_ago)
-        .scalar()
-    )
-    weekly_hours = round((weekly_minutes or 0) / 60.0, 2)
     sessions_week = StudySession.query.filter_by(user_id=current_user.id).filter(StudySession.completed_at >= week_ago).count()
 
     # Consecutive-day streak based on completed sessions.
     streak = 0
-    # Calculate Monday of the current week
-    today = datetime.utcnow().date()
+    # Calculate Monday of the current week (local date, matches the daily rollup)
+    today = DailyStatsService.local_date()
     start_of_week = today - timedelta(days=today.weekday()) # Monday = 0
+    rollup = DailyStatsService.get_range(current_user.id, min(start_of_week, today - timedelta(days=6)), today)
+
+    weekly_minutes = sum(r.study_minutes for d, r in rollup.items() if d > today - timedelta(days=7))
+    weekly_hours = round((weekly_minutes or 0) / 60.0, 2)
     
     daily = []
     max_hours = 0.0
@@ -4220,16 +7221,7 @@ def progress():
     # Iterate Mon (0) to Sun (6)
     for i in range(7):
         day = start_of_week + timedelta(days=i)
-        start_dt = datetime.combine(day, datetime.min.time())
-        end_dt = datetime.combine(day, datetime.max.time())
-        
-        minutes = (
-            db.session.query(db.func.coalesce(db.func.sum(StudySession.duration), 0))
-            .filter(StudySession.user_id == current_user.id)
-            .filter(StudySession.completed_at >= start_dt)
-            .filter(StudySession.completed_at <= end_dt)
-            .scalar()
-        )
+        minutes = rollup[day].study_minutes if day in rollup else 0
         hours = round((minutes or 0) / 60.0, 2)
         max_hours = max(max_hours, hours)
         
@@ -4294,23 +7286,306 @@ def progress():
         category_distribution=category_data
     )
 
+# ============================================================================
+# LEADERBOARD RANK INDEX (In-process sorted index)
+# ============================================================================
+
+class BucketedSortedList:
+    """
+    Sorted list split into buckets of ~LOAD items (the sortedcontainers.SortedList layout).
+
+    DS concept:
+    - Buckets: short sorted lists plus the max of each, so an insert or delete
+      only shifts one bucket (O(log n + LOAD)) instead of the whole list
+    - Fenwick tree over bucket lengths: global position of an item, and the
+      bucket holding position i, in O(log n)
+    - A bucket splits at 2 * LOAD and is dropped when empty; only then is the
+      Fenwick tree rebuilt (O(n / LOAD), rare)
+    """
+
+    LOAD = 500
+
+    def __init__(self, items=()):
+        items = sorted(items)
+        self._buckets = [items[i:i + self.LOAD] for i in range(0, len(items), self.LOAD)]
+        self._maxes = [bucket[-1] for bucket in self._buckets]
+        self._len = len(items)
+        self._build_tree()
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        for bucket in self._buckets:
+            yield from bucket
+
+    def _build_tree(self):
+        n = len(self._buckets)
+        tree = [0] * (n + 1)
+        for i, bucket in enumerate(self._buckets, 1):
+            tree[i] += len(bucket)
+            parent = i + (i & -i)
+            if parent <= n:
+                tree[parent] += tree[i]
+        self._tree = tree
+
+    def _tree_add(self, bucket_index, delta):
+        i = bucket_index + 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    def _prefix(self, bucket_index):
+        """Number of items in buckets [0, bucket_index)."""
+        total, i = 0, bucket_index
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+    def _locate(self, pos):
+        """(bucket index, offset in bucket) of global position pos (0 <= pos < len)."""
+        idx, n = 0, len(self._tree) - 1
+        step = 1 << n.bit_length()
+        while step:
+            nxt = idx + step
+            if nxt <= n and self._tree[nxt] <= pos:
+                idx = nxt
+                pos -= self._tree[nxt]
+            step >>= 1
+        return idx, pos
+
+    def add(self, item):
+        if not self._buckets:
+            self._buckets, self._maxes, self._len = [[item]], [item], 1
+            self._build_tree()
+            return
+        i = bisect.bisect_left(self._maxes, item)
+        if i == len(self._buckets):
+            i -= 1
+            self._buckets[i].append(item)
+            self._maxes[i] = item
+        else:
+            bisect.insort(self._buckets[i], item)
+        self._len += 1
+        bucket = self._buckets[i]
+        if len(bucket) > 2 * self.LOAD:
+            self._buckets[i:i + 1] = [bucket[:self.LOAD], bucket[self.LOAD:]]
+            self._maxes[i:i + 1] = [bucket[self.LOAD - 1], bucket[-1]]
+            self._build_tree()
+        else:
+            self._tree_add(i, 1)
+
+    def remove(self, item):
+        """Remove one occurrence of item. Returns False if it is not present."""
+        i = bisect.bisect_left(self._maxes, item)
+        if i == len(self._buckets):
+            return False
+        bucket = self._buckets[i]
+        j = bisect.bisect_left(bucket, item)
+        if j == len(bucket) or bucket[j] != item:
+            return False
+        del bucket[j]
+        self._len -= 1
+        if bucket:
+            self._maxes[i] = bucket[-1]
+            self._tree_add(i, -1)
+        else:
+            del self._buckets[i]
+            del self._maxes[i]
+            self._build_tree()
+        return True
+
+    def bisect_left(self, item):
+        """Number of items < item."""
+        i = bisect.bisect_left(self._maxes, item)
+        if i == len(self._buckets):
+            return self._len
+        return self._prefix(i) + bisect.bisect_left(self._buckets[i], item)
+
+    def slice(self, start, stop):
+        """Items at positions [start, stop) as a list."""
+        stop = min(stop, self._len)
+        if start < 0 or start >= stop:
+            return []
+        i, j = self._locate(start)
+        out, need = [], stop - start
+        while need > 0:
+            chunk = self._buckets[i][j:j + need]
+            out.extend(chunk)
+            need -= len(chunk)
+            i, j = i + 1, 0
+        return out
+
+
+class RankIndex:
+    """
+    Sorted in-memory index of leaderboard-eligible users
+    (public profile, not admin, not banned).
+
+    DS concept:
+    - Sorted keys (-level, -total_xp, user_id) → best player first, held in
+      a BucketedSortedList so updates shift one bucket, not the whole list
+    - Hash map user_id -> key for O(1) lookup of a user's current entry
+    - O(log n) rank-of-user; top-N is a positional slice
+
+    Writers call update()/remove() after committing XP, ban or privacy
+    changes. rebuild() reloads from the DB (startup) and check_consistency()
+    compares the index with the DB. Writes that arrive while rebuild() is
+    loading rows are logged and replayed after the swap, so none are lost.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._rebuild_lock = threading.Lock()  # One rebuild at a time
+        self._keys = BucketedSortedList()  # (-level, -total_xp, user_id)
+        self._by_user = {}     # user_id -> key
+        self._built = False
+        self._pending = None   # Write log while a rebuild is loading, else None
+
+    @staticmethod
+    def _eligible_filter():
+        return (User.is_public_profile == True, User.is_admin == False, User.is_banned == False)
+
+    @staticmethod
+    def _is_eligible(user):
+        return bool(user.is_public_profile) and not user.is_admin and not user.is_banned
+
+    @staticmethod
+    def _key(user_id, level, total_xp):
+        return (-(level or 1), -(total_xp or 0), user_id)
+
+    def rebuild(self):
+        """Reload every eligible user from the DB (one narrow query), then replay writes made meanwhile."""
+        with self._rebuild_lock:
+            with self._lock:
+                self._pending = []
+            try:
+                rows = db.session.query(User.id, User.level, User.total_xp).filter(*self._eligible_filter()).all()
+                keys = sorted(self._key(uid, level, xp) for uid, level, xp in rows)
+                with self._lock:
+                    self._keys = BucketedSortedList(keys)
+                    self._by_user = {k[2]: k for k in keys}
+                    for op in self._pending:
+                        self._apply_locked(*op)
+                    self._built = True
+            finally:
+                with self._lock:
+                    self._pending = None
+        print(f"[RankIndex] Rebuilt with {len(keys)} users")
+        return len(keys)
+
+    def ensure_built(self):
+        if not self._built:
+            self.rebuild()
+
+    def _remove_locked(self, user_id):
+        key = self._by_user.pop(user_id, None)
+        if key is not None:
+            self._keys.remove(key)
+
+    def _apply_locked(self, kind, user_id, level=None, total_xp=None, eligible=True):
+        """Apply one write: 'update' (full re-position), 'score' (indexed users only) or 'remove'."""
+        if kind == 'score' and user_id not in self._by_user:
+            return  # Not eligible for the board
+        self._remove_locked(user_id)
+        if kind == 'remove' or not eligible:
+            return
+        key = self._key(user_id, level, total_xp)
+        self._keys.add(key)
+        self._by_user[user_id] = key
+
+    def _write(self, *op):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append(op)  # Replayed once the rebuild swaps in
+            if self._built:
+                self._apply_locked(*op)
+            # Not built and no rebuild running: the first rebuild reads it from the DB
+
+    def update(self, user):
+        """Re-position a user after XP / level / ban / privacy changes."""
+        if user is None:
+            return
+        self._write('update', user.id, user.level, user.total_xp, self._is_eligible(user))
+
+    def update_score(self, user_id, level, total_xp):
+        """Re-position an already indexed user from a score alone (no User row needed)."""
+        self._write('score', user_id, level, total_xp)
+
+    def remove(self, user_id):
+        self._write('remove', user_id)
+
+    def rank_of(self, level, total_xp):
+        """Standard competition rank (1, 2, 2, 4) for the given score."""
+        self.ensure_built()
+        # user_id is always >= 1, so -1 sorts before every tied entry
+        probe = (-(level or 1), -(total_xp or 0), -1)
+        with self._lock:
+            return self._keys.bisect_left(probe) + 1
+
+    def rank_of_user(self, user):
+        return self.rank_of(user.level, user.total_xp)
+
+    def top_ids(self, n, offset=0):
+        self.ensure_built()
+        with self._lock:
+            return [k[2] for k in self._keys.slice(offset, offset + n)]
+
+    def top_users(self, n, offset=0):
+        """Top-N User rows in leaderboard order (one IN query)."""
+        ids = self.top_ids(n, offset)
+        if not ids:
+            return []
+        users = {u.id: u for u in User.query.filter(User.id.in_(ids)).all()}
+        return [users[uid] for uid in ids if uid in users]
+
+    def size(self):
+        with self._lock:
+            return len(self._keys)
+
+    def check_consistency(self, repair=False):
+        """
+        Compare the index with the DB. Returns a report; with repair=True a
+        mismatched index is rebuilt.
+        """
+        self.ensure_built()
+        rows = db.session.query(User.id, User.level, User.total_xp).filter(*self._eligible_filter()).all()
+        expected = {uid: self._key(uid, level, xp) for uid, level, xp in rows}
+        with self._lock:
+            actual = dict(self._by_user)
+            keys = list(self._keys)
+            ordered = all(keys[i] <= keys[i + 1] for i in range(len(keys) - 1))
+        missing = sorted(uid for uid in expected if uid not in actual)
+        extra = sorted(uid for uid in actual if uid not in expected)
+        stale = sorted(uid for uid, key in expected.items() if uid in actual and actual[uid] != key)
+        report = {
+            'consistent': ordered and not (missing or extra or stale),
+            'sorted': ordered,
+            'indexed': len(actual),
+            'expected': len(expected),
+            'missing': missing[:50],
+            'extra': extra[:50],
+            'stale': stale[:50],
+            'repaired': False,
+        }
+        if repair and not report['consistent']:
+            self.rebuild()
+            report['repaired'] = True
+        return report
+
+
+rank_index = RankIndex()
+
+
 @app.route('/leaderboard')
 @login_required
 def leaderboard():
     """Global leaderboard based on level and XP - Excludes admins."""
     # Get top 50 users ordered by level (desc), then by total_xp (desc)
     # EXCLUDE ADMINS from leaderboard
-    top_users = (
-        User.query
-        .filter(
-            User.is_public_profile == True,
-            User.is_admin == False,
-            User.is_banned == False
-        )
-        .order_by(User.level.desc(), User.total_xp.desc(), User.id.asc())
-        .limit(50)
-        .all()
-    )
+    top_users = rank_index.top_users(50)
+    CosmeticsService.annotate(top_users)  # Frames for all 50 rows in one query
     
     # Calculate display ranks handling ties (Standard Competition Ranking like 1, 2, 2, 4)
     for i, user in enumerate(top_users):
@@ -4324,21 +7599,8 @@ def leaderboard():
             else:
                 user.display_rank = i + 1
     
-    # Calculate current user's rank much more efficiently
-    # Rank is 1 + number of users who have more level OR same level but more XP
-    # EXCLUDE ADMINS from rank calculation
-    my_rank = User.query.filter(
-        User.is_public_profile == True,
-        User.is_admin == False,
-        User.is_banned == False,
-        db.or_(
-            User.level > current_user.level,
-            db.and_(
-                User.level == current_user.level,
-                User.total_xp > current_user.total_xp
-            )
-        )
-    ).count() + 1
+    # Rank is 1 + number of eligible users with more level OR same level but more XP (bisect on the index)
+    my_rank = rank_index.rank_of_user(current_user)
     
     return render_template(
         'leaderboard.html',
@@ -4346,6 +7608,30 @@ def leaderboard():
         my_rank=my_rank
     )
 
+@app.route('/api/leaderboard/<period>')
+@login_required
+def api_period_leaderboard(period):
+    """
+    Weekly / monthly leaderboard from XP buckets.
+    Query params: scope=global|friends, limit (max 100), cursor (from next_cursor).
+    """
+    if period not in XPBucketService.PERIODS:
+        return jsonify({'error': 'Invalid period'}), 400
+
+    scope = request.args.get('scope', 'global')
+    user_ids = None
+    if scope == 'friends':
+        user_ids = list(friend_graph.friend_ids(current_user.id) | {current_user.id})
+
+    board = XPBucketService.get_board(
+        period,
+        limit=request.args.get('limit', 20, type=int),
+        cursor=request.args.get('cursor'),
+        user_ids=user_ids
+    )
+    board['scope'] = scope
+    return jsonify(board)
+
 @app.route('/settings')
 @login_required
 def settings():
@@ -4356,10 +7642,6 @@ def settings():
 def profile(user_id):
     user = User.query.get_or_404(user_id)
     
-    # Ensure badges are up to date
-    GamificationService.check_badges(user)
-    db.session.commit()
-    
     badges = UserBadge.query.filter_by(user_id=user.id).all()
     # Calculate stats for the target user
     total_focus_minutes = db.session.query(db.func.sum(StudySession.duration))\
@@ -4375,14 +7657,9 @@ def profile(user_id):
             .order_by(Todo.due_date.asc())\
             .all()
 
-    # Get Active Frame
-    active_frame = None
-    active_items = UserItem.query.filter_by(user_id=user.id, is_active=True).all()
-    for u_item in active_items:
-        cat_item = ShopService.ITEMS.get(u_item.item_id)
-        if cat_item and cat_item['type'] == 'frame':
-            active_frame = cat_item
-            break
+    # Get Active Frame (shared cosmetics cache)
+    frame_id = CosmeticsService.for_user(user)['frame']
+    active_frame = ShopService.ITEMS.get(frame_id) if frame_id else None
 
     return render_template('profile.html', user=user, badges=badges, total_focus_hours=total_focus_hours, calendar_events=calendar_events, active_frame=active_frame)
 
@@ -4408,6 +7685,7 @@ def update_public_profile():
     is_public = data.get('is_public', True)
     current_user.is_public_profile = bool(is_public)
     db.session.commit()
+    rank_index.update(current_user)
     
     return jsonify({'status': 'success'})
 
@@ -4440,6 +7718,7 @@ def settings_update():
 
     try:
         db.session.commit()
+        user_search_index.update(current_user)
         return jsonify({'status': 'success', 'message': 'Profile updated successfully'})
     except Exception as e:
         db.session.rollback()
@@ -4885,7 +8164,7 @@ def generate_battle_problem(difficulty, language):
     )
     
     try:
-        response = call_ai_api([{'role': 'user', 'content': prompt}])
+        response = call_ai_api([{'role': 'user', 'content': prompt}], endpoint='battle')
         # Cleanup JSON
         if "```json" in response:
             response = response.split("```json")[1].split("```")[0]
@@ -4936,7 +8215,7 @@ def judge_battle(room_code):
         name_to_id = { p['name']: pid for pid, p in room['players'].items() }
         
         try:
-            response = call_ai_api([{'role': 'user', 'content': prompt}])
+            response = call_ai_api([{'role': 'user', 'content': prompt}], endpoint='battle')
              # Cleanup JSON
             if "```json" in response:
                 response = response.split("```json")[1].split("```")[0]
@@ -4954,17 +8233,17 @@ def judge_battle(room_code):
             winner_id = name_to_id.get(winner_name)
             
             if winner_id:
+                # Win count before this one -> badge thresholds crossed by this win
+                wins = XPHistory.query.filter_by(user_id=winner_id, source='battle_win').count()
+                badge_engine.evaluate([(winner_id, 'wins', wins, wins + 1)])
                 # Winner gets full XP
                 GamificationService.add_xp(winner_id, 'battle_win', base_xp)
                 result['xp_awarded'] = {winner_name: base_xp}
             elif winner_name == 'Draw':
                 # Both get 50%
                 half_xp = int(base_xp * 0.5)
-                xp_dict = {}
-                for pid in room['players']:
-                    GamificationService.add_xp(pid, 'battle_draw', half_xp)
-                    pname = room['players'][pid]['name']
-                    xp_dict[pname] = half_xp
+                GamificationService.add_xp_batch({pid: half_xp for pid in room['players']}, 'battle_draw')
+                xp_dict = {room['players'][pid]['name']: half_xp for pid in room['players']}
                 result['xp_awarded'] = xp_dict
             
             socketio.emit('battle_result', result, room=room_code)
@@ -5078,6 +8357,291 @@ def on_battle_leave(data):
 
 # Profile management can be extended later (kept simple for this semester project).
 
+# ------------------------------
+# FRIENDS GRAPH (Symmetric adjacency cache)
+# ------------------------------
+
+class FriendGraph:
+    """
+    In-memory symmetric view of the directional Friendship table.
+
+    DS concept:
+    - Adjacency sets: user_id -> {friend_id} for accepted friendships (both directions)
+    - Pending maps: user_id -> {other_id: request_id} for sent / received requests
+    - Built from one query; kept coherent by the request/accept/reject/delete paths
+
+    Friendship rows stay the source of truth; rebuild() reloads them.
+    Writes that arrive while rebuild() is loading rows are logged and
+    replayed after the swap, so none are lost.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._rebuild_lock = threading.Lock()  # One rebuild at a time
+        self._friends = {}    # user_id -> set(friend_ids)
+        self._sent = {}       # user_id -> {receiver_id: request_id}
+        self._received = {}   # user_id -> {sender_id: request_id}
+        self._built = False
+        self._pending = None  # Write log while a rebuild is loading, else None
+
+    def _add_locked(self, request_id, sender_id, receiver_id, status):
+        if status == 'accepted':
+            self._friends.setdefault(sender_id, set()).add(receiver_id)
+            self._friends.setdefault(receiver_id, set()).add(sender_id)
+        elif status == 'pending':
+            self._sent.setdefault(sender_id, {})[receiver_id] = request_id
+            self._received.setdefault(receiver_id, {})[sender_id] = request_id
+
+    def _discard_locked(self, a, b):
+        self._friends.get(a, set()).discard(b)
+        self._friends.get(b, set()).discard(a)
+        for x, y in ((a, b), (b, a)):
+            self._sent.get(x, {}).pop(y, None)
+            self._received.get(y, {}).pop(x, None)
+
+    def _remove_user_locked(self, user_id):
+        for other in list(self._friends.pop(user_id, set())):
+            self._friends.get(other, set()).discard(user_id)
+        for other in list(self._sent.pop(user_id, {})):
+            self._received.get(other, {}).pop(user_id, None)
+        for other in list(self._received.pop(user_id, {})):
+            self._sent.get(other, {}).pop(user_id, None)
+
+    def _apply_locked(self, kind, *args):
+        """Apply one write: 'request', 'accept', 'remove' (a pair) or 'remove_user'."""
+        if kind == 'request':
+            self._add_locked(*args)
+        elif kind == 'accept':
+            request_id, sender_id, receiver_id = args
+            self._discard_locked(sender_id, receiver_id)
+            self._add_locked(request_id, sender_id, receiver_id, 'accepted')
+        elif kind == 'remove':
+            self._discard_locked(*args)
+        elif kind == 'remove_user':
+            self._remove_user_locked(*args)
+
+    def _write(self, *op):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append(op)  # Replayed once the rebuild swaps in
+            if self._built:
+                self._apply_locked(*op)
+            # Not built and no rebuild running: the first rebuild reads it from the DB
+
+    def rebuild(self):
+        with self._rebuild_lock:
+            with self._lock:
+                self._pending = []
+            try:
+                rows = db.session.query(Friendship.id, Friendship.user_id, Friendship.friend_id, Friendship.status).all()
+                with self._lock:
+                    self._friends, self._sent, self._received = {}, {}, {}
+                    for request_id, sender_id, receiver_id, status in rows:
+                        self._add_locked(request_id, sender_id, receiver_id, status)
+                    for op in self._pending:
+                        self._apply_locked(*op)
+                    self._built = True
+            finally:
+                with self._lock:
+                    self._pending = None
+        print(f"[FriendGraph] Rebuilt from {len(rows)} friendship rows")
+
+    def ensure_built(self):
+        if not self._built:
+            self.rebuild()
+
+    # --- Writers (call after commit) ---
+
+    def on_request(self, req):
+        self._write('request', req.id, req.user_id, req.friend_id, req.status)
+
+    def on_accept(self, req):
+        self._write('accept', req.id, req.user_id, req.friend_id)
+
+    def on_remove(self, a, b):
+        self._write('remove', a, b)
+
+    def remove_user(self, user_id):
+        self._write('remove_user', user_id)
+
+    # --- Readers ---
+
+    def friend_ids(self, user_id):
+        self.ensure_built()
+        with self._lock:
+            return set(self._friends.get(user_id, ()))
+
+    def received_requests(self, user_id):
+        """{sender_id: request_id} of pending requests to this user."""
+        self.ensure_built()
+        with self._lock:
+            return dict(self._received.get(user_id, {}))
+
+    def linked_ids(self, user_id):
+        """Everyone with a friendship row (accepted or pending, either direction)."""
+        self.ensure_built()
+        with self._lock:
+            return (set(self._friends.get(user_id, ()))
+                    | set(self._sent.get(user_id, {}))
+                    | set(self._received.get(user_id, {})))
+
+    def users_with_friends(self):
+        self.ensure_built()
+        with self._lock:
+            return {uid for uid, friends in self._friends.items() if friends}
+
+    def status(self, user_id, other_id):
+        """'accepted' | 'sent' | 'received' | 'none' from user_id's point of view."""
+        self.ensure_built()
+        with self._lock:
+            if other_id in self._friends.get(user_id, ()):
+                return 'accepted'
+            if other_id in self._sent.get(user_id, {}):
+                return 'sent'
+            if other_id in self._received.get(user_id, {}):
+                return 'received'
+        return 'none'
+
+    @staticmethod
+    def row_exists(a, b):
+        """DB backstop before inserting a request: any Friendship row for the pair, either direction."""
+        return db.session.query(Friendship.id).filter(db.or_(
+            db.and_(Friendship.user_id == a, Friendship.friend_id == b),
+            db.and_(Friendship.user_id == b, Friendship.friend_id == a),
+        )).first() is not None
+
+
+friend_graph = FriendGraph()
+
+
+class FriendSuggestionStore:
+    """
+    "People you may know": 2-hop neighbours in the friend graph, ranked by
+    mutual-friend count and shared topics.
+
+    A background pass precomputes suggestions for every user with friends and
+    stores them per user with a TTL, so /friends only does a dict lookup plus
+    one IN query for the profiles.
+    """
+
+    MUTUAL_WEIGHT = 10
+    TOPIC_WEIGHT = 3
+    PER_USER = 10
+
+    def __init__(self, ttl_seconds=3600, refresh_seconds=1800):
+        self.ttl = ttl_seconds
+        self.refresh_seconds = refresh_seconds
+        self._lock = threading.Lock()
+        self._store = {}          # user_id -> (computed_at, [suggestion, ...])
+        self._queued = set()      # users waiting for an on-demand computation
+        self._wake = threading.Event()
+        self._thread = None
+
+    def compute_for(self, user_id):
+        """2-hop traversal for one user (no DB access beyond the in-memory indexes)."""
+        friends = friend_graph.friend_ids(user_id)
+        if not friends:
+            return []
+        excluded = friend_graph.linked_ids(user_id) | {user_id}
+        mutual = {}
+        for friend_id in friends:
+            for candidate in friend_graph.friend_ids(friend_id):
+                if candidate not in excluded:
+                    mutual[candidate] = mutual.get(candidate, 0) + 1
+
+        scored = []
+        for candidate, count in mutual.items():
+            topics = proficiency_matrix.common_topics(user_id, candidate, limit=3)
+            score = count * self.MUTUAL_WEIGHT + len(topics) * self.TOPIC_WEIGHT
+            scored.append((score, count, candidate, topics))
+        scored.sort(key=lambda x: (-x[0], -x[1], x[2]))
+        return [
+            {'user_id': candidate, 'mutual_count': count, 'shared_topics': topics, 'score': score}
+            for score, count, candidate, topics in scored[:self.PER_USER]
+        ]
+
+    def refresh_user(self, user_id):
+        proficiency_matrix.ensure_fresh()
+        suggestions = self.compute_for(user_id)
+        with self._lock:
+            self._store[user_id] = (time.time(), suggestions)
+        return suggestions
+
+    def refresh_all(self):
+        proficiency_matrix.ensure_fresh()
+        user_ids = friend_graph.users_with_friends()
+        for uid in user_ids:
+            self.refresh_user(uid)
+        # Drop users who no longer have friends
+        with self._lock:
+            for uid in [uid for uid in self._store if uid not in user_ids]:
+                del self._store[uid]
+        return len(user_ids)
+
+    def get(self, user_id):
+        """Stored suggestions, or [] (and an on-demand refresh is queued) when missing/expired."""
+        with self._lock:
+            entry = self._store.get(user_id)
+            if entry and time.time() - entry[0] < self.ttl:
+                return entry[1]
+            self._queued.add(user_id)
+        self._wake.set()
+        return entry[1] if entry else []
+
+    def invalidate(self, *user_ids):
+        """The graph around these users changed; recompute them in the background."""
+        with self._lock:
+            for uid in user_ids:
+                self._store.pop(uid, None)
+                self._queued.add(uid)
+        self._wake.set()
+
+    def _run(self):
+        last_full = 0
+        while True:
+            self._wake.wait(timeout=60)
+            self._wake.clear()
+            try:
+                with app.app_context():
+                    if time.time() - last_full >= self.refresh_seconds:
+                        count = self.refresh_all()
+                        last_full = time.time()
+                        print(f"[Suggestions] Refreshed {count} users")
+                    with self._lock:
+                        queued = list(self._queued)
+                        self._queued.clear()
+                    for uid in queued:
+                        self.refresh_user(uid)
+                    db.session.remove()
+            except Exception as e:
+                print(f"[Suggestions] Refresh failed: {e}")
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True, name="friend-suggestions")
+            self._thread.start()
+
+
+friend_suggestions = FriendSuggestionStore(
+    ttl_seconds=int(os.getenv('SUGGESTION_TTL_SECONDS', 3600)),
+    refresh_seconds=int(os.getenv('SUGGESTION_REFRESH_SECONDS', 1800))
+)
+friend_suggestions.start()
+
+
+def load_users_by_id(user_ids):
+    """Batched profile loader: {id: User} for the given ids in a single IN query."""
+    user_ids = {uid for uid in user_ids if uid}
+    if not user_ids:
+        return {}
+    return {u.id: u for u in User.query.filter(User.id.in_(user_ids)).all()}
+
+
+def load_friends(user_id):
+    """Accepted friends of user_id as User rows (adjacency cache + one IN query)."""
+    return list(load_users_by_id(friend_graph.friend_ids(user_id)).values())
+
+
 # ------------------------------
 # FRIENDS & PROFILE LOGIC
 # ------------------------------
@@ -5088,31 +8652,31 @@ def inject_user_context():
         # 1. Focus Buddies
         friends = []
         try:
-            friendships = Friendship.query.filter(
-                ((Friendship.user_id == current_user.id) | (Friendship.friend_id == current_user.id)) & 
-                (Friendship.status == 'accepted')
-            ).all()
-            
-            for f in friendships:
-                fid = f.friend_id if f.user_id == current_user.id else f.user_id
-                friend = User.query.get(fid)
-                if friend:
-                    # Check online status (within 5 mins)
-                    is_online = (datetime.utcnow() - (friend.last_seen or datetime.min)) < timedelta(minutes=5)
-                    friends.append({
+            def _load_friends():
+                # Adjacency cache + one IN query instead of a User.query.get per friend
+                loaded = []
+                for friend in load_friends(current_user.id):
+                    loaded.append({
                         'id': friend.id,
                         'name': f"{friend.first_name} {friend.last_name}",
                         'avatar': friend.get_avatar(64),
-                        'is_online': is_online,
+                        'last_seen': friend.last_seen,
                         'is_public': friend.is_public_profile,
-                        'rank': GamificationService.get_rank(friend.level) if friend.is_public_profile else None,
+                        'rank': friend.rank_info if friend.is_public_profile else None,
                         'stats': {'level': friend.level, 'xp': friend.total_xp} if friend.is_public_profile else None
                     })
+                return loaded
+
+            for cached in context_cache.get_or_load(current_user.id, 'friends', _load_friends):
+                # Online status is live (presence buffer), everything else comes from the cache
+                entry = dict(cached)
+                entry['is_online'] = presence.is_online(entry['id'], entry.pop('last_seen'))
+                friends.append(entry)
         except Exception:
             pass # Fail gracefully if table doesn't exist yet
         
         # 2. Sidebar Stats (Rank, Level Progress)
-        current_rank = GamificationService.get_rank(current_user.level)
+        current_rank = current_user.rank_info
         # XP per level is 500 (from GamificationService)
         xp_per_level = 500
         current_xp_in_level = current_user.total_xp % xp_per_level
@@ -5129,22 +8693,13 @@ def inject_user_context():
         )
     return dict(focus_buddies=[])
 
-@app.before_request
-def update_last_seen():
-    if current_user.is_authenticated:
-        try:
-            current_user.last_seen = datetime.utcnow()
-            db.session.commit()
-        except Exception:
-            db.session.rollback()
-            pass # Fail silently to prevent request crash
-
 @app.route('/settings/public-profile', methods=['POST'])
 @login_required
 def toggle_public_profile():
     data = request.get_json()
     current_user.is_public_profile = data.get('is_public', True)
     db.session.commit()
+    rank_index.update(current_user)
     return jsonify({'status': 'success'})
 
 @app.route('/friends')
@@ -5158,34 +8713,227 @@ def friends_page():
             'email': u.email,
             'avatar': u.get_avatar(100),
             'level': u.level,
-            'rank': GamificationService.get_rank(u.level),
+            'rank': u.rank_info,
             'is_public': u.is_public_profile
         }
 
+    # Friends and request senders come from the adjacency cache; profiles in one IN query
+    friend_ids = friend_graph.friend_ids(current_user.id)
+    received = friend_graph.received_requests(current_user.id)
+    profiles = load_users_by_id(friend_ids | set(received))
+
     # 1. My Friends
-    accepted = Friendship.query.filter(
-        ((Friendship.user_id == current_user.id) | (Friendship.friend_id == current_user.id)) & 
-        (Friendship.status == 'accepted')
-    ).all()
-    my_friends = []
-    for f in accepted:
-        fid = f.friend_id if f.user_id == current_user.id else f.user_id
-        friend = User.query.get(fid)
-        if friend:
-            my_friends.append(format_user(friend))
+    my_friends = [format_user(profiles[fid]) for fid in friend_ids if fid in profiles]
 
     # 2. Friend Requests (Received)
-    requests = Friendship.query.filter_by(friend_id=current_user.id, status='pending').all()
     friend_requests = []
-    for r in requests:
-        sender = User.query.get(r.user_id)
+    for sender_id, request_id in received.items():
+        sender = profiles.get(sender_id)
         if sender:
             friend_requests.append({
-                'request_id': r.id,
+                'request_id': request_id,
                 **format_user(sender)
             })
 
-    return render_template('friends.html', my_friends=my_friends, friend_requests=friend_requests)
+    # 3. People you may know (precomputed in the background)
+    suggestions = friend_suggestions.get(current_user.id)
+    suggested_users = load_users_by_id(sg['user_id'] for sg in suggestions)
+    people_you_may_know = []
+    for sg in suggestions:
+        u = suggested_users.get(sg['user_id'])
+        # Skip anyone linked since the last pass, banned or admin
+        if not u or u.is_banned or u.is_admin or friend_graph.status(current_user.id, u.id) != 'none':
+            continue
+        people_you_may_know.append({
+            **format_user(u),
+            'mutual_count': sg['mutual_count'],
+            'shared_topics': sg['shared_topics']
+        })
+
+    return render_template('friends.html', my_friends=my_friends, friend_requests=friend_requests,
+                           people_you_may_know=people_you_may_know)
+
+# ------------------------------
+# USER SEARCH INDEX
+# ------------------------------
+
+class UserSearchIndex:
+    """
+    Substring search over email / first_name / last_name with prefix matches ranked first.
+
+    - PostgreSQL: ILIKE backed by pg_trgm GIN indexes (created at startup)
+    - SQLite / no pg_trgm: in-process trigram index
+
+    DS concept (fallback):
+    - Inverted index: trigram -> set(user_id)
+    - Query = intersect the postings of the query's trigrams (smallest first),
+      then verify the substring on the few remaining candidates
+
+    Writes that arrive while rebuild() is loading rows are logged and
+    replayed after the swap, so none are lost.
+    """
+
+    FIELDS = ('email', 'first_name', 'last_name')
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._rebuild_lock = threading.Lock()  # One rebuild at a time
+        self._docs = {}      # user_id -> (email, first_name, last_name) lowercased
+        self._grams = {}     # trigram -> set(user_id)
+        self._built = False
+        self._pending = None  # Write log while a rebuild is loading, else None
+        self.pg_trgm_ready = False
+
+    @staticmethod
+    def _use_database():
+        return db.engine.dialect.name == 'postgresql'
+
+    @staticmethod
+    def _trigrams(text):
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    # --- PostgreSQL setup ---
+
+    def ensure_pg_indexes(self):
+        """CREATE EXTENSION pg_trgm + GIN indexes. Safe to run on every start."""
+        if not self._use_database():
+            return
+        statements = ['CREATE EXTENSION IF NOT EXISTS pg_trgm'] + [
+            f'CREATE INDEX IF NOT EXISTS ix_user_{column}_trgm ON "user" USING gin ({column} gin_trgm_ops)'
+            for column in self.FIELDS
+        ]
+        try:
+            for sql in statements:
+                db.session.execute(db.text(sql))
+            db.session.commit()
+            self.pg_trgm_ready = True
+            print("[Search] pg_trgm GIN indexes ready")
+        except Exception as e:
+            db.session.rollback()
+            print(f"[Search] pg_trgm unavailable, ILIKE will scan: {e}")
+
+    # --- In-process fallback index ---
+
+    def _doc(self, email, first_name, last_name):
+        return tuple((v or '').lower() for v in (email, first_name, last_name))
+
+    def _put_locked(self, user_id, doc):
+        self._drop_locked(user_id)
+        self._docs[user_id] = doc
+        for value in doc:
+            for gram in self._trigrams(value):
+                self._grams.setdefault(gram, set()).add(user_id)
+
+    def _drop_locked(self, user_id):
+        doc = self._docs.pop(user_id, None)
+        if not doc:
+            return
+        for value in doc:
+            for gram in self._trigrams(value):
+                posting = self._grams.get(gram)
+                if posting is not None:
+                    posting.discard(user_id)
+                    if not posting:
+                        del self._grams[gram]
+
+    def _apply_locked(self, kind, user_id, doc=None):
+        if kind == 'put':
+            self._put_locked(user_id, doc)
+        else:
+            self._drop_locked(user_id)
+
+    def _write(self, *op):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append(op)  # Replayed once the rebuild swaps in
+            if self._built:
+                self._apply_locked(*op)
+            # Not built and no rebuild running: the first rebuild reads it from the DB
+
+    def rebuild(self):
+        if self._use_database():
+            return
+        with self._rebuild_lock:
+            with self._lock:
+                self._pending = []
+            try:
+                rows = db.session.query(User.id, User.email, User.first_name, User.last_name).all()
+                with self._lock:
+                    self._docs, self._grams = {}, {}
+                    for uid, email, first_name, last_name in rows:
+                        self._put_locked(uid, self._doc(email, first_name, last_name))
+                    for op in self._pending:
+                        self._apply_locked(*op)
+                    self._built = True
+            finally:
+                with self._lock:
+                    self._pending = None
+
+    def update(self, user):
+        """Re-index a user after create / name or email change."""
+        if user is None:
+            return
+        self._write('put', user.id, self._doc(user.email, user.first_name, user.last_name))
+
+    def remove(self, user_id):
+        self._write('drop', user_id)
+
+    def _fallback_ids(self, q):
+        if not self._built:
+            self.rebuild()
+        with self._lock:
+            if len(q) >= 3:
+                postings = sorted((self._grams.get(g, set()) for g in self._trigrams(q)), key=len)
+                candidates = set(postings[0]) if postings else set()
+                for posting in postings[1:]:
+                    candidates &= posting
+                    if not candidates:
+                        break
+                docs = ((uid, self._docs[uid]) for uid in candidates)
+            else:
+                docs = list(self._docs.items())  # 2-char queries: trigram index can't help
+            matches = []
+            for uid, doc in docs:
+                if any(q in value for value in doc):
+                    prefix = any(value.startswith(q) for value in doc)
+                    matches.append((0 if prefix else 1, len(doc[1]), uid))
+        matches.sort()
+        return [uid for _, _, uid in matches]
+
+    # --- Public API ---
+
+    def match_filter(self, q):
+        """SQLAlchemy filter for 'q matches a user' (indexed on PostgreSQL, id list otherwise)."""
+        q = q.strip()
+        if self._use_database():
+            pattern = f"%{q}%"
+            return db.or_(User.email.ilike(pattern), User.first_name.ilike(pattern), User.last_name.ilike(pattern))
+        return User.id.in_(self._fallback_ids(q.lower()))
+
+    def search(self, q, limit=10, exclude_ids=()):
+        """Matching users, prefix matches first, at most `limit` rows."""
+        q = q.strip()
+        if len(q) < 2:
+            return []
+        if self._use_database():
+            prefix = f"{q}%"
+            is_prefix = db.or_(User.email.ilike(prefix), User.first_name.ilike(prefix), User.last_name.ilike(prefix))
+            query = User.query.filter(self.match_filter(q))
+            if exclude_ids:
+                query = query.filter(~User.id.in_(list(exclude_ids)))
+            return query.order_by(
+                db.case((is_prefix, 0), else_=1),
+                db.func.length(User.first_name),
+                User.id
+            ).limit(limit).all()
+
+        ids = [uid for uid in self._fallback_ids(q.lower()) if uid not in exclude_ids][:limit]
+        users = load_users_by_id(ids)
+        return [users[uid] for uid in ids if uid in users]
+
+
+user_search_index = UserSearchIndex()
+
 
 @app.route('/api/users/search')
 @login_required
@@ -5194,31 +8942,13 @@ def search_users():
     if not query or len(query) < 2:
         return jsonify([])
     
-    # Search by name or email
-    users = User.query.filter(
-        (User.id != current_user.id) & 
-        (
-            (User.email.ilike(f"%{query}%")) | 
-            (User.first_name.ilike(f"%{query}%")) | 
-            (User.last_name.ilike(f"%{query}%"))
-        )
-    ).limit(10).all()
+    # Search by name or email (indexed, prefix matches first)
+    users = user_search_index.search(query, limit=10, exclude_ids={current_user.id})
     
     results = []
     for u in users:
-        # Check friendship status
-        friendship = Friendship.query.filter(
-            ((Friendship.user_id == current_user.id) & (Friendship.friend_id == u.id)) |
-            ((Friendship.user_id == u.id) & (Friendship.friend_id == current_user.id))
-        ).first()
-        
-        status = 'none'
-        if friendship:
-            status = friendship.status
-            if status == 'pending' and friendship.friend_id == current_user.id:
-                status = 'received' # Request received from this user
-            elif status == 'pending' and friendship.user_id == current_user.id:
-                status = 'sent' # Request sent to this user
+        # Friendship status for the whole page comes from the adjacency cache (no per-row query)
+        status = friend_graph.status(current_user.id, u.id)
         
         results.append({
             'id': u.id,
@@ -5240,17 +8970,13 @@ def send_friend_request(user_id):
     if not target:
         return jsonify({'error': 'User not found'}), 404
         
-    existing = Friendship.query.filter(
-        ((Friendship.user_id == current_user.id) & (Friendship.friend_id == user_id)) |
-        ((Friendship.user_id == user_id) & (Friendship.friend_id == current_user.id))
-    ).first()
-    
-    if existing:
+    if friend_graph.status(current_user.id, user_id) != 'none' or FriendGraph.row_exists(current_user.id, user_id):
         return jsonify({'error': 'Friendship or request already exists'}), 400
         
     req = Friendship(user_id=current_user.id, friend_id=user_id, status='pending')
     db.session.add(req)
     db.session.commit()
+    friend_graph.on_request(req)
 
     # 🔔 Notify the target user in real-time via Socket.IO
     try:
@@ -5274,6 +9000,10 @@ def accept_friend_request(request_id):
         
     req.status = 'accepted'
     db.session.commit()
+    friend_graph.on_accept(req)
+    friend_suggestions.invalidate(req.user_id, req.friend_id)
+    context_cache.invalidate(req.user_id, 'friends')
+    context_cache.invalidate(req.friend_id, 'friends')
     return jsonify({'status': 'success'})
 
 @app.route('/friends/reject/<int:request_id>', methods=['POST'])
@@ -5285,6 +9015,10 @@ def reject_friend_request(request_id):
         
     db.session.delete(req)
     db.session.commit()
+    friend_graph.on_remove(req.user_id, req.friend_id)
+    friend_suggestions.invalidate(req.user_id, req.friend_id)
+    context_cache.invalidate(req.user_id, 'friends')
+    context_cache.invalidate(req.friend_id, 'friends')
     return jsonify({'status': 'success'})
 
 # ------------------------------
@@ -5379,6 +9113,8 @@ class QuizService:
         # 2. Call AI
         # Minimal prompt to save tokens and ensure JSON
         topic_str = ", ".join(topics_list[:3]) # Limit to 3 topics for context
+        # Only the syllabus chunks about these topics
+        material = SyllabusService.relevant_text(user_id, topic_str, k=4, syllabus_id=active_syllabus_id) if active_syllabus_id else ""
         prompt = (
             f"Create a {num_questions}-question multiple choice quiz testing knowledge on: {topic_str}. "
             f"Difficulty level: {difficulty}. "
@@ -5386,9 +9122,11 @@ class QuizService:
             "Output strictly valid JSON (no markdown formatting) in this specific format: "
             '{"questions": [{"question": "...", "options": ["A", "B", "C", "D"], "correct_index": 0, "topic": "..."}]}'
         )
+        if material:
+            prompt += f"\n\nBase the questions on this course material where relevant:\n{PromptBuilder.truncate(material, 600)}"
 
         messages = [{'role': 'user', 'content': prompt}]
-        response_text = call_ai_api(messages)
+        response_text = call_ai_api(messages, endpoint='quiz')
         
         # 3. Parse JSON
         # Clean potential markdown codes
@@ -5404,57 +9142,177 @@ class QuizService:
 # ------------------------------
 # MATCHMAKING SERVICE
 # ------------------------------
+class ProficiencyMatrix:
+    """
+    Sparse user x topic proficiency matrix for matchmaking.
+
+    DS concept:
+    - Row store: user_id -> {topic: proficiency} plus a cached L2 norm per row
+    - Inverted index (CSC-style): topic -> {user_id: proficiency}, so a
+      sparse matrix-vector product only touches users sharing a topic
+    - Dirty set: writers mark users stale; their rows are reloaded in one
+      IN query on the next lookup (incremental refresh)
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._rows = {}      # user_id -> {topic: value}
+        self._norms = {}     # user_id -> L2 norm of the row
+        self._columns = {}   # topic -> {user_id: value}
+        self._dirty = set()
+        self._built = False
+
+    def _set_row_locked(self, user_id, row):
+        for topic in self._rows.get(user_id, {}):
+            col = self._columns.get(topic)
+            if col is not None:
+                col.pop(user_id, None)
+                if not col:
+                    del self._columns[topic]
+        row = {t: v for t, v in row.items() if v}
+        if row:
+            self._rows[user_id] = row
+            self._norms[user_id] = sum(v * v for v in row.values()) ** 0.5
+            for topic, value in row.items():
+                self._columns.setdefault(topic, {})[user_id] = value
+        else:
+            self._rows.pop(user_id, None)
+            self._norms.pop(user_id, None)
+
+    @staticmethod
+    def _load_rows(user_ids=None):
+        query = db.session.query(TopicProficiency.user_id, TopicProficiency.topic_name, TopicProficiency.proficiency)
+        if user_ids is not None:
+            query = query.filter(TopicProficiency.user_id.in_(user_ids))
+        rows = {}
+        for uid, topic, value in query.all():
+            if topic:
+                rows.setdefault(uid, {})[topic.strip()] = float(value or 0)
+        return rows
+
+    def rebuild(self):
+        rows = self._load_rows()
+        with self._lock:
+            self._rows, self._norms, self._columns = {}, {}, {}
+            for uid, row in rows.items():
+                self._set_row_locked(uid, row)
+            self._dirty.clear()
+            self._built = True
+
+    def mark_dirty(self, user_id):
+        """Call after changing a user's TopicProficiency rows."""
+        with self._lock:
+            self._dirty.add(user_id)
+
+    def ensure_fresh(self):
+        """Build the matrix on first use and reload rows of users marked dirty."""
+        self._refresh()
+
+    def _refresh(self):
+        if not self._built:
+            self.rebuild()
+            return
+        with self._lock:
+            dirty = list(self._dirty)
+            self._dirty.clear()
+        if not dirty:
+            return
+        rows = self._load_rows(dirty)
+        with self._lock:
+            for uid in dirty:
+                self._set_row_locked(uid, rows.get(uid, {}))
+
+    def similarities(self, user_id):
+        """Cosine similarity of user_id's row against every other row sharing a topic."""
+        self._refresh()
+        with self._lock:
+            row = self._rows.get(user_id)
+            if not row:
+                return {}
+            dots = {}
+            for topic, value in row.items():
+                for other_id, other_value in self._columns.get(topic, {}).items():
+                    if other_id != user_id:
+                        dots[other_id] = dots.get(other_id, 0.0) + value * other_value
+            norm = self._norms[user_id]
+            return {uid: dot / (norm * self._norms[uid]) for uid, dot in dots.items() if self._norms.get(uid)}
+
+    def common_topics(self, user_id, other_id, limit=3):
+        """Shared topics, strongest for both users first (call ensure_fresh() before a batch)."""
+        with self._lock:
+            mine = self._rows.get(user_id, {})
+            theirs = self._rows.get(other_id, {})
+            shared = [(min(mine[t], theirs[t]), t) for t in mine if t in theirs]
+        return [t for _, t in sorted(shared, reverse=True)[:limit]]
+
+
+proficiency_matrix = ProficiencyMatrix()
+
+
 class MatchmakingService:
+    # Score weights (max ~100 before jitter)
+    LEVEL_WEIGHT = 20       # Same level = 20, fades to 0 at LEVEL_RANGE apart
+    LEVEL_RANGE = 15
+    TOPIC_WEIGHT = 50       # Cosine similarity of topic proficiency vectors
+    RECENT_DAY_BONUS = 30   # Seen in the last 24h
+    RECENT_WEEK_BONUS = 10  # Seen in the last 7 days
+
     @staticmethod
-    def find_matches(user):
-        # 1. Get candidates (not self, not already friends)
-        subq = db.session.query(Friendship.friend_id).filter(Friendship.user_id == user.id)
-        subq2 = db.session.query(Friendship.user_id).filter(Friendship.friend_id == user.id)
-        
-        candidates = User.query.filter(
-            User.id != user.id,
-            ~User.id.in_(subq),
-            ~User.id.in_(subq2),
-            User.is_public_profile == True
-        ).limit(50).all()
-        
-        matches = []
-        user_proficiencies = {p.topic_name for p in TopicProficiency.query.filter_by(user_id=user.id).all()}
-        
-        for candidate in candidates:
-            score = 0
-            
-            # Level Compatibility
-            level_diff = abs(user.level - candidate.level)
-            if level_diff <= 5:
-                score += 20
-            elif level_diff <= 10:
-                score += 10
-                
-            # Topic Overlap
-            cand_prof = {p.topic_name for p in TopicProficiency.query.filter_by(user_id=candidate.id).all()}
-            overlap = user_proficiencies.intersection(cand_prof)
-            score += len(overlap) * 10
-            
-            # Recency
-            if candidate.last_seen: 
-                 delta = datetime.utcnow() - candidate.last_seen
-                 if delta < timedelta(days=1):
-                    score += 30 
-                 elif delta < timedelta(days=7):
-                    score += 10
-            
+    def find_matches(user, limit=5):
+        """
+        Score every eligible user in one pass: one narrow query for candidate
+        levels/last_seen, one sparse product for topic similarity and one IN
+        query for the winners' profiles.
+        """
+        # 1. Exclude self and anyone with a friendship row in either direction (adjacency cache)
+        excluded = friend_graph.linked_ids(user.id) | {user.id}
+
+        candidates = db.session.query(User.id, User.level, User.last_seen).filter(
+            User.is_public_profile == True,
+            User.is_admin == False,
+            User.is_banned == False
+        ).all()
+
+        similarity = proficiency_matrix.similarities(user.id)
+        now = datetime.utcnow()
+        scored = []
+        for cand_id, cand_level, cand_seen in candidates:
+            if cand_id in excluded:
+                continue
+            # Level Compatibility (linear fall-off)
+            level_diff = abs((user.level or 1) - (cand_level or 1))
+            score = MatchmakingService.LEVEL_WEIGHT * max(0.0, 1 - level_diff / MatchmakingService.LEVEL_RANGE)
+
+            # Topic similarity
+            score += MatchmakingService.TOPIC_WEIGHT * similarity.get(cand_id, 0.0)
+
+            # Recency (buffered presence beats the DB column)
+            seen = presence.last_seen(cand_id, cand_seen)
+            if seen:
+                delta = now - seen
+                if delta < timedelta(days=1):
+                    score += MatchmakingService.RECENT_DAY_BONUS
+                elif delta < timedelta(days=7):
+                    score += MatchmakingService.RECENT_WEEK_BONUS
+
             # Random jitter to keep list fresh if scores are tie
             score += random.randint(0, 5)
+            scored.append((score, cand_id))
 
-            matches.append({
-                'user': candidate,
-                'score': score,
-                'common_topics': list(overlap)[:3]
-            })
-            
-        matches.sort(key=lambda x: x['score'], reverse=True)
-        return matches[:5]
+        top = heapq.nlargest(limit, scored)
+        if not top:
+            return []
+        users = {u.id: u for u in User.query.filter(User.id.in_([uid for _, uid in top])).all()}
+
+        matches = []
+        for score, cand_id in top:
+            if cand_id in users:
+                matches.append({
+                    'user': users[cand_id],
+                    'score': int(round(score)),
+                    'common_topics': proficiency_matrix.common_topics(user.id, cand_id)
+                })
+        return matches
 
 @app.route('/api/matches')
 @login_required
@@ -5463,7 +9321,7 @@ def get_matches():
     results = []
     for m in raw_matches:
         u = m['user']
-        current_rank = GamificationService.get_rank(u.level)
+        current_rank = u.rank_info
         results.append({
             'id': u.id,
             'name': f"{u.first_name} {u.last_name}",
@@ -5551,13 +9409,14 @@ def quiz_submit():
     # Bonus for perfect score
     if correct_count == len(answers) and correct_count > 0:
         xp_earned += 50
-        GamificationService.award_badge(current_user, 'Quiz Master') # Need to ensure badge exists or create dynamically handling it
+        badge_engine.evaluate([(current_user.id, 'quiz_perfect', 0, 1)])
 
     # Save XP
     if xp_earned > 0:
         GamificationService.add_xp(current_user.id, 'quiz', xp_earned)
         
     db.session.commit()
+    proficiency_matrix.mark_dirty(current_user.id)  # After the commit (see todos_toggle)
     
     return jsonify({
         'status': 'success',
@@ -5978,13 +9837,8 @@ def admin_users():
     )
     
     if search:
-        query = query.filter(
-            db.or_(
-                User.email.ilike(f'%{search}%'),
-                User.first_name.ilike(f'%{search}%'),
-                User.last_name.ilike(f'%{search}%')
-            )
-        )
+        # pg_trgm-indexed ILIKE on PostgreSQL, in-process trigram index otherwise
+        query = query.filter(user_search_index.match_filter(search))
     
     if filter_type == 'active':
         query = query.filter(User.last_seen >= datetime.utcnow() - timedelta(days=7))
@@ -6000,20 +9854,17 @@ def admin_users():
 @admin_required
 def admin_user_activity():
     """Admin view for user presence and recent activity."""
-    # Define threshold for "offline"
-    threshold = datetime.utcnow() - timedelta(minutes=ONLINE_THRESHOLD_MINUTES)
-    
-    # Fetch actually online users (in set AND seen recently)
+    # Write buffered timestamps so the "all users" list below is ordered correctly
+    presence.flush()
+
+    # Fetch actually online users (seen recently according to the presence buffer)
     active_users = []
-    if online_users:
+    online_ids = presence.online_ids()
+    if online_ids:
         active_users = User.query.filter(
-            User.id.in_(online_users), 
-            User.last_seen >= threshold,
+            User.id.in_(online_ids),
             User.is_admin == False
         ).all()
-        # Prune stale IDs from set
-        active_ids = {u.id for u in active_users}
-        online_users.intersection_update(active_ids)
         
     # Format current time to IST helper
     def format_ist(dt):
@@ -6133,6 +9984,7 @@ def admin_adjust_xp(user_id):
     # Log XP change
     log = XPHistory(user_id=user.id, source='admin', amount=amount)
     db.session.add(log)
+    DailyStatsService.bump_xp(user.id, 'admin', amount)
     
     # Log admin action
     AdminService.log_action(
@@ -6142,6 +9994,7 @@ def admin_adjust_xp(user_id):
         target_id=user_id,
         details={'amount': amount, 'reason': reason}
     )
+    rank_index.update(user)
     
     # Notify user via Support System
     action_type = "added" if amount > 0 else "removed"
@@ -6190,6 +10043,7 @@ def admin_support_detail(ticket_id):
     if unread_msgs:
         ticket.admin_unread_count = 0
         db.session.commit()
+        invalidate_support_context(ticket.user_id)
     
     messages = SupportMessage.query.filter_by(ticket_id=ticket.id).order_by(SupportMessage.created_at.asc()).all()
     return render_template('admin/support/detail.html', ticket=ticket, user=user, messages=messages)
@@ -6216,6 +10070,7 @@ def admin_support_close(ticket_id):
     ticket.status = 'closed'
     ticket.closed_at = datetime.utcnow()
     db.session.commit()
+    invalidate_support_context(ticket.user_id)
     flash('Ticket closed successfully', 'success')
     return redirect(url_for('admin_support'))
 
@@ -6352,18 +10207,22 @@ def admin_battles():
     
     # Get stats
     total_sessions = StudySession.query.count()
-    total_focus_time = db.session.query(db.func.sum(StudySession.duration)).filter_by(mode='focus').scalar() or 0
-    total_break_time = db.session.query(db.func.sum(StudySession.duration)).filter(StudySession.mode.in_(['shortBreak', 'longBreak'])).scalar() or 0
+    # Totals come from the daily rollup (one row per user per day)
+    total_study_time, total_focus_time = db.session.query(
+        db.func.coalesce(db.func.sum(UserDailyStats.study_minutes), 0),
+        db.func.coalesce(db.func.sum(UserDailyStats.focus_minutes), 0)
+    ).one()
+    total_break_time = (total_study_time or 0) - (total_focus_time or 0)
     
     # Top studiers
     from sqlalchemy import func
     top_studiers = db.session.query(
-        User, func.sum(StudySession.duration).label('total_time')
-    ).join(StudySession).filter(
+        User, func.sum(UserDailyStats.study_minutes).label('total_time')
+    ).join(UserDailyStats, UserDailyStats.user_id == User.id).filter(
         User.is_admin == False,
         User.email != 'admin@studyverse.com',
         User.email != 'admin@studyversefinal.com'
-    ).group_by(User.id).order_by(func.sum(StudySession.duration).desc()).limit(10).all()
+    ).group_by(User.id).order_by(func.sum(UserDailyStats.study_minutes).desc()).limit(10).all()
     
     stats = {
         'total_sessions': total_sessions,
@@ -6400,14 +10259,14 @@ def admin_analytics():
     
     # Study sessions
     total_sessions = StudySession.query.count()
-    total_study_time = db.session.query(db.func.sum(StudySession.duration)).scalar() or 0
+    total_study_time = db.session.query(db.func.sum(UserDailyStats.study_minutes)).scalar() or 0
     
     # Group activity
     total_groups = Group.query.count()
     total_group_members = GroupMember.query.count()
     
     # XP activity
-    total_xp_earned = db.session.query(db.func.sum(XPHistory.amount)).filter(XPHistory.amount > 0).scalar() or 0
+    total_xp_earned = db.session.query(db.func.sum(UserDailyStats.xp_earned)).scalar() or 0
     
     # Recent activity (last 7 days)
     seven_days_ago = datetime.utcnow() - timedelta(days=7)
@@ -6434,6 +10293,58 @@ def admin_analytics():
     return render_template('admin/analytics/dashboard.html', stats=stats)
 
 
+@app.route('/admin/metrics/rank-index')
+@login_required
+@admin_required
+def admin_rank_index_check():
+    """Leaderboard rank index consistency report (JSON). ?repair=1 rebuilds on mismatch."""
+    repair = request.args.get('repair', type=int) == 1
+    return jsonify(rank_index.check_consistency(repair=repair))
+
+
+@app.route('/admin/metrics/db-pool')
+@login_required
+@admin_required
+def admin_db_pool_metrics():
+    """Connection pool checkout/wait metrics (JSON)"""
+    return jsonify(db_pool_metrics.snapshot(db.engine.pool))
+
+
+@app.route('/admin/metrics/ai-gateway')
+@login_required
+@admin_required
+def admin_ai_gateway_metrics():
+    """AI gateway pool usage, coalescing and rejection counters (JSON)"""
+    return jsonify(ai_gateway.stats())
+
+
+@app.route('/admin/metrics/ai-keys')
+@login_required
+@admin_required
+def admin_ai_key_health():
+    """Gemini key health: token buckets, cooldowns, daily exhaustion, latency / errors"""
+    keys = gemini_keys.health()
+    if request.args.get('format') == 'json':
+        return jsonify({'keys': keys, 'gateway': ai_gateway.stats()})
+    return render_template('admin/ai_keys.html', keys=keys, gateway=ai_gateway.stats())
+
+
+@app.route('/admin/metrics/chat-cache')
+@login_required
+@admin_required
+def admin_chat_cache_metrics():
+    """AI chat response cache hit/miss/eviction counters (JSON)"""
+    return jsonify(ChatService.cache_stats())
+
+
+@app.route('/admin/metrics/syllabus-cache')
+@login_required
+@admin_required
+def admin_syllabus_cache_metrics():
+    """Syllabus extraction cache hit rate, entries and evictions (JSON)"""
+    return jsonify(syllabus_extraction_cache.stats())
+
+
 
 # ============================================================================
 # ONE-TIME MIGRATION ROUTE (For Render Deployment)
@@ -6720,7 +10631,7 @@ Generate a structured learning breakdown in JSON format:
 
 Return ONLY valid JSON. No markdown, no extra text."""
 
-        resp = gemini_rotator.generate_content(AI_MODEL, prompt)
+        resp = ai_gateway.generate('topic', AI_MODEL, prompt)
         raw = resp.text.strip()
         # Strip markdown code fences if present
         if raw.startswith('```'):
@@ -6877,14 +10788,15 @@ def topic_resolver_diagram():
         return jsonify({'description': 'AI diagram service not available.'}), 200
 
     try:
-        # Try Gemini image generation model (rotator handles quota failover)
+        # Try Gemini image generation model (key scheduler handles quota failover)
         image_prompt = (
             f"Create a clean, educational diagram or concept map for the topic: '{topic}'. "
             f"The diagram should be: labeled clearly, use arrows and boxes, show relationships, "
             f"use a dark background with colourful labels, academic style, no text clutter. "
             f"Similar to a textbook figure or Khan Academy illustration."
         )
-        image_response = gemini_rotator.generate_content(
+        image_response = ai_gateway.generate(
+            'topic',
             'gemini-2.0-flash-preview-image-generation',
             image_prompt,
             generation_config={"response_modalities": ["image", "text"]}
@@ -6907,7 +10819,7 @@ def topic_resolver_diagram():
         fallback_prompt = f"""Create a clear, structured text diagram or concept map for: "{topic}"
 Use ASCII art, arrows (→, ↓, ←, ↑), boxes (┌─┐ │ └─┘), and indentation to show relationships.
 Make it educational, concise, and visually clear. Max 30 lines."""
-        fb_resp = gemini_rotator.generate_content(AI_MODEL, fallback_prompt)
+        fb_resp = ai_gateway.generate('topic', AI_MODEL, fallback_prompt)
         return jsonify({'description': fb_resp.text.strip()})
     except Exception as fb_err:
         return jsonify({'description': f'Diagram generation unavailable for: {topic}'}), 200
@@ -6919,7 +10831,6 @@ def topic_resolver_award_xp():
     """Award XP for using the Topic Resolver feature."""
     try:
         result = GamificationService.add_xp(current_user.id, 'topic_resolver', 15)
-        GamificationService.update_streak(current_user.id)
         earned = (result or {}).get('earned', 15) if result else 15
         return jsonify({'earned': earned if earned > 0 else 15})
     except Exception:
@@ -7000,7 +10911,8 @@ IMPORTANT:
 - Be thorough with steps — explain each one clearly for a student.
 - Use simple, friendly language."""
 
-        response = gemini_rotator.generate_content(
+        response = ai_gateway.generate(
+            'photo',
             AI_MODEL,
             contents=[
                 {'role': 'user', 'parts': [
@@ -7051,7 +10963,6 @@ def photo_solver_award_xp():
     """Award XP for using the Photo Solver feature."""
     try:
         result = GamificationService.add_xp(current_user.id, 'photo_solver', 20)
-        GamificationService.update_streak(current_user.id)
         earned = (result or {}).get('earned', 20) if result else 20
         return jsonify({'earned': earned if earned > 0 else 20})
     except Exception:
@@ -7077,31 +10988,27 @@ _live_streams = {}   # key = stream_id (str(user_id))
 def live_streams_page():
     """Discovery page: shows all currently live friends."""
     # Get current user's accepted friends
-    friend_ids = [
-        f.friend_id if f.user_id == current_user.id else f.user_id
-        for f in Friendship.query.filter(
-            ((Friendship.user_id == current_user.id) | (Friendship.friend_id == current_user.id)),
-            Friendship.status == 'accepted'
-        ).all()
-    ]
+    friend_ids = friend_graph.friend_ids(current_user.id)
+    visible = {sid: info for sid, info in list(_live_streams.items())
+               if info.get('user_id') in friend_ids or info.get('user_id') == current_user.id}
+    profiles = load_users_by_id(info.get('user_id') for info in visible.values())
     # Find which friends are currently live
     live_friends = []
-    for sid, info in _live_streams.items():
+    for sid, info in visible.items():
         uid = info.get('user_id')
-        if uid in friend_ids or uid == current_user.id:
-            user = User.query.get(uid)
-            if user:
-                live_friends.append({
-                    'stream_id': sid,
-                    'user_id': uid,
-                    'name': f"{user.first_name} {user.last_name}".strip(),
-                    'avatar': user.get_avatar(64),
-                    'topic': info.get('topic', 'Studying'),
-                    'subject': info.get('subject', ''),
-                    'timer_min': info.get('timer_min', 25),
-                    'watcher_count': len(info.get('watchers', set())),
-                    'elapsed': info.get('elapsed', 0),
-                })
+        user = profiles.get(uid)
+        if user:
+            live_friends.append({
+                'stream_id': sid,
+                'user_id': uid,
+                'name': f"{user.first_name} {user.last_name}".strip(),
+                'avatar': user.get_avatar(64),
+                'topic': info.get('topic', 'Studying'),
+                'subject': info.get('subject', ''),
+                'timer_min': info.get('timer_min', 25),
+                'watcher_count': len(info.get('watchers', set())),
+                'elapsed': info.get('elapsed', 0),
+            })
     # Check if the current user is already streaming
     user_sid = str(current_user.id)
     user_is_live = user_sid in _live_streams
@@ -7143,29 +11050,25 @@ def watch_stream(streamer_id):
 @login_required
 def api_live_streams():
     """JSON API: returns all live streams from user's friends."""
-    friend_ids = [
-        f.friend_id if f.user_id == current_user.id else f.user_id
-        for f in Friendship.query.filter(
-            ((Friendship.user_id == current_user.id) | (Friendship.friend_id == current_user.id)),
-            Friendship.status == 'accepted'
-        ).all()
-    ]
+    friend_ids = friend_graph.friend_ids(current_user.id)
+    visible = {sid: info for sid, info in list(_live_streams.items())
+               if info.get('user_id') in friend_ids or info.get('user_id') == current_user.id}
+    profiles = load_users_by_id(info.get('user_id') for info in visible.values())
     result = []
-    for sid, info in _live_streams.items():
+    for sid, info in visible.items():
         uid = info.get('user_id')
-        if uid in friend_ids or uid == current_user.id:
-            user = User.query.get(uid)
-            if user:
-                result.append({
-                    'stream_id': sid,
-                    'user_id': uid,
-                    'name': f"{user.first_name} {user.last_name}".strip(),
-                    'avatar': user.get_avatar(48),
-                    'topic': info.get('topic', 'Studying'),
-                    'subject': info.get('subject', ''),
-                    'watcher_count': len(info.get('watchers', set())),
-                    'elapsed': info.get('elapsed', 0),
-                })
+        user = profiles.get(uid)
+        if user:
+            result.append({
+                'stream_id': sid,
+                'user_id': uid,
+                'name': f"{user.first_name} {user.last_name}".strip(),
+                'avatar': user.get_avatar(48),
+                'topic': info.get('topic', 'Studying'),
+                'subject': info.get('subject', ''),
+                'watcher_count': len(info.get('watchers', set())),
+                'elapsed': info.get('elapsed', 0),
+            })
     return jsonify({'streams': result})
 
 
@@ -7229,13 +11132,7 @@ def handle_go_live(data):
     join_room(f"stream_{sid}")
 
     # Notify all friends
-    friend_ids = [
-        f.friend_id if f.user_id == uid else f.user_id
-        for f in Friendship.query.filter(
-            ((Friendship.user_id == uid) | (Friendship.friend_id == uid)),
-            Friendship.status == 'accepted'
-        ).all()
-    ]
+    friend_ids = friend_graph.friend_ids(uid)
     notification = {
         'user_id': uid,
         'stream_id': sid,
@@ -7585,7 +11482,7 @@ def voice_assistant():
     to the frontend (which breaks the JSON contract expected by verse_assistant.js).
     """
     try:
-        if not gemini_rotator.available:
+        if not gemini_keys.available:
             return jsonify({'action': 'none', 'params': {}, 'reply': "I'm not set up yet.", 'dom_actions': []})
 
         data       = request.get_json(silent=True) or {}
@@ -7626,18 +11523,11 @@ def voice_assistant():
             pass
 
         try:
-            accepted = Friendship.query.filter(
-                ((Friendship.user_id == current_user.id) | (Friendship.friend_id == current_user.id)),
-                Friendship.status == 'accepted'
-            ).all()
             friends_names = []
-            for f in accepted[:10]:
-                fid = f.friend_id if f.user_id == current_user.id else f.user_id
-                friend = User.query.filter_by(id=fid).first()  # always works
-                if friend:
-                    name = f"{friend.first_name or ''} {friend.last_name or ''}".strip()
-                    if name:
-                        friends_names.append(name)
+            for friend in load_friends(current_user.id)[:10]:
+                name = f"{friend.first_name or ''} {friend.last_name or ''}".strip()
+                if name:
+                    friends_names.append(name)
             friends_str = ', '.join(friends_names) if friends_names else 'none'
         except Exception as _e:
             print(f"[Verse] Friends context error: {_e}")
@@ -7647,13 +11537,8 @@ def voice_assistant():
         rank_1_user = 'unknown'
         rank_1_xp   = 0
         try:
-            # User model does not have is_public_profile, is_admin, or is_banned,
-            # so we rely on standard filtering
-            my_rank = User.query.filter(
-                db.or_(User.level > current_user.level,
-                       db.and_(User.level == current_user.level, User.total_xp > current_user.total_xp))
-            ).count() + 1
-            top_users = User.query.order_by(User.level.desc(), User.total_xp.desc()).limit(5).all()
+            my_rank = rank_index.rank_of_user(current_user)
+            top_users = rank_index.top_users(5)
             if top_users:
                 rank_1_user = f"{top_users[0].first_name} {top_users[0].last_name or ''}".strip()
                 rank_1_xp   = top_users[0].total_xp or 0
@@ -7886,7 +11771,7 @@ User said: "{transcript}"
 """
 
         try:
-            response = gemini_rotator.generate_content(AI_MODEL, system_prompt)
+            response = ai_gateway.generate('voice', AI_MODEL, system_prompt)
             raw = response.text.strip()
             if raw.startswith('```'):
                 raw = raw.split('```')[1]
@@ -7997,19 +11882,18 @@ def verse_execute_action():
         if not target:
             return jsonify({'success': False, 'message': f'Could not find a user named {name}.'})
         # Check existing friendship
-        existing = Friendship.query.filter(
-            ((Friendship.user_id == current_user.id) & (Friendship.friend_id == target.id)) |
-            ((Friendship.user_id == target.id) & (Friendship.friend_id == current_user.id))
-        ).first()
-        if existing:
-            status = existing.status
+        status = friend_graph.status(current_user.id, target.id)
+        if status != 'none':
             if status == 'accepted':
                 return jsonify({'success': False, 'message': f'You are already friends with {target.first_name}.'})
             else:
                 return jsonify({'success': False, 'message': f'A friend request to {target.first_name} already exists.'})
+        if FriendGraph.row_exists(current_user.id, target.id):
+            return jsonify({'success': False, 'message': f'A friend request to {target.first_name} already exists.'})
         req = Friendship(user_id=current_user.id, friend_id=target.id, status='pending')
         db.session.add(req)
         db.session.commit()
+        friend_graph.on_request(req)
         # Socket notification
         try:
             socketio.emit('friend_request_received', {
@@ -8035,15 +11919,8 @@ def verse_execute_action():
     # ── GET LEADERBOARD ───────────────────────────────────────────────────
     elif action == 'get_leaderboard':
         try:
-            my_rank = User.query.filter(
-                User.is_public_profile == True, User.is_admin == False, User.is_banned == False,
-                db.or_(User.level > current_user.level,
-                       db.and_(User.level == current_user.level,
-                               User.total_xp > current_user.total_xp))
-            ).count() + 1
-            top_users = User.query.filter(
-                User.is_public_profile == True, User.is_admin == False, User.is_banned == False
-            ).order_by(User.level.desc(), User.total_xp.desc()).limit(5).all()
+            my_rank = rank_index.rank_of_user(current_user)
+            top_users = rank_index.top_users(5)
             lines = []
             for i, u in enumerate(top_users, 1):
                 n = f"{u.first_name} {u.last_name or ''}".strip()
@@ -8058,16 +11935,8 @@ def verse_execute_action():
     # ── GET FRIENDS ───────────────────────────────────────────────────────
     elif action == 'get_friends':
         try:
-            accepted = Friendship.query.filter(
-                ((Friendship.user_id == current_user.id) | (Friendship.friend_id == current_user.id)),
-                Friendship.status == 'accepted'
-            ).all()
-            names = []
-            for f in accepted:
-                fid = f.friend_id if f.user_id == current_user.id else f.user_id
-                friend = User.query.filter_by(id=fid).first()
-                if friend:
-                    names.append(f"{friend.first_name} {friend.last_name or ''}".strip())
+            names = [f"{friend.first_name} {friend.last_name or ''}".strip()
+                     for friend in load_friends(current_user.id)]
             if not names:
                 msg = "You don't have any friends yet on StudyVerse. Say 'send request to someone' to add them!"
             else:
@@ -8136,6 +12005,7 @@ def verse_execute_action():
                 return jsonify({'success': False, 'message': f"You don't own {matched_item['name']}."})
             user_item.is_active = False
             db.session.commit()
+            CosmeticsService.invalidate(current_user._get_current_object())
             return jsonify({'success': True, 'message': f"Unequipped {matched_item['name']}! Back to default."})
 
         # ── EQUIP (already owned) ──
@@ -8263,7 +12133,27 @@ def _startup_db_init():
                     else:
                         print(f"⚠️  Migration warning: {_col_err}")
 
+            try:
+                ShopService.ensure_ownership_index()
+            except Exception as _uq_err:
+                db.session.rollback()
+                print(f"⚠️  Inventory index warning: {_uq_err}")
+
             print("✅  DB migrations complete.")
+
+            # Step 3: Warm in-process indexes from the DB (each step independent)
+            for _name, _step in (
+                ('Rank index', rank_index.rebuild),
+                ('Friend graph', friend_graph.rebuild),
+                ('User search indexes', user_search_index.ensure_pg_indexes),
+                ('User search', user_search_index.rebuild),
+                ('Badge catalog', badge_engine.load),
+            ):
+                try:
+                    _step()
+                except Exception as _idx_err:
+                    db.session.rollback()
+                    print(f"⚠️  {_name} warm-up warning: {_idx_err}")
     except Exception as _e:
         print(f"⚠️  DB init thread error: {_e}")
 
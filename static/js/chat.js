@@ -23,7 +23,9 @@
  * 
  * 4. **Real-Time Messaging**:
  *    - AJAX-based message sending (no page refresh)
- *    - Loading indicator during AI processing
+ *    - Streaming replies: tokens arrive over Socket.IO as they are generated
+ *    - Stop button / Escape cancels a streaming reply
+ *    - Loading indicator until the first token
  *    - Auto-scroll to latest messages
  * 
  * 5. **Security**:
@@ -54,6 +56,7 @@
  * ---------------
  * - Message Object: {role: 'user'|'bot', content: string, timestamp: string}
  * - Chat State: {isLoading: boolean, messageHistory: Message[]}
+ * - Streams: {stream_id: {node, raw, frame}} (hash map of replies in progress)
  * 
  * ALGORITHMS:
  * ----------
@@ -66,6 +69,11 @@
  * - POST /chat/send: Send user message and get AI response
  *   Request: {message: string}
  *   Response: {status: 'success', reply: string, user_timestamp: string, ai_timestamp: string}
+ * - POST /chat/send (streaming): {message: string, stream: true, stream_id: string}
+ *   Response: {status: 'streaming', stream_id: string, user_timestamp: string}
+ *   Socket.IO (user_{id} room): chat_token {stream_id, delta},
+ *   chat_done / chat_error {stream_id, reply, cancelled, ai_timestamp}
+ *   Client emits chat_cancel {stream_id} to stop
  * 
  * DESIGN PATTERNS:
  * ---------------
@@ -85,6 +93,24 @@ document.addEventListener('DOMContentLoaded', () => {
     const chatInput = document.getElementById('chatInput');
     const messagesContainer = document.getElementById('messagesContainer');
     const loadingIndicator = document.getElementById('loadingIndicator');
+    const sendButton = document.getElementById('sendButton');
+
+    // Streaming replies arrive on the user's personal Socket.IO room
+    const chatSocket = (typeof io !== 'undefined') ? io({ reconnectionAttempts: 3 }) : null;
+    const streams = {};          // stream_id -> {node, raw, frame}
+    let activeStreamId = null;
+
+    if (chatSocket) {
+        chatSocket.on('connect', () => chatSocket.emit('join_user_room', {}));
+        chatSocket.on('chat_token', onChatToken);
+        chatSocket.on('chat_done', (data) => finishStream(data));
+        chatSocket.on('chat_error', (data) => finishStream(data));
+        chatSocket.on('disconnect', () => {
+            if (activeStreamId) {
+                finishStream({ stream_id: activeStreamId, note: 'Connection lost — reload to see the full reply.' });
+            }
+        });
+    }
 
     // 1. Initial Markdown Parsing for History
     document.querySelectorAll('.markdown-content').forEach(el => {
@@ -106,23 +132,29 @@ document.addEventListener('DOMContentLoaded', () => {
         // This simple version works for single line inputs primarily
     });
 
-    // 3. Handle Enter Key
+    // 3. Handle Enter Key (Escape stops a streaming reply)
     chatInput.addEventListener('keydown', (e) => {
         if (e.key === 'Enter' && !e.shiftKey) {
             e.preventDefault();
             submitMessage();
+        } else if (e.key === 'Escape' && activeStreamId) {
+            cancelStream();
         }
     });
 
-    // 4. Handle Form Submit
+    // 4. Handle Form Submit (the send button turns into a stop button while streaming)
     chatForm.addEventListener('submit', (e) => {
         e.preventDefault();
-        submitMessage();
+        if (activeStreamId) {
+            cancelStream();
+        } else {
+            submitMessage();
+        }
     });
 
     function submitMessage() {
         const message = chatInput.value.trim();
-        if (!message) return;
+        if (!message || activeStreamId) return;
 
         // Add User Message to UI
         appendMessage('user', message);
@@ -135,6 +167,120 @@ document.addEventListener('DOMContentLoaded', () => {
             scrollToBottom();
         }
 
+        if (chatSocket && chatSocket.connected) {
+            sendStreaming(message);
+        } else {
+            sendBlocking(message);
+        }
+    }
+
+    // ========================================================================
+    // STREAMING (Socket.IO)
+    // ========================================================================
+
+    function sendStreaming(message) {
+        const streamId = Date.now().toString(36) + Math.random().toString(36).slice(2, 10);
+        streams[streamId] = { node: null, raw: '', frame: null };
+        setStreaming(streamId);
+
+        fetch('/chat/send', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'X-Requested-With': 'XMLHttpRequest'
+            },
+            body: JSON.stringify({ message: message, stream: true, stream_id: streamId })
+        })
+            .then(response => response.json())
+            .then(data => {
+                if (data.status === 'streaming') {
+                    addUserTimestamp(data.user_timestamp);
+                    return;
+                }
+                dropStream(streamId);
+                appendMessage('bot', '⚠️ Error: ' + (data.message || 'Unknown error'));
+            })
+            .catch(err => {
+                console.error(err);
+                dropStream(streamId);
+                appendMessage('bot', '⚠️ Connection error. Please try again.');
+            });
+    }
+
+    function onChatToken(data) {
+        const stream = streams[data.stream_id];
+        if (!stream) return; // Another tab's stream
+
+        if (!stream.node) {
+            if (loadingIndicator) loadingIndicator.style.display = 'none';
+            stream.node = appendMessage('bot', '', null, true);
+        }
+        stream.raw += data.delta;
+
+        // Re-render markdown at most once per animation frame
+        if (!stream.frame) {
+            stream.frame = requestAnimationFrame(() => {
+                stream.frame = null;
+                renderStream(stream);
+                scrollToBottom();
+            });
+        }
+    }
+
+    function renderStream(stream) {
+        stream.node.querySelector('.msg-bubble').innerHTML = DOMPurify.sanitize(marked.parse(stream.raw));
+    }
+
+    function finishStream(data) {
+        const stream = streams[data.stream_id];
+        if (!stream) return;
+        dropStream(data.stream_id);
+
+        const text = data.reply || stream.raw;
+        let label = data.ai_timestamp || '';
+        if (data.cancelled) label = label ? `${label} · stopped` : 'stopped';
+        if (data.note) label = label ? `${label} · ${data.note}` : data.note;
+        if (!text) return;
+
+        if (!stream.node) {
+            // Finished before any token was rendered (cache hit, error, ...)
+            appendMessage('bot', text, label);
+            return;
+        }
+        stream.raw = text;
+        renderStream(stream);
+        if (label) stream.node.lastElementChild.appendChild(makeTimestamp(label));
+        delete stream.node.dataset.streaming;
+        messagesContainer.dispatchEvent(new CustomEvent('chat:stream-done', { detail: stream.node.querySelector('.msg-bubble').textContent }));
+        scrollToBottom();
+    }
+
+    function dropStream(streamId) {
+        const stream = streams[streamId];
+        if (stream && stream.frame) cancelAnimationFrame(stream.frame);
+        delete streams[streamId];
+        if (activeStreamId === streamId) setStreaming(null);
+        if (loadingIndicator) loadingIndicator.style.display = 'none';
+    }
+
+    function cancelStream() {
+        if (chatSocket && activeStreamId) {
+            chatSocket.emit('chat_cancel', { stream_id: activeStreamId });
+        }
+    }
+
+    function setStreaming(streamId) {
+        activeStreamId = streamId;
+        if (!sendButton) return;
+        sendButton.innerHTML = streamId ? '<i class="fa-solid fa-stop"></i>' : '<i class="fa-solid fa-paper-plane"></i>';
+        sendButton.title = streamId ? 'Stop generating (Esc)' : '';
+    }
+
+    // ========================================================================
+    // NON-STREAMING FALLBACK (no socket connection)
+    // ========================================================================
+
+    function sendBlocking(message) {
         // Send to Backend
         fetch('/chat/send', {
             method: 'POST',
@@ -151,14 +297,7 @@ document.addEventListener('DOMContentLoaded', () => {
 
                 if (data.status === 'success') {
                     // Add timestamp to the user message we just added
-                    const userMsgs = messagesContainer.querySelectorAll('.ai-msg.user');
-                    if (userMsgs.length > 0 && data.user_timestamp) {
-                        const lastUserMsg = userMsgs[userMsgs.length - 1];
-                        const timestamp = document.createElement('div');
-                        timestamp.style = 'font-size: 0.7rem; color: var(--text-secondary); text-align: right; margin: 0 4px;';
-                        timestamp.innerHTML = `<span>${data.user_timestamp}</span>`;
-                        lastUserMsg.querySelector('div').appendChild(timestamp);
-                    }
+                    addUserTimestamp(data.user_timestamp);
 
                     // Append AI message with timestamp
                     appendMessage('bot', data.reply, data.ai_timestamp);
@@ -173,9 +312,30 @@ document.addEventListener('DOMContentLoaded', () => {
             });
     }
 
-    function appendMessage(role, content, timestamp) {
+    function addUserTimestamp(userTimestamp) {
+        const userMsgs = messagesContainer.querySelectorAll('.ai-msg.user');
+        if (userMsgs.length > 0 && userTimestamp) {
+            const lastUserMsg = userMsgs[userMsgs.length - 1];
+            const timestamp = makeTimestamp(userTimestamp);
+            timestamp.style.textAlign = 'right';
+            lastUserMsg.querySelector('div').appendChild(timestamp);
+        }
+    }
+
+    function makeTimestamp(text) {
+        const timestampDiv = document.createElement('div');
+        timestampDiv.style = 'font-size: 0.7rem; color: var(--text-secondary); margin: 0 4px;';
+        const span = document.createElement('span');
+        span.textContent = text;
+        timestampDiv.appendChild(span);
+        return timestampDiv;
+    }
+
+    function appendMessage(role, content, timestamp, streaming) {
         const div = document.createElement('div');
         div.className = `ai-msg ${role}`;
+        // Voice output waits for chat:stream-done instead of reading the first token
+        if (streaming) div.dataset.streaming = 'true';
 
         let iconHtml = '';
         if (role === 'bot') {
@@ -201,10 +361,7 @@ document.addEventListener('DOMContentLoaded', () => {
 
         // Add timestamp if provided
         if (timestamp) {
-            const timestampDiv = document.createElement('div');
-            timestampDiv.style = 'font-size: 0.7rem; color: var(--text-secondary); margin: 0 4px;';
-            timestampDiv.innerHTML = `<span>${timestamp}</span>`;
-            bubble.appendChild(timestampDiv);
+            bubble.appendChild(makeTimestamp(timestamp));
         }
 
         div.innerHTML = `${iconHtml}`;
@@ -218,6 +375,7 @@ document.addEventListener('DOMContentLoaded', () => {
         }
 
         scrollToBottom();
+        return div;
     }
 
     function scrollToBottom() {
@@ -8,8 +8,10 @@
  * --------
  * 1. **PDF Upload**: Custom styled file input
  * 2. **File Validation**: Ensures only PDF files accepted
- * 3. **Loading State**: Disabled button during upload
+ * 3. **Loading State**: Disabled button with live progress while processing
  * 4. **AI Integration**: Uploaded syllabus used as context for AI chat
+ * 5. **Background Jobs**: Upload returns a job id; progress arrives over
+ *    Socket.IO (syllabus_progress), with /syllabus/jobs/<id> polling as fallback
  * 
  * FLOW:
  * -----
@@ -17,10 +19,10 @@
  * 2. Hidden file input triggered
  * 3. User selects PDF file
  * 4. File type validated (must be application/pdf)
- * 5. Form submitted to /syllabus/upload endpoint
- * 6. Backend extracts text from PDF
- * 7. Text stored in database for AI context
- * 8. Success message displayed
+ * 5. File posted to /syllabus/upload (AJAX), which returns {job_id} at once
+ * 6. Backend extracts text and AI tasks in parallel in the background
+ * 7. Progress shown on the button; text + tasks stored in database
+ * 8. Page reloads and the success message is displayed
  * 
  * BACKEND PROCESSING:
  * ------------------
@@ -47,6 +49,27 @@ document.addEventListener('DOMContentLoaded', () => {
     const pdfInput = document.getElementById('pdfInput');
     const form = document.getElementById('syllabusUploadForm');
 
+    const NOTICE_KEY = 'syllabusUploadNotice';
+    const POLL_MS = 3000;
+    let activeJobId = null;
+    let pollTimer = null;
+
+    // Result of a job that finished before the last reload
+    const notice = sessionStorage.getItem(NOTICE_KEY);
+    if (notice) {
+        sessionStorage.removeItem(NOTICE_KEY);
+        const { message, type } = JSON.parse(notice);
+        if (typeof showToast === 'function') showToast(message, type);
+    }
+
+    // Progress events arrive on the user's personal room
+    const socket = (typeof io !== 'undefined') ? io({ reconnectionAttempts: 3 }) : null;
+    if (socket) {
+        socket.on('connect', () => socket.emit('join_user_room', {}));
+        socket.on('syllabus_progress', (data) => {
+            if (data.job_id === activeJobId) onProgress(data);
+        });
+    }
 
     if (uploadPdf) {
         uploadPdf.addEventListener('click', () => {
@@ -58,13 +81,76 @@ document.addEventListener('DOMContentLoaded', () => {
         pdfInput.addEventListener('change', (e) => {
             const file = e.target.files[0];
             if (file && file.type === 'application/pdf') {
-                // Real upload: submit the form to Flask route (/syllabus/upload)
-                if (uploadPdf) {
-                    uploadPdf.disabled = true;
-                    uploadPdf.textContent = 'Uploading...';
-                }
-                form?.submit();
+                startUpload();
             }
         });
     }
-});
\ No newline at end of file
+
+    function setButton(text, disabled) {
+        if (!uploadPdf) return;
+        uploadPdf.disabled = disabled;
+        uploadPdf.textContent = text;
+    }
+
+    function startUpload() {
+        setButton('Uploading...', true);
+
+        fetch(form.action, {
+            method: 'POST',
+            headers: { 'X-Requested-With': 'XMLHttpRequest' },
+            body: new FormData(form)
+        })
+            .then(response => response.json())
+            .then(data => {
+                if (data.status !== 'queued') {
+                    fail(data.message || 'Upload failed');
+                    return;
+                }
+                activeJobId = data.job_id;
+                setButton('Processing...', true);
+                // Polling covers a dropped socket or a missed event
+                pollTimer = setInterval(poll, POLL_MS);
+            })
+            .catch(err => {
+                console.error(err);
+                fail('Upload failed. Please try again.');
+            });
+    }
+
+    function poll() {
+        if (!activeJobId) return;
+        fetch(`/syllabus/jobs/${activeJobId}`)
+            .then(response => response.json())
+            .then(data => {
+                if (data.status && data.status !== 'queued') onProgress({ ...data, job_id: activeJobId });
+            })
+            .catch(err => console.error(err));
+    }
+
+    function onProgress(data) {
+        if (data.status === 'done') {
+            finish();
+            const warnings = data.warnings || [];
+            const message = warnings.length ? `${data.message} (${warnings.join(' ')})` : data.message;
+            sessionStorage.setItem(NOTICE_KEY, JSON.stringify({ message, type: warnings.length ? 'warning' : 'success' }));
+            window.location.reload();
+        } else if (data.status === 'error') {
+            finish();
+            fail(data.message);
+        } else {
+            setButton(`${data.percent}% · ${data.message}`, true);
+        }
+    }
+
+    function finish() {
+        activeJobId = null;
+        if (pollTimer) clearInterval(pollTimer);
+        pollTimer = null;
+    }
+
+    function fail(message) {
+        if (typeof showToast === 'function') showToast(message, 'error');
+        setButton('Upload', false);
+        if (pdfInput) pdfInput.value = '';
+    }
+});